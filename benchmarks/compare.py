@@ -0,0 +1,77 @@
+"""Compare two benchmark results and report the regressions.
+
+Usage: python -m benchmarks.compare baseline.json current.json [--threshold 0.1]
+
+The exit status is 1 when a metric got worse than the threshold allows.
+"""
+
+import argparse
+import json
+import sys
+
+DEFAULT_THRESHOLD = 0.10
+
+# Metrics where a higher value is better, every other metric is a cost.
+HIGHER_IS_BETTER = ("_per_s",)
+IGNORED_METRICS = ("count", "entities")
+
+
+def load(path):
+    """Load the results written by benchmarks.run."""
+    with open(path, encoding="utf-8") as file:
+        return json.load(file)
+
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD):
+    """Return the relative change of every metric present in both results."""
+    changes = []
+    for name, result in current["benchmarks"].items():
+        base_metrics = baseline["benchmarks"].get(name, {}).get("metrics")
+        metrics = result.get("metrics")
+        if not base_metrics or not metrics:
+            continue
+        for metric, value in metrics.items():
+            base_value = base_metrics.get(metric)
+            if metric in IGNORED_METRICS or not base_value:
+                continue
+            change = (value - base_value) / abs(base_value)
+            if metric.endswith(HIGHER_IS_BETTER):
+                change = -change
+            changes.append(
+                {
+                    "benchmark": name,
+                    "metric": metric,
+                    "baseline": base_value,
+                    "current": value,
+                    "change": change,
+                    "regression": change > threshold,
+                }
+            )
+    return changes
+
+
+def main(argv=None):
+    """Print the comparison of two results and fail on regressions."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument("--json", action="store_true", help="print the changes as JSON")
+    args = parser.parse_args(argv)
+
+    changes = compare(load(args.baseline), load(args.current), args.threshold)
+    if args.json:
+        print(json.dumps(changes, indent=2))
+    else:
+        for change in changes:
+            flag = "REGRESSION" if change["regression"] else ""
+            print(
+                f"{change['benchmark']:>16} {change['metric']:<22} "
+                f"{change['baseline']:>14.4f} {change['current']:>14.4f} "
+                f"{change['change']:>+8.1%} {flag}"
+            )
+    return 1 if any(change["regression"] for change in changes) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
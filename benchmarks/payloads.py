@@ -0,0 +1,127 @@
+"""Synthetic MobilityLabs responses used by the benchmarks."""
+
+import random
+
+ACCESS_TOKEN = "3bd5855a-ed3d-41d5-8b4b-182726f86031"
+DEFAULT_LINES = 10
+DEFAULT_ARRIVALS_PER_LINE = 2
+
+
+def line_label(index) -> str:
+    """Return the label of the synthetic line with the given index."""
+    return str(index + 1)
+
+
+def login_response():
+    """Return a successful login response."""
+    return {
+        "code": "01",
+        "description": "Token extend into control-cache Data recovered OK",
+        "data": [
+            {
+                "accessToken": ACCESS_TOKEN,
+                "tokenSecExpiration": 86399,
+                "apiCounter": {"current": 0, "dailyUse": 10_000_000},
+            }
+        ],
+    }
+
+
+def stop_info_response(stop_id, lines=DEFAULT_LINES):
+    """Return a bus stop detail response with the given number of lines."""
+    return {
+        "code": "00",
+        "description": "Data recovered OK",
+        "data": [
+            {
+                "stops": [
+                    {
+                        "stop": str(stop_id),
+                        "name": f"Stop {stop_id}",
+                        "postalAddress": f"Calle {stop_id}",
+                        "geometry": {
+                            "type": "Point",
+                            "coordinates": [-3.69214452424823, 40.4203613685499],
+                        },
+                        "dataLine": [
+                            {
+                                "line": f"{index + 1:03d}",
+                                "label": line_label(index),
+                                "direction": "A" if index % 2 else "B",
+                                "maxFreq": "25",
+                                "minFreq": "11",
+                                "headerA": f"Origin {index + 1}",
+                                "headerB": f"Destination {index + 1}",
+                                "startTime": "07:00",
+                                "stopTime": "23:30",
+                                "dayType": "LA",
+                            }
+                            for index in range(lines)
+                        ],
+                    }
+                ]
+            }
+        ],
+    }
+
+
+def arround_stop_response(stop_id, lines=DEFAULT_LINES):
+    """Return a stops arround stop response with the given number of lines."""
+    return {
+        "code": "00",
+        "description": "Data recovered OK",
+        "data": [
+            {
+                "stopId": stop_id,
+                "stopName": f"Stop {stop_id}",
+                "address": f"Calle {stop_id}",
+                "geometry": {
+                    "type": "Point",
+                    "coordinates": [-3.69214452424823, 40.4203613685499],
+                },
+                "lines": [
+                    {
+                        "line": f"{index + 1:03d}",
+                        "label": line_label(index),
+                        "to": "A" if index % 2 else "B",
+                        "nameA": f"Origin {index + 1}",
+                        "nameB": f"Destination {index + 1}",
+                    }
+                    for index in range(lines)
+                ],
+            }
+        ],
+    }
+
+
+def arrivals_response(
+    stop_id, lines=DEFAULT_LINES, arrivals_per_line=DEFAULT_ARRIVALS_PER_LINE, seed=0
+):
+    """Return an arrival times response with the given number of arrivals per line."""
+    rng = random.Random(seed)
+    arrive = []
+    for index in range(lines):
+        for _ in range(arrivals_per_line):
+            arrive.append(
+                {
+                    "line": line_label(index),
+                    "stop": str(stop_id),
+                    "isHead": "False",
+                    "destination": f"Destination {index + 1}",
+                    "deviation": 0,
+                    "bus": rng.randint(1, 9999),
+                    "geometry": {
+                        "type": "Point",
+                        "coordinates": [-3.69295437941713, 40.41338567959594],
+                    },
+                    "estimateArrive": rng.randint(0, 3600),
+                    "DistanceBus": rng.randint(0, 10000),
+                    "positionTypeBus": "0",
+                }
+            )
+    arrive.sort(key=lambda arrival: arrival["estimateArrive"])
+    return {
+        "code": "00",
+        "description": "Data recovered OK",
+        "data": [{"Arrive": arrive, "StopInfo": [], "ExtraInfo": [], "Incident": {}}],
+    }
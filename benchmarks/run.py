@@ -0,0 +1,345 @@
+"""Run the EMT Madrid benchmarks and write the results as JSON.
+
+Usage: python -m benchmarks.run [--stops N] [--lines M] [--output results.json]
+
+Every request is answered by a local stub of the MobilityLabs API, so the suite
+runs offline and only measures the client. The results of two runs can be
+compared with python -m benchmarks.compare.
+"""
+
+import argparse
+import asyncio
+from datetime import datetime, timezone
+import gc
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from custom_components.emt_madrid import emt_madrid
+from custom_components.emt_madrid.auth import TokenManager
+from custom_components.emt_madrid.cache import StopInfoCache
+
+from . import payloads
+from .stub_server import StubServer
+
+SCHEMA_VERSION = 1
+FIRST_STOP_ID = 1000
+DEFAULT_STOPS = 20
+DEFAULT_POLLS = 200
+DEFAULT_PARSE_LINES = 50
+DEFAULT_PARSE_ARRIVALS = 20
+DEFAULT_PARSE_ROUNDS = 500
+
+
+def summarize(durations):
+    """Return the latency statistics, in milliseconds, of a list of durations."""
+    durations_ms = sorted(duration * 1000 for duration in durations)
+    quantiles = (
+        statistics.quantiles(durations_ms, n=100)
+        if len(durations_ms) > 1
+        else durations_ms * 99
+    )
+    return {
+        "count": len(durations_ms),
+        "mean_ms": statistics.fmean(durations_ms),
+        "median_ms": statistics.median(durations_ms),
+        "p95_ms": quantiles[94],
+        "min_ms": durations_ms[0],
+        "max_ms": durations_ms[-1],
+    }
+
+
+def stop_ids(stops):
+    """Return the IDs of the synthetic bus stops."""
+    return list(range(FIRST_STOP_ID, FIRST_STOP_ID + stops))
+
+
+def create_client(stop_id, session, account="bench"):
+    """Create a client without arrival caching and with its own caches."""
+    return emt_madrid.APIEMT(
+        f"{account}@mail.com",
+        "password123",
+        stop_id,
+        session=session,
+        token_manager=TokenManager(),
+        stop_info_cache=StopInfoCache(),
+        min_freshness=0,
+        stale_ttl=0,
+    )
+
+
+def bench_client_setup(stops):
+    """Measure the login, bus stop information and first arrival times per stop."""
+    session = emt_madrid.create_session(retries=0)
+    durations = []
+    for stop_id in stop_ids(stops):
+        start = time.perf_counter()
+        api_emt = create_client(stop_id, session)
+        api_emt.authenticate()
+        api_emt.update_stop_info(stop_id)
+        api_emt.update_arrival_times(stop_id)
+        durations.append(time.perf_counter() - start)
+    session.close()
+    return {"params": {"stops": stops}, "metrics": summarize(durations)}
+
+
+async def _async_setup_platform(stops, lines):
+    """Measure the sensor platform setup of each bus stop in Home Assistant.
+
+    The setup of a stop returns before its requests, which run in background tasks,
+    so the time until every stop is loaded is measured as well.
+    """
+    from homeassistant.core import HomeAssistant
+
+    from custom_components.emt_madrid import sensor
+
+    with tempfile.TemporaryDirectory() as config_dir:
+        hass = HomeAssistant(config_dir)
+        durations = []
+        entities = []
+        ready_start = time.perf_counter()
+        for stop_id in stop_ids(stops):
+            config = {
+                "email": "setup@mail.com",
+                "password": "password123",
+                "stop": stop_id,
+                "lines": [payloads.line_label(index) for index in range(lines)],
+                "icon": sensor.DEFAULT_ICON,
+            }
+            start = time.perf_counter()
+            await sensor.async_setup_platform(hass, config, entities.extend)
+            durations.append(time.perf_counter() - start)
+        await hass.async_block_till_done(wait_background_tasks=True)
+        ready = time.perf_counter() - ready_start
+        await hass.async_stop(force=True)
+    return durations, ready, len(entities)
+
+
+def bench_setup_platform(stops, lines):
+    """Measure the sensor platform setup, if Home Assistant is installed."""
+    try:
+        import homeassistant.core  # noqa: F401
+    except ImportError:
+        return {"params": {"stops": stops}, "skipped": "homeassistant not installed"}
+    durations, ready, entities = asyncio.run(_async_setup_platform(stops, lines))
+    metrics = summarize(durations)
+    metrics["ready_ms"] = ready * 1000
+    metrics["entities"] = entities
+    return {"params": {"stops": stops, "lines": lines}, "metrics": metrics}
+
+
+def bench_poll(stops, polls):
+    """Measure the latency of update_arrival_times with a pooled session."""
+    session = emt_madrid.create_session(retries=0)
+    clients = [create_client(stop_id, session) for stop_id in stop_ids(stops)]
+    for api_emt in clients:
+        api_emt.update_stop_info(api_emt.get_stop_info().stop_id)
+    durations = []
+    for poll in range(polls):
+        api_emt = clients[poll % len(clients)]
+        stop_id = api_emt.get_stop_info().stop_id
+        start = time.perf_counter()
+        api_emt.update_arrival_times(stop_id)
+        durations.append(time.perf_counter() - start)
+    session.close()
+    return {"params": {"stops": stops, "polls": polls}, "metrics": summarize(durations)}
+
+
+async def _async_poll(stops, polls):
+    """Measure the latency of the asyncio update_arrival_times."""
+    import aiohttp
+
+    async with aiohttp.ClientSession() as session:
+        clients = [
+            emt_madrid.AsyncAPIEMT(
+                session,
+                "async@mail.com",
+                "password123",
+                stop_id,
+                token_manager=TokenManager(),
+                stop_info_cache=StopInfoCache(),
+                min_freshness=0,
+                stale_ttl=0,
+            )
+            for stop_id in stop_ids(stops)
+        ]
+        for api_emt in clients:
+            await api_emt.update_stop_info(api_emt.get_stop_info().stop_id)
+        durations = []
+        for poll in range(polls):
+            api_emt = clients[poll % len(clients)]
+            stop_id = api_emt.get_stop_info().stop_id
+            start = time.perf_counter()
+            await api_emt.update_arrival_times(stop_id)
+            durations.append(time.perf_counter() - start)
+    return durations
+
+
+def bench_async_poll(stops, polls):
+    """Measure the latency of the asyncio client polls."""
+    durations = asyncio.run(_async_poll(stops, polls))
+    return {"params": {"stops": stops, "polls": polls}, "metrics": summarize(durations)}
+
+
+def bench_parse_arrivals(lines, arrivals_per_line, rounds):
+    """Measure the decoding and parsing throughput of large arrival payloads."""
+    stop_id = FIRST_STOP_ID
+    api_emt = create_client(stop_id, None)
+    api_emt._parse_stop_info(payloads.stop_info_response(stop_id, lines), "full")
+    response = payloads.arrivals_response(stop_id, lines, arrivals_per_line)
+    body = json.dumps(response).encode()
+    arrivals = lines * arrivals_per_line
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        emt_madrid.json_loads(body)
+    decode_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        api_emt._parse_arrivals(response)
+    parse_seconds = time.perf_counter() - start
+
+    return {
+        "params": {
+            "lines": lines,
+            "arrivals_per_line": arrivals_per_line,
+            "rounds": rounds,
+            "payload_bytes": len(body),
+            "json_backend": "orjson" if emt_madrid.orjson is not None else "json",
+        },
+        "metrics": {
+            "decode_ms": decode_seconds * 1000 / rounds,
+            "decode_mb_per_s": len(body) * rounds / decode_seconds / 1e6,
+            "parse_ms": parse_seconds * 1000 / rounds,
+            "parse_arrivals_per_s": arrivals * rounds / parse_seconds,
+        },
+    }
+
+
+def bench_memory(stops, lines, arrivals_per_line):
+    """Measure the memory and allocations of N bus stops with M lines each."""
+    responses = [
+        (
+            payloads.stop_info_response(stop_id, lines),
+            payloads.arrivals_response(stop_id, lines, arrivals_per_line, seed=stop_id),
+        )
+        for stop_id in stop_ids(stops)
+    ]
+    token_manager = TokenManager()
+    stop_info_cache = StopInfoCache()
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    clients = []
+    for stop_id, (stop_info, arrivals) in zip(stop_ids(stops), responses):
+        api_emt = emt_madrid.APIEMT(
+            "memory@mail.com",
+            "password123",
+            stop_id,
+            token_manager=token_manager,
+            stop_info_cache=stop_info_cache,
+        )
+        api_emt._parse_stop_info(stop_info, "full")
+        api_emt._parse_arrivals(arrivals)
+        clients.append(api_emt)
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    stats = after.compare_to(before, "filename")
+    allocated = sum(stat.size_diff for stat in stats)
+    blocks = sum(stat.count_diff for stat in stats)
+    return {
+        "params": {
+            "stops": stops,
+            "lines": lines,
+            "arrivals_per_line": arrivals_per_line,
+        },
+        "metrics": {
+            "retained_bytes": allocated,
+            "retained_blocks": blocks,
+            "bytes_per_stop": allocated / stops,
+            "peak_bytes": peak,
+            "current_bytes": current,
+        },
+    }
+
+
+def git_revision():
+    """Return the current git commit, if the suite runs from a checkout."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def metadata(args):
+    """Return the environment of the run, to tell apart the compared results."""
+    return {
+        "schema": SCHEMA_VERSION,
+        "date": datetime.now(timezone.utc).isoformat(),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "arguments": vars(args),
+    }
+
+
+def run(args):
+    """Run every benchmark against a local stub server."""
+    results = {}
+    with StubServer(lines=args.lines, latency=args.latency) as stub:
+        emt_madrid.BASE_URL = stub.base_url
+        results["client_setup"] = bench_client_setup(args.stops)
+        results["setup_platform"] = bench_setup_platform(args.stops, args.lines)
+        results["poll"] = bench_poll(args.stops, args.polls)
+        results["async_poll"] = bench_async_poll(args.stops, args.polls)
+        requests = dict(stub.requests)
+    results["parse_arrivals"] = bench_parse_arrivals(
+        args.parse_lines, args.parse_arrivals, args.parse_rounds
+    )
+    results["memory"] = bench_memory(args.stops, args.lines, args.arrivals)
+    return {"metadata": metadata(args), "requests": requests, "benchmarks": results}
+
+
+def main(argv=None):
+    """Parse the arguments, run the benchmarks and write the results."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--stops", type=int, default=DEFAULT_STOPS)
+    parser.add_argument("--lines", type=int, default=payloads.DEFAULT_LINES)
+    parser.add_argument(
+        "--arrivals", type=int, default=payloads.DEFAULT_ARRIVALS_PER_LINE
+    )
+    parser.add_argument("--polls", type=int, default=DEFAULT_POLLS)
+    parser.add_argument("--parse-lines", type=int, default=DEFAULT_PARSE_LINES)
+    parser.add_argument("--parse-arrivals", type=int, default=DEFAULT_PARSE_ARRIVALS)
+    parser.add_argument("--parse-rounds", type=int, default=DEFAULT_PARSE_ROUNDS)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds added to every response"
+    )
+    parser.add_argument("--output", help="file to write the JSON results to")
+    args = parser.parse_args(argv)
+
+    report = run(args)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
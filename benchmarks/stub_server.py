@@ -0,0 +1,148 @@
+"""A local stub of the MobilityLabs endpoints used by the EMT Madrid client."""
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import re
+import threading
+import time
+
+from . import payloads
+
+LOGIN_PATH = re.compile(r"^/v1/mobilitylabs/user/login/$")
+STOP_INFO_PATH = re.compile(r"^/v1/transport/busemtmad/stops/(\d+)/detail/$")
+ARROUND_STOP_PATH = re.compile(
+    r"^/v2/transport/busemtmad/stops/arroundstop/(\d+)/\d+/$"
+)
+ARRIVALS_PATH = re.compile(r"^/v2/transport/busemtmad/stops/(\d+)/arrives/$")
+
+STOP_NOT_FOUND = {"code": "81", "description": "Stop not found", "data": []}
+
+
+class StubServer:
+    """A threaded HTTP server answering like the MobilityLabs API.
+
+    Responses are generated once per bus stop and served from memory, so the time
+    measured is spent in the client. The arroundstop_only bus stops answer the
+    detail request with code 81, like the ones the API only knows from arroundstop.
+    """
+
+    def __init__(
+        self,
+        lines=payloads.DEFAULT_LINES,
+        arrivals_per_line=payloads.DEFAULT_ARRIVALS_PER_LINE,
+        latency=0.0,
+        arroundstop_only=(),
+    ) -> None:
+        """Initialize an instance of the StubServer class."""
+        self.lines = lines
+        self.arrivals_per_line = arrivals_per_line
+        self.latency = latency
+        self.arroundstop_only = {int(stop_id) for stop_id in arroundstop_only}
+        self.requests = Counter()
+        self._bodies = {}
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        """Return the URL to use instead of the MobilityLabs base URL."""
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self):
+        """Start serving on a free local port in a background thread."""
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # The headers and the body are written separately: with Nagle's
+            # algorithm the body waits for the delayed ACK of the client, adding
+            # about 40 ms to every request of a keep-alive connection.
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                stub._handle(self)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                self.rfile.read(length)
+                stub._handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop the server and wait for its thread."""
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        """Start the server when entering a with block."""
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        """Stop the server when leaving a with block."""
+        self.stop()
+
+    def _body(self, key, build):
+        """Return the encoded response for the key, building it the first time."""
+        with self._lock:
+            body = self._bodies.get(key)
+            if body is None:
+                body = self._bodies[key] = json.dumps(build()).encode()
+            return body
+
+    def _route(self, path):
+        """Return the endpoint name and encoded response of a request path."""
+        if LOGIN_PATH.match(path):
+            return "login", self._body("login", payloads.login_response)
+        if match := STOP_INFO_PATH.match(path):
+            stop_id = int(match.group(1))
+            if stop_id in self.arroundstop_only:
+                return "detail", self._body("not_found", lambda: STOP_NOT_FOUND)
+            return "detail", self._body(
+                ("detail", stop_id),
+                lambda: payloads.stop_info_response(stop_id, self.lines),
+            )
+        if match := ARROUND_STOP_PATH.match(path):
+            stop_id = int(match.group(1))
+            return "arroundstop", self._body(
+                ("arroundstop", stop_id),
+                lambda: payloads.arround_stop_response(stop_id, self.lines),
+            )
+        if match := ARRIVALS_PATH.match(path):
+            stop_id = int(match.group(1))
+            return "arrives", self._body(
+                ("arrives", stop_id),
+                lambda: payloads.arrivals_response(
+                    stop_id, self.lines, self.arrivals_per_line, seed=stop_id
+                ),
+            )
+        return None, None
+
+    def _handle(self, handler):
+        """Answer a request of the client."""
+        endpoint, body = self._route(handler.path)
+        with self._lock:
+            self.requests[endpoint or "unknown"] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if body is None:
+            handler.send_response(404)
+            handler.send_header("Content-Length", "0")
+            handler.end_headers()
+            return
+        handler.send_response(200)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
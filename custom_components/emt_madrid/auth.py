@@ -0,0 +1,138 @@
+"""Access token management for the EMT Madrid API."""
+
+import asyncio
+from dataclasses import dataclass, field
+import hashlib
+import threading
+import time
+
+from .persistence import load_json, save_json
+
+DEFAULT_TOKEN_LIFETIME = 86399
+TOKEN_REFRESH_MARGIN = 600
+
+_token_managers = {}
+_token_managers_lock = threading.Lock()
+
+
+def account_key(user, password) -> str:
+    """Return the key identifying an account without exposing its credentials."""
+    return hashlib.sha256(f"{user}:{password}".encode()).hexdigest()
+
+
+@dataclass(frozen=True, slots=True)
+class Credentials:
+    """The credentials of an EMT MobilityLabs account.
+
+    Either the email and password of a user, or the X-ClientId and passKey of an app
+    registered in MobilityLabs, which has a higher daily limit.
+    """
+
+    email: str | None = None
+    password: str | None = field(default=None, repr=False)
+    client_id: str | None = None
+    pass_key: str | None = field(default=None, repr=False)
+
+    @property
+    def is_app(self) -> bool:
+        """Check whether these are the credentials of an app."""
+        return self.client_id is not None
+
+    @property
+    def key(self) -> str:
+        """Return the key identifying the account."""
+        if self.is_app:
+            return account_key(f"app:{self.client_id}", self.pass_key)
+        return account_key(self.email, self.password)
+
+    def login_headers(self):
+        """Return the headers of the login request."""
+        if self.is_app:
+            return {"X-ClientId": self.client_id, "passKey": self.pass_key}
+        return {"email": self.email, "password": self.password}
+
+
+class TokenManager:
+    """A cache of access tokens shared by every API client of the same account.
+
+    Tokens are stored with their expiration time and can be persisted, to a file or
+    through the on_change callback, so a restart does not need a new login. A token
+    is considered expired a few minutes before the API does, so it gets refreshed
+    before requests fail.
+    """
+
+    def __init__(
+        self, path=None, refresh_margin=TOKEN_REFRESH_MARGIN, on_change=None
+    ) -> None:
+        """Initialize an instance of the TokenManager class.
+
+        The on_change callback is called whenever a token is stored, so the tokens
+        can be persisted somewhere else than a file.
+        """
+        self._path = path
+        self._refresh_margin = refresh_margin
+        self._on_change = on_change
+        self._tokens = {}
+        self._lock = threading.Lock()
+        self._account_locks = {}
+        self._async_account_locks = {}
+
+    def get(self, key):
+        """Retrieve the access token of an account if it is not about to expire."""
+        with self._lock:
+            token_info = self._tokens.get(key)
+        if token_info is None:
+            return None
+        if token_info["expires_at"] - self._refresh_margin <= time.time():
+            return None
+        return token_info["token"]
+
+    def store(self, key, token, lifetime=DEFAULT_TOKEN_LIFETIME):
+        """Store the access token of an account and its expiration time."""
+        with self._lock:
+            self._tokens[key] = {"token": token, "expires_at": time.time() + lifetime}
+        if self._on_change is not None:
+            self._on_change()
+
+    def account_lock(self, key) -> threading.Lock:
+        """Retrieve the lock serializing the logins of an account."""
+        with self._lock:
+            return self._account_locks.setdefault(key, threading.Lock())
+
+    def async_account_lock(self, key) -> asyncio.Lock:
+        """Retrieve the asyncio lock serializing the logins of an account."""
+        with self._lock:
+            return self._async_account_locks.setdefault(key, asyncio.Lock())
+
+    def as_dict(self):
+        """Return the access tokens and their expiration times."""
+        with self._lock:
+            return dict(self._tokens)
+
+    def restore(self, tokens):
+        """Restore persisted access tokens, keeping the ones already known."""
+        with self._lock:
+            for key, token_info in tokens.items():
+                self._tokens.setdefault(key, token_info)
+
+    def load(self):
+        """Load the persisted access tokens from disk."""
+        tokens = load_json(self._path, "the access tokens")
+        if tokens is not None:
+            self.restore(tokens)
+
+    def save(self):
+        """Persist the access tokens to disk, only readable by their owner."""
+        if self._path is not None:
+            save_json(self._path, self.as_dict(), "the access tokens", private=True)
+
+
+def get_token_manager(path=None) -> TokenManager:
+    """Retrieve the token manager shared by every client using the same storage path."""
+    with _token_managers_lock:
+        token_manager = _token_managers.get(path)
+        if token_manager is None:
+            token_manager = TokenManager(path)
+            token_manager.load()
+            _token_managers[path] = token_manager
+        return token_manager
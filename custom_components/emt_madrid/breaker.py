@@ -0,0 +1,134 @@
+"""Circuit breakers protecting the EMT Madrid API from failing requests."""
+
+import random
+import threading
+import time
+
+DEFAULT_FAILURE_THRESHOLD = 3
+DEFAULT_BASE_DELAY = 30
+DEFAULT_MAX_DELAY = 30 * 60
+DEFAULT_JITTER = 0.2
+PROBE_TIMEOUT = 60
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+_circuit_breakers = None
+_circuit_breakers_lock = threading.Lock()
+
+
+class CircuitBreaker:
+    """A circuit breaker with exponential backoff and jitter.
+
+    After failure_threshold consecutive failures the circuit opens and no request is
+    sent for a delay that doubles every time it opens again, up to max_delay, and
+    varies randomly by the jitter fraction so many clients do not retry at once.
+    Once the delay is over a single probe request is allowed: its success closes the
+    circuit, and its failure opens it again with a longer delay. A probe without an
+    outcome after PROBE_TIMEOUT seconds, like a cancelled one, is replaced by another.
+    """
+
+    def __init__(
+        self,
+        failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+        base_delay=DEFAULT_BASE_DELAY,
+        max_delay=DEFAULT_MAX_DELAY,
+        jitter=DEFAULT_JITTER,
+    ) -> None:
+        """Initialize an instance of the CircuitBreaker class."""
+        self._failure_threshold = failure_threshold
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._jitter = jitter
+        self._state = STATE_CLOSED
+        self._failures = 0
+        self._openings = 0
+        self._opened_until = 0.0
+        self._probe_started = 0.0
+        self._random = random.Random()
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        """Return the state of the circuit."""
+        with self._lock:
+            return self._state
+
+    def retry_after(self) -> float:
+        """Return the seconds until a probe request is allowed, 0 if it already is."""
+        with self._lock:
+            if self._state != STATE_OPEN:
+                return 0.0
+            return max(self._opened_until - time.monotonic(), 0.0)
+
+    def _probe_due(self, now):
+        """Check whether a probe request can be sent."""
+        if self._state == STATE_OPEN:
+            return self._opened_until <= now
+        return self._probe_started + PROBE_TIMEOUT <= now
+
+    def ready(self) -> bool:
+        """Check whether a request would be allowed, without claiming the probe."""
+        with self._lock:
+            return self._state == STATE_CLOSED or self._probe_due(time.monotonic())
+
+    def allow_request(self) -> bool:
+        """Check whether a request can be sent, claiming the probe if it is due."""
+        with self._lock:
+            if self._state == STATE_CLOSED:
+                return True
+            now = time.monotonic()
+            if not self._probe_due(now):
+                return False
+            self._state = STATE_HALF_OPEN
+            self._probe_started = now
+            return True
+
+    def record_success(self):
+        """Close the circuit after a successful request."""
+        with self._lock:
+            self._state = STATE_CLOSED
+            self._failures = 0
+            self._openings = 0
+
+    def record_failure(self):
+        """Count a failed request, opening the circuit if needed."""
+        with self._lock:
+            self._failures += 1
+            if (
+                self._state == STATE_HALF_OPEN
+                or self._failures >= self._failure_threshold
+            ):
+                delay = min(self._base_delay * 2**self._openings, self._max_delay)
+                delay *= 1 + self._random.uniform(-self._jitter, self._jitter)
+                self._state = STATE_OPEN
+                self._opened_until = time.monotonic() + delay
+                self._openings += 1
+
+
+class CircuitBreakerRegistry:
+    """The circuit breakers of every account, shared by the clients using them."""
+
+    def __init__(self) -> None:
+        """Initialize an instance of the CircuitBreakerRegistry class."""
+        self._circuit_breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, key) -> CircuitBreaker:
+        """Retrieve the circuit breaker of an account."""
+        with self._lock:
+            circuit_breaker = self._circuit_breakers.get(key)
+            if circuit_breaker is None:
+                circuit_breaker = CircuitBreaker()
+                self._circuit_breakers[key] = circuit_breaker
+            return circuit_breaker
+
+
+def get_circuit_breakers() -> CircuitBreakerRegistry:
+    """Retrieve the circuit breakers shared by the clients without their own."""
+    global _circuit_breakers
+    with _circuit_breakers_lock:
+        if _circuit_breakers is None:
+            _circuit_breakers = CircuitBreakerRegistry()
+        return _circuit_breakers
@@ -0,0 +1,137 @@
+"""Bus stop information cache for the EMT Madrid integration."""
+
+import copy
+from datetime import datetime
+import threading
+import time
+from zoneinfo import ZoneInfo
+
+from .persistence import load_json, save_json
+
+DEFAULT_STOP_INFO_TTL = 7 * 24 * 3600
+DAY_TYPE_TIMEZONE = ZoneInfo("Europe/Madrid")
+
+_stop_info_caches = {}
+_stop_info_caches_lock = threading.Lock()
+
+
+def current_day_type(now: datetime | None = None) -> str:
+    """Return the EMT day type (working day, saturday or holiday) of a date."""
+    now = now or datetime.now(DAY_TYPE_TIMEZONE)
+    weekday = now.weekday()
+    if weekday == 5:
+        return "SA"
+    if weekday == 6:
+        return "FE"
+    return "LA"
+
+
+class StopEntries:
+    """Entries of bus stops valid until their TTL expires, optionally persisted.
+
+    The on_change callback is called whenever entries are stored, so they can be
+    persisted somewhere else than a file.
+    """
+
+    description = "the bus stop entries"
+
+    def __init__(self, path=None, ttl=DEFAULT_STOP_INFO_TTL, on_change=None) -> None:
+        """Initialize an instance of the StopEntries class."""
+        self._path = path
+        self._ttl = ttl
+        self._on_change = on_change
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _get_entry(self, stop_id):
+        """Retrieve the entry of a bus stop if its TTL did not expire."""
+        with self._lock:
+            entry = self._entries.get(str(stop_id))
+        if entry is None or entry["updated_at"] + self._ttl <= time.time():
+            return None
+        return entry
+
+    def _changed(self):
+        """Call the on_change callback, if any."""
+        if self._on_change is not None:
+            self._on_change()
+
+    def _restore_entry(self, stop_id, entry):
+        """Add a persisted entry, with the lock held."""
+        self._entries[stop_id] = entry
+
+    def as_dict(self):
+        """Return the entries, keyed by bus stop ID."""
+        with self._lock:
+            return dict(self._entries)
+
+    def restore(self, entries):
+        """Restore persisted entries, keeping the ones already known."""
+        with self._lock:
+            for stop_id, entry in entries.items():
+                if stop_id not in self._entries:
+                    self._restore_entry(stop_id, entry)
+
+    def load(self) -> bool:
+        """Load the persisted entries from disk, return whether they were read."""
+        entries = load_json(self._path, self.description)
+        if entries is None:
+            return False
+        self.restore(entries)
+        return True
+
+    def save(self) -> bool:
+        """Persist the entries to disk, return whether they were written."""
+        if self._path is None:
+            return False
+        return save_json(self._path, self.as_dict(), self.description)
+
+
+class StopInfoCache(StopEntries):
+    """A cache of the parsed bus stop information, optionally persisted.
+
+    Stop names, addresses, coordinates and lines rarely change, so they are reused
+    until the TTL expires or the line frequencies belong to another day type. The
+    endpoint that returned the information is remembered even after it expires, so
+    bus stops only served by the stops arround stop endpoint go there directly.
+    """
+
+    description = "the bus stop cache"
+
+    def get(self, stop_id):
+        """Retrieve a copy of the cached information of a bus stop if still valid."""
+        entry = self._get_entry(stop_id)
+        if entry is None or entry["day_type"] not in (None, current_day_type()):
+            return None
+        return copy.deepcopy(entry["stop_info"])
+
+    def get_endpoint(self, stop_id):
+        """Retrieve the endpoint that last returned the information of a bus stop."""
+        with self._lock:
+            entry = self._entries.get(str(stop_id))
+        return entry["endpoint"] if entry else None
+
+    def store(self, stop_id, stop_info, endpoint):
+        """Store a copy of the information of a bus stop and the endpoint used."""
+        stop_info = copy.deepcopy(stop_info)
+        day_types = {line.get("day_type") for line in stop_info["lines"].values()}
+        day_types.discard(None)
+        with self._lock:
+            self._entries[str(stop_id)] = {
+                "stop_info": stop_info,
+                "endpoint": endpoint,
+                "day_type": day_types.pop() if len(day_types) == 1 else None,
+                "updated_at": time.time(),
+            }
+        self._changed()
+
+
+def get_stop_info_cache(path=None) -> StopInfoCache:
+    """Retrieve the bus stop cache shared by every client using the same path."""
+    with _stop_info_caches_lock:
+        stop_info_cache = _stop_info_caches.get(path)
+        if stop_info_cache is None:
+            stop_info_cache = StopInfoCache(path)
+            stop_info_cache.load()
+            _stop_info_caches[path] = stop_info_cache
+        return stop_info_cache
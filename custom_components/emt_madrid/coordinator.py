@@ -0,0 +1,115 @@
+"""Update coordinator for the EMT Madrid integration."""
+
+import asyncio
+from datetime import timedelta
+import logging
+
+import aiohttp
+
+from homeassistant.core import CALLBACK_TYPE, HomeAssistant, callback
+from homeassistant.helpers.event import async_track_time_interval
+from homeassistant.helpers.update_coordinator import DataUpdateCoordinator, UpdateFailed
+
+from .emt_madrid import AsyncAPIEMT
+from .model import Stop
+
+_LOGGER = logging.getLogger(__name__)
+
+SCAN_INTERVAL = timedelta(minutes=1)
+COUNTDOWN_INTERVAL = timedelta(seconds=15)
+
+
+class EMTStopCoordinator(DataUpdateCoordinator[Stop]):
+    """Fetch the arrival times of a bus stop once per interval for all its lines.
+
+    The coordinator owns the AsyncAPIEMT instance of the stop, so every bus line sensor
+    of that stop shares the same request instead of sending its own. The interval
+    between updates grows when needed to make the account's daily quota last.
+
+    Between updates, the sensors are notified on a short timer so they can count
+    down the arrival times locally, without any request.
+
+    When an update fails, the last known arrival times are kept, marked as stale.
+    If the API keeps failing, the circuit breakers of the client stop the requests
+    for a growing delay, and the next update is scheduled when a probe request is
+    allowed.
+    """
+
+    def __init__(
+        self,
+        hass: HomeAssistant,
+        api_emt: AsyncAPIEMT,
+        stop_id,
+        scan_interval: timedelta = SCAN_INTERVAL,
+    ) -> None:
+        """Initialize the coordinator."""
+        super().__init__(
+            hass,
+            _LOGGER,
+            name=f"EMT Madrid stop {stop_id}",
+            update_interval=scan_interval,
+        )
+        self._api_emt = api_emt
+        self._stop_id = stop_id
+        self._scan_interval = scan_interval
+        self._unsub_countdown: CALLBACK_TYPE | None = None
+        self._quota = api_emt.get_quota()
+        self._quota.register_stop(stop_id)
+        api_emt.add_revalidation_listener(self._handle_revalidation)
+
+    @property
+    def api_emt(self) -> AsyncAPIEMT:
+        """Return the AsyncAPIEMT instance used by the coordinator."""
+        return self._api_emt
+
+    @property
+    def stop_id(self):
+        """Return the bus stop ID handled by the coordinator."""
+        return self._stop_id
+
+    @callback
+    def async_add_listener(self, update_callback, context=None) -> CALLBACK_TYPE:
+        """Listen for updates, starting the countdown timer with the first listener."""
+        remove_listener = super().async_add_listener(update_callback, context)
+        if self._unsub_countdown is None:
+            self._unsub_countdown = async_track_time_interval(
+                self.hass, self._async_countdown, COUNTDOWN_INTERVAL
+            )
+
+        @callback
+        def remove_countdown_listener() -> None:
+            remove_listener()
+            if not self._listeners and self._unsub_countdown is not None:
+                self._unsub_countdown()
+                self._unsub_countdown = None
+
+        return remove_countdown_listener
+
+    @callback
+    def _async_countdown(self, now) -> None:
+        """Let the sensors recompute the arrival times without a request."""
+        self.async_update_listeners()
+
+    def _handle_revalidation(self) -> None:
+        """Notify the sensors of arrival times refreshed in the background."""
+        self.async_set_updated_data(self._api_emt.get_stop_info())
+
+    async def _async_update_data(self) -> Stop:
+        """Fetch the arrival times for every line of the bus stop."""
+        try:
+            await self._api_emt.update_arrival_times(self._stop_id)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            if self.data is None:
+                raise UpdateFailed(
+                    f"Error updating bus stop {self._stop_id}: {e}"
+                ) from e
+            _LOGGER.warning(
+                f"Error updating bus stop {self._stop_id}, keeping the last arrival "
+                f"times: {e}"
+            )
+        finally:
+            self.update_interval = max(
+                self._quota.poll_interval(self._scan_interval),
+                timedelta(seconds=self._api_emt.retry_after()),
+            )
+        return self._api_emt.get_stop_info()
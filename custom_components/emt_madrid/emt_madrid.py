@@ -1,10 +1,38 @@
 """Support for EMT Madrid API."""
 
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
 import json
 import logging
-import math
+import threading
+import time
+from typing import TYPE_CHECKING
 
+import aiohttp
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from .auth import DEFAULT_TOKEN_LIFETIME, Credentials, TokenManager, get_token_manager
+from .breaker import CircuitBreaker, CircuitBreakerRegistry, get_circuit_breakers
+from .cache import StopInfoCache, get_stop_info_cache
+from .history import ArrivalHistory
+from .index import StopIndex, get_stop_index
+from .metrics import RequestMetrics
+from .model import Arrival, Line, Stop
+from .quota import QuotaManager, QuotaPool, QuotaTracker, get_quota_manager
+from .singleflight import AsyncSingleFlight, SingleFlight
+from .tracker import Vehicle, VehicleTracker
+from .transport import Transport
+
+if TYPE_CHECKING:
+    from .stats import LineStatistics
 
 BASE_URL = "https://openapi.emtmadrid.es/"
 ENDPOINT_LOGIN = "v1/mobilitylabs/user/login/"
@@ -12,9 +40,87 @@ ENDPOINT_ARRIVAL_TIME = "v2/transport/busemtmad/stops/"
 ENDPOINT_STOP_INFO = "v1/transport/busemtmad/stops/"
 ENDPOINT_STOPS_ARROUND_STOP = "v2/transport/busemtmad/stops/arroundstop/"
 
+REQUEST_TIMEOUT = 10
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.5
+DEFAULT_POOL_CONNECTIONS = 4
+DEFAULT_POOL_MAXSIZE = 16
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_DISCOVERY_RADIUS = 500
+# Requests more left in another account of the pool before moving to it.
+ACCOUNT_SWITCH_MARGIN = 100
+# Login codes of an unknown user or a wrong password, which are not retried.
+INVALID_CREDENTIALS_CODES = ("89", "92")
+ARRIVALS_MIN_FRESHNESS = 15
+ARRIVALS_STALE_TTL = 30
 
 _LOGGER = logging.getLogger(__name__)
 
+_shared_session = None
+_shared_session_lock = threading.Lock()
+
+
+def create_session(
+    retries=DEFAULT_RETRIES,
+    backoff_factor=DEFAULT_BACKOFF_FACTOR,
+    pool_connections=DEFAULT_POOL_CONNECTIONS,
+    pool_maxsize=DEFAULT_POOL_MAXSIZE,
+) -> requests.Session:
+    """Create a keep-alive HTTP session with a connection pool and retry policy.
+
+    Connection errors and transient 5xx responses are retried with an exponential
+    backoff. The EMT POST requests only read data, so they are safe to retry too.
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUS_CODES,
+        allowed_methods=frozenset(["GET", "POST"]),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_shared_session() -> requests.Session:
+    """Return the HTTP session shared by all the APIEMT instances."""
+    global _shared_session
+    with _shared_session_lock:
+        if _shared_session is None:
+            _shared_session = create_session()
+        return _shared_session
+
+
+def json_loads(content):
+    """Decode a JSON response body, with orjson when it is installed.
+
+    An empty or invalid body raises a ValueError, whichever decoder is used.
+    """
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def endpoint_name(url) -> str:
+    """Return the short name of the endpoint of a request URL, used in the metrics."""
+    if ENDPOINT_LOGIN in url:
+        return "login"
+    if ENDPOINT_STOPS_ARROUND_STOP in url:
+        return "arroundstop"
+    if url.endswith("/arrives/"):
+        return "arrives"
+    if url.endswith("/detail/"):
+        return "detail"
+    return "other"
+
 
 class APIEMT:
     """A class representing an API client for EMT (Empresa Municipal de Transportes) services.
@@ -23,62 +129,435 @@ class APIEMT:
     update arrival times, and access the retrieved data.
     """
 
-    def __init__(self, user, password, stop_id) -> None:
-        """Initialize an instance of the APIEMT class."""
-        self._user = user
-        self._password = password
+    def __init__(
+        self,
+        user,
+        password,
+        stop_id,
+        session: requests.Session | None = None,
+        token_manager: TokenManager | None = None,
+        stop_info_cache: StopInfoCache | None = None,
+        min_freshness=ARRIVALS_MIN_FRESHNESS,
+        stale_ttl=ARRIVALS_STALE_TTL,
+        transport: Transport | None = None,
+        stop_index: StopIndex | None = None,
+        history: ArrivalHistory | None = None,
+        credentials: list[Credentials] | None = None,
+        quota_manager: QuotaManager | None = None,
+        circuit_breakers: CircuitBreakerRegistry | None = None,
+    ) -> None:
+        """Initialize an instance of the APIEMT class.
+
+        If no session, token manager, bus stop cache, index, quota manager or circuit
+        breakers are given, the ones shared by all instances are used, so clients of
+        the same account reuse a single access token and quota, and bus stops are
+        only requested once.
+
+        Arrival times updated less than min_freshness seconds ago are not requested
+        again. For stale_ttl more seconds they are still returned, while a single
+        request refreshes them in the background.
+
+        A transport can record the API responses or replay them instead of sending
+        the requests, and an arrival history records the arrival times of every poll.
+
+        A pool of credentials can be given instead of the user and password. Each
+        account has its own access token, quota and circuit breaker, and requests
+        are sent with the account with the most requests left.
+        """
+        self._pool = tuple(credentials or [Credentials(user, password)])
+        self._session = session
+        self._token_manager = token_manager or get_token_manager()
+        self._stop_info_cache = stop_info_cache or get_stop_info_cache()
+        self._stop_index = stop_index if stop_index is not None else get_stop_index()
+        self._quota_manager = quota_manager or get_quota_manager()
+        self._circuit_breakers = circuit_breakers or get_circuit_breakers()
+        self._quota_pool = (
+            self._quota_manager.get_pool([account.key for account in self._pool])
+            if len(self._pool) > 1
+            else self._quota_manager.get(self._pool[0].key)
+        )
+        self._use_account(self._pool[0])
+        self._stop_breaker = CircuitBreaker()
+        self._arrivals_stale = False
+        self._rejected_token = None
+        self._rejected_accounts = set()
+        self._flights = SingleFlight()
+        self._min_freshness = min_freshness
+        self._stale_ttl = stale_ttl
+        self._transport = transport
+        self._history = history
+        self._line_statistics = {}
+        self._tracker = VehicleTracker()
+        self._metrics = RequestMetrics()
+        self._arrivals_updated_at = {}
+        self._revalidation_lock = threading.Lock()
+        self._revalidation_listeners = []
+        self._subscribed_lines = None
+        self._stop_info = Stop(stop_id)
+
+    def _use_account(self, credentials: Credentials):
+        """Send the next requests with an account of the pool."""
+        self._credentials = credentials
+        self._account = credentials.key
+        self._quota = self._quota_manager.get(self._account)
+        self._account_breaker = self._circuit_breakers.get(self._account)
         self._token = None
-        self._stop_info = {
-            "bus_stop_id": stop_id,
-            "bus_stop_name": None,
-            "bus_stop_coordinates": None,
-            "bus_stop_address": None,
-            "lines": {},
-        }
 
-    def authenticate(self):
-        """Authenticate the user using the provided credentials."""
-        headers = {"email": self._user, "password": self._password}
+    def _route_account(self):
+        """Move to the account of the pool with the most requests left if needed.
+
+        Accounts with wrong credentials, an open circuit breaker or an almost used
+        quota are skipped.
+        The current account is kept unless it runs out or another one has clearly
+        more requests left, so the access tokens are not swapped on every request.
+        """
+        if len(self._pool) == 1:
+            return
+
+        def rank(credentials):
+            quota = self._quota_manager.get(credentials.key)
+            available = (
+                credentials.key not in self._rejected_accounts
+                and self._circuit_breakers.get(credentials.key).ready()
+            )
+            return available and quota.can_request(), quota.budget
+
+        best = max(self._pool, key=rank)
+        current = rank(self._credentials)
+        best_rank = rank(best)
+        if best_rank[0] > current[0] or (
+            best_rank[0] == current[0]
+            and best_rank[1] > current[1] + ACCOUNT_SWITCH_MARGIN
+        ):
+            _LOGGER.debug("Moving to another account of the pool with more quota left")
+            self._use_account(best)
+
+    def credentials_rejected(self) -> bool:
+        """Check whether the API rejected the credentials of every account."""
+        return all(account.key in self._rejected_accounts for account in self._pool)
+
+    def authenticate(self, force=False):
+        """Authenticate the user, reusing the shared access token while it is valid.
+
+        With force, a new login is done unless another client has already replaced
+        the current token. If the login fails the client has no token, and it logs in
+        again on the next update, unless the credentials were rejected.
+        """
+        if self._account in self._rejected_accounts:
+            return
+        with self._token_manager.account_lock(self._account):
+            token = self._token_manager.get(self._account)
+            if token is None or (force and token == self._token):
+                url, headers = self._login_request()
+                response = self._make_request(url, headers=headers, method="GET")
+                token = self._store_token(response)
+                self._token_manager.save()
+            self._token = token
+
+    def _store_token(self, response):
+        """Extract the access token from the login response and share it."""
+        token = self._extract_token(response)
+        if token is not None:
+            self._token_manager.store(
+                self._account, token, self._extract_token_lifetime(response)
+            )
+            self._quota.update_from_login(response["data"][0].get("apiCounter"))
+        return token
+
+    def subscribe_lines(self, lines):
+        """Only parse the arrival times of the given lines, or of every line if None."""
+        self._subscribed_lines = frozenset(lines) if lines else None
+
+    def get_quota(self) -> QuotaTracker | QuotaPool:
+        """Retrieve the daily quota tracker of the account, or of the pool."""
+        return self._quota_pool
+
+    def get_circuit_breakers(self) -> tuple[CircuitBreaker, CircuitBreaker]:
+        """Retrieve the circuit breakers of the account and of the bus stop."""
+        return self._account_breaker, self._stop_breaker
+
+    def retry_after(self) -> float:
+        """Return the seconds until the circuit breakers allow a new request."""
+        return max(
+            self._account_breaker.retry_after(), self._stop_breaker.retry_after()
+        )
+
+    def is_stale(self) -> bool:
+        """Check whether the arrival times could not be updated on the last attempt."""
+        return self._arrivals_stale
+
+    def _allow_request(self):
+        """Check the circuit breakers, claiming their probe requests if they are due."""
+        if not (self._account_breaker.ready() and self._stop_breaker.ready()):
+            return False
+        return (
+            self._account_breaker.allow_request()
+            and self._stop_breaker.allow_request()
+        )
+
+    def _record_outcome(self, response):
+        """Update the circuit breakers with an API response, return if it succeeded.
+
+        A failed login or an exhausted quota are failures of the account, while
+        a bus stop rejected after logging in again is a failure of the stop.
+        """
+        code = response.get("code") if response is not None else None
+        if response is None or code == "98" or self._token is None:
+            self._account_breaker.record_failure()
+            return False
+        self._account_breaker.record_success()
+        if code == "80":
+            self._stop_breaker.record_failure()
+            return False
+        self._stop_breaker.record_success()
+        return True
+
+    def _record_error(self, error):
+        """Update the circuit breakers with a failed request.
+
+        Unparseable responses are failures of the bus stop, every other error is a
+        failure of the account, like a timeout or a connection error.
+        """
+        if isinstance(error, ValueError):
+            self._stop_breaker.record_failure()
+        else:
+            self._account_breaker.record_failure()
+
+    def get_metrics(self) -> RequestMetrics:
+        """Retrieve the metrics of the requests sent by this client."""
+        return self._metrics
+
+    def get_diagnostics(self):
+        """Retrieve the request metrics together with the daily quota usage."""
+        diagnostics = self._metrics.as_dict()
+        diagnostics["latency_p95_ms"] = self._metrics.latency_quantile(0.95)
+        quota = self.get_quota()
+        diagnostics["quota_used"] = quota.used
+        diagnostics["quota_remaining"] = quota.remaining
+        diagnostics["quota_limit"] = quota.daily_limit
+        return diagnostics
+
+    def _check_quota(self, response):
+        """Stop using the account for today if the API limit was reached."""
+        if response.get("code") == "98":
+            self._quota.mark_exhausted()
+
+    def _token_needs_refresh(self):
+        """Check whether the access token is missing, expiring or was replaced."""
+        if self._account in self._rejected_accounts:
+            return False
+        token = self._token_manager.get(self._account)
+        return token is None or token != self._token
+
+    def _is_token_rejected(self, response):
+        """Check whether the API rejected an access token that was not retried yet."""
+        return response.get("code") == "80" and self._token != self._rejected_token
+
+    def _send_authenticated(self, build_request, *args, method):
+        """Send a request with the access token, logging in again once if rejected."""
+        url, headers, data = build_request(*args)
+        response = self._make_request(url, headers=headers, data=data, method=method)
+        if self._is_token_rejected(response):
+            self.authenticate(force=True)
+            if self._token is None:
+                return response
+            url, headers, data = build_request(*args)
+            response = self._make_request(
+                url, headers=headers, data=data, method=method
+            )
+            if response.get("code") == "80":
+                self._rejected_token = self._token
+        self._check_quota(response)
+        return response
+
+    def _login_request(self):
+        """Build the URL and headers of the login request."""
+        headers = self._credentials.login_headers()
         url = f"{BASE_URL}{ENDPOINT_LOGIN}"
-        response = self._make_request(url, headers=headers, method="GET")
-        self._token = self._extract_token(response)
+        return url, headers
 
     def _extract_token(self, response):
-        """Extract the access token from the API response."""
+        """Extract the access token from the API response, or None if login failed.
+
+        Wrong credentials are remembered so the account is not used again.
+        """
         try:
-            if response.get("code") != "01":
-                _LOGGER.error("Invalid email or password")
-                return "Invalid token"
+            code = response.get("code")
+            if code in INVALID_CREDENTIALS_CODES:
+                if self._credentials.is_app:
+                    _LOGGER.error("Invalid client ID or pass key")
+                else:
+                    _LOGGER.error("Invalid email or password")
+                self._rejected_accounts.add(self._account)
+                return None
+            if code != "01":
+                _LOGGER.warning(f"Unable to log in to the EMT API, API code {code}")
+                return None
             return response["data"][0]["accessToken"]
         except (KeyError, IndexError) as e:
             raise ValueError("Unable to get token from the API") from e
 
+    def _extract_token_lifetime(self, response):
+        """Extract the seconds until the access token expires from the API response."""
+        try:
+            return int(response["data"][0]["tokenSecExpiration"])
+        except (KeyError, IndexError, TypeError, ValueError):
+            return DEFAULT_TOKEN_LIFETIME
+
     def update_stop_info(self, stop_id):
+        """Update all the lines and information from the bus stop.
+
+        Concurrent calls for the same bus stop share a single request.
+        """
+        self._flights.do(
+            (ENDPOINT_STOP_INFO, stop_id), self._update_stop_info, stop_id
+        )
+        return self._stop_info
+
+    def _update_stop_info(self, stop_id):
+        """Request and parse the information from the bus stop."""
+        if self.load_cached_stop_info(stop_id):
+            return
+        self._route_account()
+        if self._token_needs_refresh():
+            self.authenticate()
+        if self._token is not None:
+            endpoint = self._stop_info_cache.get_endpoint(stop_id)
+            if endpoint != ENDPOINT_STOPS_ARROUND_STOP:
+                response = self._send_authenticated(
+                    self._stop_info_request, stop_id, method="GET"
+                )
+                if response.get("code") != "81":
+                    self._parse_stop_info(response, "full")
+                    self._cache_stop_info(stop_id, ENDPOINT_STOP_INFO)
+                    self._stop_info_cache.save()
+                    return
+            self._parse_stop_info(self.retry_update_stop_info(), "basic")
+            self._cache_stop_info(stop_id, ENDPOINT_STOPS_ARROUND_STOP)
+            self._stop_info_cache.save()
+
+    def load_cached_stop_info(self, stop_id):
+        """Load the bus stop information from the cache or the index if still valid."""
+        stop_info = self._stop_info_cache.get(stop_id)
+        if stop_info is None:
+            stop_info = self._stop_index.get(stop_id)
+        if stop_info is None:
+            return False
+        self._stop_info = Stop.from_dict(stop_info)
+        return True
+
+    def _cache_stop_info(self, stop_id, endpoint):
+        """Store the bus stop information in the cache if it was parsed."""
+        if self._stop_info.name is not None:
+            self._stop_info_cache.store(stop_id, self._stop_info.as_dict(), endpoint)
+
+    def retry_update_stop_info(self):
         """Update all the lines and information from the bus stop."""
+        if self._token is not None:
+            response = self._send_authenticated(
+                self._arround_stop_request, method="GET"
+            )
+            return response
+
+    def _stop_info_request(self, stop_id):
+        """Build the URL, headers and data of the bus stop detail request."""
         url = f"{BASE_URL}{ENDPOINT_STOP_INFO}{stop_id}/detail/"
         headers = {"accessToken": self._token}
         data = {"idStop": stop_id}
-        if self._token != "Invalid token":
-            response = self._make_request(url, headers=headers, data=data, method="GET")
-            self._parse_stop_info(response)
+        return url, headers, data
 
-    def retry_update_stop_info(self):
-        """Update all the lines and information from the bus stop."""
-        stop_id = self._stop_info["bus_stop_id"]
-        url = f"{BASE_URL}{ENDPOINT_STOPS_ARROUND_STOP}{stop_id}/0/"
+    def _arround_stop_request(self, stop_id=None, radius=0):
+        """Build the URL, headers and data of the stops arround stop request."""
+        if stop_id is None:
+            stop_id = self._stop_info.stop_id
+        url = f"{BASE_URL}{ENDPOINT_STOPS_ARROUND_STOP}{stop_id}/{radius}/"
         headers = {"accessToken": self._token}
         data = {"idStop": stop_id}
-        if self._token != "Invalid token":
-            response = self._make_request(url, headers=headers, data=data, method="GET")
-            return response
+        return url, headers, data
 
-    def get_stop_info(
-        self,
-    ):
+    def get_stop_info(self) -> Stop:
         """Retrieve all the information from the bus stop."""
         return self._stop_info
 
-    def _parse_stop_info(self, response):
+    def get_history(self) -> ArrivalHistory | None:
+        """Retrieve the arrival history of the client, if any."""
+        return self._history
+
+    def get_line_statistics(self, line) -> "LineStatistics | None":
+        """Compute the observed service of a line from the arrival history, if any.
+
+        The statistics are only computed again when new arrivals were recorded.
+        NumPy is only imported here, so the clients work without it.
+        """
+        if self._history is None:
+            return None
+        from .stats import compute_line_statistics
+
+        stop_id = self._stop_info.stop_id
+        count = self._history.count(stop_id, line)
+        cached = self._line_statistics.get(line)
+        if cached is not None and cached[0] == count:
+            return cached[1]
+        line_info = self._stop_info.lines.get(line)
+        scheduled_headway = line_info.min_freq if line_info is not None else None
+        statistics = compute_line_statistics(
+            self._history.get(stop_id, line), scheduled_headway
+        )
+        self._line_statistics[line] = (count, statistics)
+        return statistics
+
+    def get_vehicles(self, line) -> list[Vehicle]:
+        """Retrieve the buses of a line tracked across updates, the closest first."""
+        return self._tracker.vehicles(line)
+
+    def get_stop_index(self) -> StopIndex:
+        """Retrieve the index of the discovered bus stops."""
+        return self._stop_index
+
+    def discover_stops(self, stop_id, radius=DEFAULT_DISCOVERY_RADIUS):
+        """Discover the bus stops within radius meters of a stop and index them.
+
+        A single request returns the basic information of every bus stop around,
+        so they can be set up later without a detail request each.
+        """
+        self._route_account()
+        if self._token_needs_refresh():
+            self.authenticate()
+        if self._token is None:
+            return []
+        response = self._send_authenticated(
+            self._arround_stop_request, stop_id, radius, method="GET"
+        )
+        stops = self._parse_arround_stops(response)
+        self._stop_index.add(stops)
+        self._stop_index.save()
+        return stops
+
+    def _parse_arround_stops(self, response):
+        """Parse the bus stops of a stops arround stop response."""
+        response_code = response.get("code")
+        if response_code != "00":
+            _LOGGER.warning(f"Unable to discover bus stops, API code {response_code}")
+            return []
+        try:
+            return [
+                self._parse_arround_stop(stop_info, int(stop_info["stopId"]))
+                for stop_info in response["data"]
+            ]
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError("Unable to get the bus stops around") from e
+
+    def _parse_arround_stop(self, stop_info, stop_id) -> Stop:
+        """Parse a bus stop of the stops arround stop endpoint."""
+        return Stop(
+            stop_id=stop_id,
+            name=stop_info["stopName"],
+            coordinates=stop_info["geometry"]["coordinates"],
+            address=stop_info["address"],
+            lines=self._parse_lines(stop_info["lines"], "basic"),
+        )
+
+    def _parse_stop_info(self, response, mode):
         """Parse the stop info from the API response."""
         try:
             response_code = response.get("code")
@@ -88,144 +567,606 @@ class APIEMT:
                 _LOGGER.warning("Invalid token")
             elif response_code == "98":
                 _LOGGER.warning("API limit reached")
-            elif response_code == "81":
-                response = self.retry_update_stop_info()
-
-                stop_info = response["data"][0]
-                self._stop_info.update(
-                    {
-                        "bus_stop_name": stop_info["stopName"],
-                        "bus_stop_coordinates": stop_info["geometry"]["coordinates"],
-                        "bus_stop_address": stop_info["address"],
-                        "lines": self._parse_lines(stop_info["lines"], "basic"),
-                    }
+            elif mode == "basic":
+                self._stop_info = self._parse_arround_stop(
+                    response["data"][0], self._stop_info.stop_id
                 )
             else:
                 stop_info = response["data"][0]["stops"][0]
-                self._stop_info.update(
-                    {
-                        "bus_stop_name": stop_info["name"],
-                        "bus_stop_coordinates": stop_info["geometry"]["coordinates"],
-                        "bus_stop_address": stop_info["postalAddress"],
-                        "lines": self._parse_lines(stop_info["dataLine"], "full"),
-                    }
+                self._stop_info = Stop(
+                    stop_id=self._stop_info.stop_id,
+                    name=stop_info["name"],
+                    coordinates=stop_info["geometry"]["coordinates"],
+                    address=stop_info["postalAddress"],
+                    lines=self._parse_lines(stop_info["dataLine"], "full"),
                 )
         except (KeyError, IndexError) as e:
             raise ValueError("Unable to get bus stop information") from e
 
     def _parse_lines(self, lines, mode):
         """Parse the line info from the API response."""
+        line_info = {}
         if mode == "full":
-            line_info = {}
             for line in lines:
                 line_number = line["label"]
-                line_info[line_number] = {
-                    "destination": line["headerA"]
+                line_info[line_number] = Line(
+                    number=line_number,
+                    destination=line["headerA"]
                     if line["direction"] == "A"
                     else line["headerB"],
-                    "origin": line["headerA"]
+                    origin=line["headerA"]
                     if line["direction"] == "B"
                     else line["headerB"],
-                    "max_freq": int(line["maxFreq"]),
-                    "min_freq": int(line["minFreq"]),
-                    "start_time": line["startTime"],
-                    "end_time": line["stopTime"],
-                    "day_type": line["dayType"],
-                    "distance": [],
-                    "arrivals": [],
-                }
+                    max_freq=int(line["maxFreq"]),
+                    min_freq=int(line["minFreq"]),
+                    start_time=line["startTime"],
+                    end_time=line["stopTime"],
+                    day_type=line["dayType"],
+                )
         elif mode == "basic":
-            line_info = {}
             for line in lines:
                 line_number = line["label"]
-                line_info[line_number] = {
-                    "destination": line["nameA"]
-                    if line["to"] == "A"
-                    else line["nameB"],
-                    "origin": line["nameA"] if line["to"] == "B" else line["nameB"],
-                    "distance": [],
-                    "arrivals": [],
-                }
+                line_info[line_number] = Line(
+                    number=line_number,
+                    destination=line["nameA"] if line["to"] == "A" else line["nameB"],
+                    origin=line["nameA"] if line["to"] == "B" else line["nameB"],
+                )
         return line_info
 
     def update_arrival_times(self, stop):
-        """Update the arrival times for the specified bus stop and line."""
+        """Update the arrival times for the specified bus stop and line.
+
+        Concurrent calls for the same bus stop share a single request, and recent
+        arrival times are returned from the cache.
+        """
+        freshness = self._arrivals_freshness(stop)
+        if freshness == "stale" and self._revalidation_lock.acquire(blocking=False):
+            threading.Thread(
+                target=self._revalidate_arrival_times, args=(stop,), daemon=True
+            ).start()
+        elif freshness == "expired":
+            self._flights.do(
+                (ENDPOINT_ARRIVAL_TIME, stop), self._update_arrival_times, stop
+            )
+        return self._stop_info
+
+    def _revalidate_arrival_times(self, stop):
+        """Refresh stale arrival times in the background."""
+        try:
+            self._flights.do(
+                (ENDPOINT_ARRIVAL_TIME, stop), self._update_arrival_times, stop
+            )
+        except (requests.RequestException, ValueError) as e:
+            _LOGGER.warning(f"Unable to refresh the arrival times of stop {stop}: {e}")
+        else:
+            self._notify_revalidation()
+        finally:
+            self._revalidation_lock.release()
+
+    def _arrivals_freshness(self, stop):
+        """Return whether the cached arrival times are fresh, stale or expired."""
+        updated_at = self._arrivals_updated_at.get(stop)
+        if updated_at is None:
+            return "expired"
+        age = time.monotonic() - updated_at
+        if age < self._min_freshness:
+            return "fresh"
+        if age < self._min_freshness + self._stale_ttl:
+            return "stale"
+        return "expired"
+
+    def add_revalidation_listener(self, listener):
+        """Call the listener when stale arrival times are refreshed in the background.
+
+        Return a function that removes the listener.
+        """
+        self._revalidation_listeners.append(listener)
+        return lambda: self._revalidation_listeners.remove(listener)
+
+    def _notify_revalidation(self):
+        """Call the listeners of background refreshes."""
+        for listener in list(self._revalidation_listeners):
+            listener()
+
+    def _update_arrival_times(self, stop):
+        """Request and parse the arrival times for the specified bus stop.
+
+        While the quota is almost used or a circuit breaker is open, no request is
+        sent and the last arrival times are kept, marked as stale.
+        """
+        self._route_account()
+        if not self._quota.can_request():
+            _LOGGER.debug(f"Daily API quota almost used, skipping bus stop {stop}")
+            self._arrivals_stale = True
+            return
+        if not self._allow_request():
+            _LOGGER.debug(f"Circuit open, skipping bus stop {stop}")
+            self._arrivals_stale = True
+            return
+        response = None
+        try:
+            if self._token_needs_refresh():
+                self.authenticate()
+            if self._token is not None:
+                response = self._send_authenticated(
+                    self._arrivals_request, stop, method="POST"
+                )
+                # An exhausted quota carries no arrival times, only the breakers
+                # are updated and the last arrival times are kept.
+                if response.get("code") != "98":
+                    self._parse_arrivals(response)
+                    self._arrivals_updated_at[stop] = time.monotonic()
+        except Exception as e:
+            self._record_error(e)
+            self._arrivals_stale = True
+            raise
+        self._arrivals_stale = not self._record_outcome(response)
+
+    def _arrivals_request(self, stop):
+        """Build the URL, headers and data of the arrival times request."""
         url = f"{BASE_URL}{ENDPOINT_ARRIVAL_TIME}{stop}/arrives/"
         headers = {"accessToken": self._token}
         data = {"stopId": stop, "Text_EstimationsRequired_YN": "Y"}
-        if self._token != "Invalid token":
-            response = self._make_request(
-                url, headers=headers, data=data, method="POST"
-            )
-            self._parse_arrivals(response)
+        return url, headers, data
 
-    def get_arrival_time(self, line):
-        """Retrieve arrival times in minutes for the specified bus line."""
-        try:
-            arrivals = self._stop_info["lines"][line].get("arrivals")
-        except KeyError:
+    def get_arrival_time(self, line, now=None):
+        """Retrieve the arrival times in minutes of the next two buses of a line.
+
+        If a timestamp is given, the arrival times are counted down from the last
+        update to that time, and the buses that already arrived are skipped.
+        """
+        line_info = self._stop_info.lines.get(line)
+        if line_info is None:
             return [None, None]
-        while len(arrivals) < 2:
-            arrivals.append(None)
-        return arrivals
+        if now is None:
+            arrivals = [arrival.minutes for arrival in line_info.arrivals[:2]]
+        else:
+            arrivals = [
+                arrival.minutes_at(now)
+                for arrival in line_info.arrivals
+                if arrival.remaining(now) >= 0
+            ][:2]
+        return arrivals + [None] * (2 - len(arrivals))
 
-    def get_line_info(self, line):
+    def get_line_info(self, line) -> Line:
         """Retrieve the information for a specific line."""
-        lines = self._stop_info["lines"]
-        if line in lines:
-            line_info = lines.get(line)
-            if "distance" in line_info and len(line_info["distance"]) == 0:
-                line_info["distance"].append(None)
+        line_info = self._stop_info.lines.get(line)
+        if line_info is not None:
             return line_info
 
         _LOGGER.warning(f"The bus line {line} does not exist at this stop.")
-        line_info = {
-            "destination": None,
-            "origin": None,
-            "max_freq": None,
-            "min_freq": None,
-            "start_time": None,
-            "end_time": None,
-            "day_type": None,
-            "distance": [None],
-            "arrivals": [None, None],
-        }
-        return line_info
+        return Line(line)
 
     def _parse_arrivals(self, response):
-        """Parse the arrival times and distance from the API response."""
+        """Parse the arrival times and distance from the API response.
+
+        Only the fields used by the client are read, and the arrivals of the lines
+        that are not subscribed are skipped.
+        """
         try:
             if response.get("code") == "80":
                 _LOGGER.warning("Bus Stop disabled or does not exist")
             else:
-                for line_info in self._stop_info["lines"].values():
-                    line_info["arrivals"] = []
-                    line_info["distance"] = []
-                arrivals = response["data"][0].get("Arrive", [])
-                for arrival in arrivals:
+                timestamp = time.time()
+                lines = self._stop_info.lines
+                subscribed = self._subscribed_lines
+                arrivals = {
+                    line: []
+                    for line in lines
+                    if subscribed is None or line in subscribed
+                }
+                vehicles = {line: [] for line in arrivals}
+                for arrival in response["data"][0].get("Arrive", []):
                     line = arrival.get("line")
-                    line_info = self._stop_info["lines"].get(line)
-                    arrival_time = min(
-                        math.trunc(arrival.get("estimateArrive") / 60), 45
+                    if line not in arrivals:
+                        continue
+                    eta = int(arrival.get("estimateArrive"))
+                    bus = arrival.get("bus")
+                    if bus is None:
+                        arrivals[line].append(
+                            Arrival(eta, arrival.get("DistanceBus"), bus, timestamp)
+                        )
+                    else:
+                        vehicles[line].append(
+                            Vehicle(
+                                bus=bus,
+                                line=line,
+                                eta=eta,
+                                distance=arrival.get("DistanceBus"),
+                                coordinates=arrival.get("geometry", {}).get(
+                                    "coordinates"
+                                ),
+                                deviation=arrival.get("deviation"),
+                                timestamp=timestamp,
+                            )
+                        )
+                self._tracker.update(vehicles)
+                for line, line_vehicles in vehicles.items():
+                    arrivals[line].extend(
+                        Arrival(
+                            eta=vehicle.eta,
+                            distance=vehicle.distance,
+                            bus=vehicle.bus,
+                            timestamp=timestamp,
+                            pace=vehicle.pace,
+                        )
+                        for vehicle in line_vehicles
                     )
-                    if line_info:
-                        line_info["arrivals"].append(arrival_time)
-                        line_info["distance"].append(arrival.get("DistanceBus"))
+                    arrivals[line].sort(key=lambda arrival: arrival.eta)
+                for line, line_arrivals in arrivals.items():
+                    lines[line].arrivals = line_arrivals
+                if self._history is not None:
+                    self._history.record(self._stop_info.stop_id, arrivals)
         except (KeyError, IndexError) as e:
             raise ValueError("Unable to get the arrival times from the API") from e
         except TypeError as e:
             _LOGGER.error(f"ERROR {e} --> RESPONSE: {response}")
 
     def _make_request(self, url: str, headers=None, data=None, method="POST"):
-        """Send an HTTP request to the specified URL."""
+        """Send an HTTP request to the specified URL, through the transport if any."""
+        if method not in ["POST", "GET"]:
+            raise ValueError(f"Invalid HTTP method: {method}")
+        endpoint = endpoint_name(url)
+        start = time.monotonic()
+        try:
+            if self._transport is not None:
+                response = self._transport.request(
+                    self._send, method, url, headers, data
+                )
+            else:
+                response = self._send(method, url, headers, data)
+        except Exception:
+            self._metrics.record_failure(endpoint, time.monotonic() - start)
+            raise
+        self._metrics.record_response(endpoint, time.monotonic() - start, response)
+        return response
+
+    def _send(self, method, url, headers, data):
+        """Send an HTTP request with the session and decode the response."""
         try:
-            if method not in ["POST", "GET"]:
-                raise ValueError(f"Invalid HTTP method: {method}")
-            kwargs = {"url": url, "headers": headers, "timeout": 10}
+            kwargs = {"url": url, "headers": headers, "timeout": REQUEST_TIMEOUT}
             if method == "POST":
                 kwargs["data"] = json.dumps(data)
-            response = requests.request(method, **kwargs)
+            session = self._session or get_shared_session()
+            self._quota.record_request()
+            response = session.request(method, **kwargs)
             response.raise_for_status()
-            return response.json()
+            self._metrics.record_bytes(endpoint_name(url), len(response.content))
+            return json_loads(response.content)
         except requests.HTTPError as e:
             raise requests.HTTPError(f"Error while connecting to EMT API: {e}") from e
+
+
+@dataclass
+class BatchResult:
+    """The bus stop information and errors of a batch update, keyed by bus stop ID."""
+
+    results: dict = field(default_factory=dict)
+    errors: dict = field(default_factory=dict)
+
+
+class APIEMTBatch:
+    """A client fetching the arrival times of many bus stops concurrently.
+
+    Every bus stop has its own APIEMT instance, but all of them share the HTTP session
+    and the access token. At most max_workers requests are sent at the same time,
+    and a slow or failing bus stop does not delay the results of the others. Any
+    error of a bus stop is reported in the errors of the result.
+    """
+
+    def __init__(
+        self,
+        user,
+        password,
+        stop_ids,
+        max_workers=DEFAULT_MAX_WORKERS,
+        session: requests.Session | None = None,
+        token_manager: TokenManager | None = None,
+        transport: Transport | None = None,
+        history: ArrivalHistory | None = None,
+        credentials: list[Credentials] | None = None,
+        quota_manager: QuotaManager | None = None,
+        circuit_breakers: CircuitBreakerRegistry | None = None,
+    ) -> None:
+        """Initialize an instance of the APIEMTBatch class."""
+        self._max_workers = max_workers
+        self._clients = {
+            stop_id: APIEMT(
+                user,
+                password,
+                stop_id,
+                session,
+                token_manager,
+                transport=transport,
+                history=history,
+                credentials=credentials,
+                quota_manager=quota_manager,
+                circuit_breakers=circuit_breakers,
+            )
+            for stop_id in stop_ids
+        }
+        self._initialized = set()
+
+    def get_client(self, stop_id) -> APIEMT:
+        """Retrieve the APIEMT instance of a bus stop."""
+        return self._clients[stop_id]
+
+    def update_arrival_times(self, stop_ids=None) -> BatchResult:
+        """Update the arrival times of the given bus stops, or of all of them."""
+        stop_ids = self._clients.keys() if stop_ids is None else stop_ids
+        result = BatchResult()
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            futures = {
+                executor.submit(self._update_stop, stop_id): stop_id
+                for stop_id in stop_ids
+            }
+            for future in as_completed(futures):
+                stop_id = futures[future]
+                try:
+                    result.results[stop_id] = future.result()
+                except (requests.RequestException, ValueError) as e:
+                    _LOGGER.warning(f"Unable to update bus stop {stop_id}: {e}")
+                    result.errors[stop_id] = e
+                except Exception as e:
+                    _LOGGER.exception(f"Unexpected error updating bus stop {stop_id}")
+                    result.errors[stop_id] = e
+        return result
+
+    def _update_stop(self, stop_id):
+        """Update the information, if missing, and arrival times of a bus stop.
+
+        Until the information is loaded, like after a failed login or an exhausted
+        quota, no arrival times are requested and it is requested again on the next
+        batch.
+        """
+        api_emt = self._clients[stop_id]
+        if stop_id not in self._initialized:
+            api_emt.update_stop_info(stop_id)
+            if api_emt.get_stop_info().name is None:
+                return api_emt.get_stop_info()
+            self._initialized.add(stop_id)
+        api_emt.update_arrival_times(stop_id)
+        return api_emt.get_stop_info()
+
+
+class AsyncAPIEMT(APIEMT):
+    """An asyncio API client for EMT (Empresa Municipal de Transportes) services.
+
+    It offers the same methods and parsing behavior as APIEMT, but every request is
+    sent through a shared aiohttp session instead of blocking the calling thread.
+    """
+
+    def __init__(
+        self,
+        session: aiohttp.ClientSession,
+        user,
+        password,
+        stop_id,
+        token_manager: TokenManager | None = None,
+        stop_info_cache: StopInfoCache | None = None,
+        min_freshness=ARRIVALS_MIN_FRESHNESS,
+        stale_ttl=ARRIVALS_STALE_TTL,
+        transport: Transport | None = None,
+        stop_index: StopIndex | None = None,
+        history: ArrivalHistory | None = None,
+        credentials: list[Credentials] | None = None,
+        quota_manager: QuotaManager | None = None,
+        circuit_breakers: CircuitBreakerRegistry | None = None,
+    ) -> None:
+        """Initialize an instance of the AsyncAPIEMT class."""
+        super().__init__(
+            user,
+            password,
+            stop_id,
+            token_manager=token_manager,
+            stop_info_cache=stop_info_cache,
+            min_freshness=min_freshness,
+            stale_ttl=stale_ttl,
+            transport=transport,
+            stop_index=stop_index,
+            history=history,
+            credentials=credentials,
+            quota_manager=quota_manager,
+            circuit_breakers=circuit_breakers,
+        )
+        self._session = session
+        self._flights = AsyncSingleFlight()
+        self._revalidations = set()
+
+    async def authenticate(self, force=False):
+        """Authenticate the user, reusing the shared access token while it is valid.
+
+        With force, a new login is done unless another client has already replaced
+        the current token. If the login fails the client has no token, and it logs in
+        again on the next update, unless the credentials were rejected.
+        """
+        if self._account in self._rejected_accounts:
+            return
+        async with self._token_manager.async_account_lock(self._account):
+            token = self._token_manager.get(self._account)
+            if token is None or (force and token == self._token):
+                url, headers = self._login_request()
+                response = await self._make_request(url, headers=headers, method="GET")
+                token = self._store_token(response)
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self._token_manager.save
+                )
+            self._token = token
+
+    async def _send_authenticated(self, build_request, *args, method):
+        """Send a request with the access token, logging in again once if rejected."""
+        url, headers, data = build_request(*args)
+        response = await self._make_request(
+            url, headers=headers, data=data, method=method
+        )
+        if self._is_token_rejected(response):
+            await self.authenticate(force=True)
+            if self._token is None:
+                return response
+            url, headers, data = build_request(*args)
+            response = await self._make_request(
+                url, headers=headers, data=data, method=method
+            )
+            if response.get("code") == "80":
+                self._rejected_token = self._token
+        self._check_quota(response)
+        return response
+
+    async def update_stop_info(self, stop_id):
+        """Update all the lines and information from the bus stop.
+
+        Concurrent calls for the same bus stop share a single request.
+        """
+        await self._flights.do(
+            (ENDPOINT_STOP_INFO, stop_id), self._update_stop_info, stop_id
+        )
+        return self._stop_info
+
+    async def _update_stop_info(self, stop_id):
+        """Request and parse the information from the bus stop."""
+        if self.load_cached_stop_info(stop_id):
+            return
+        self._route_account()
+        if self._token_needs_refresh():
+            await self.authenticate()
+        if self._token is not None:
+            loop = asyncio.get_running_loop()
+            endpoint = self._stop_info_cache.get_endpoint(stop_id)
+            if endpoint != ENDPOINT_STOPS_ARROUND_STOP:
+                response = await self._send_authenticated(
+                    self._stop_info_request, stop_id, method="GET"
+                )
+                if response.get("code") != "81":
+                    self._parse_stop_info(response, "full")
+                    self._cache_stop_info(stop_id, ENDPOINT_STOP_INFO)
+                    await loop.run_in_executor(None, self._stop_info_cache.save)
+                    return
+            self._parse_stop_info(await self.retry_update_stop_info(), "basic")
+            self._cache_stop_info(stop_id, ENDPOINT_STOPS_ARROUND_STOP)
+            await loop.run_in_executor(None, self._stop_info_cache.save)
+
+    async def retry_update_stop_info(self):
+        """Update all the lines and information from the bus stop."""
+        if self._token is not None:
+            response = await self._send_authenticated(
+                self._arround_stop_request, method="GET"
+            )
+            return response
+
+    async def discover_stops(self, stop_id, radius=DEFAULT_DISCOVERY_RADIUS):
+        """Discover the bus stops within radius meters of a stop and index them.
+
+        A single request returns the basic information of every bus stop around,
+        so they can be set up later without a detail request each.
+        """
+        self._route_account()
+        if self._token_needs_refresh():
+            await self.authenticate()
+        if self._token is None:
+            return []
+        response = await self._send_authenticated(
+            self._arround_stop_request, stop_id, radius, method="GET"
+        )
+        stops = self._parse_arround_stops(response)
+        self._stop_index.add(stops)
+        await asyncio.get_running_loop().run_in_executor(None, self._stop_index.save)
+        return stops
+
+    async def update_arrival_times(self, stop):
+        """Update the arrival times for the specified bus stop and line.
+
+        Concurrent calls for the same bus stop share a single request, and recent
+        arrival times are returned from the cache.
+        """
+        freshness = self._arrivals_freshness(stop)
+        if freshness == "stale" and not self._revalidations:
+            task = asyncio.create_task(self._revalidate_arrival_times(stop))
+            self._revalidations.add(task)
+            task.add_done_callback(self._revalidations.discard)
+        elif freshness == "expired":
+            await self._flights.do(
+                (ENDPOINT_ARRIVAL_TIME, stop), self._update_arrival_times, stop
+            )
+        return self._stop_info
+
+    async def _revalidate_arrival_times(self, stop):
+        """Refresh stale arrival times in the background."""
+        try:
+            await self._flights.do(
+                (ENDPOINT_ARRIVAL_TIME, stop), self._update_arrival_times, stop
+            )
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            _LOGGER.warning(f"Unable to refresh the arrival times of stop {stop}: {e}")
+        else:
+            self._notify_revalidation()
+
+    async def _update_arrival_times(self, stop):
+        """Request and parse the arrival times for the specified bus stop.
+
+        While the quota is almost used or a circuit breaker is open, no request is
+        sent and the last arrival times are kept, marked as stale.
+        """
+        self._route_account()
+        if not self._quota.can_request():
+            _LOGGER.debug(f"Daily API quota almost used, skipping bus stop {stop}")
+            self._arrivals_stale = True
+            return
+        if not self._allow_request():
+            _LOGGER.debug(f"Circuit open, skipping bus stop {stop}")
+            self._arrivals_stale = True
+            return
+        response = None
+        try:
+            if self._token_needs_refresh():
+                await self.authenticate()
+            if self._token is not None:
+                response = await self._send_authenticated(
+                    self._arrivals_request, stop, method="POST"
+                )
+                # An exhausted quota carries no arrival times, only the breakers
+                # are updated and the last arrival times are kept.
+                if response.get("code") != "98":
+                    self._parse_arrivals(response)
+                    self._arrivals_updated_at[stop] = time.monotonic()
+        except Exception as e:
+            self._record_error(e)
+            self._arrivals_stale = True
+            raise
+        self._arrivals_stale = not self._record_outcome(response)
+
+    async def _make_request(self, url: str, headers=None, data=None, method="POST"):
+        """Send an HTTP request to the specified URL, through the transport if any."""
+        if method not in ["POST", "GET"]:
+            raise ValueError(f"Invalid HTTP method: {method}")
+        endpoint = endpoint_name(url)
+        start = time.monotonic()
+        try:
+            if self._transport is not None:
+                response = await self._transport.async_request(
+                    self._send, method, url, headers, data
+                )
+            else:
+                response = await self._send(method, url, headers, data)
+        except Exception:
+            self._metrics.record_failure(endpoint, time.monotonic() - start)
+            raise
+        self._metrics.record_response(endpoint, time.monotonic() - start, response)
+        return response
+
+    async def _send(self, method, url, headers, data):
+        """Send an HTTP request with the aiohttp session and decode the response."""
+        try:
+            kwargs = {
+                "headers": headers,
+                "timeout": aiohttp.ClientTimeout(total=REQUEST_TIMEOUT),
+            }
+            if method == "POST":
+                kwargs["data"] = json.dumps(data)
+            self._quota.record_request()
+            async with self._session.request(method, url, **kwargs) as response:
+                response.raise_for_status()
+                content = await response.read()
+                self._metrics.record_bytes(endpoint_name(url), len(content))
+                return json_loads(content)
+        except aiohttp.ClientResponseError as e:
+            raise aiohttp.ClientError(f"Error while connecting to EMT API: {e}") from e
@@ -0,0 +1,276 @@
+"""History of the arrival times polled from the EMT Madrid API."""
+
+from array import array
+import logging
+import os
+import struct
+import sys
+import threading
+
+DEFAULT_HISTORY_CAPACITY = 4096
+DEFAULT_HISTORY_MAX_SIZE = 8 * 1024 * 1024
+HISTORY_MAGIC = b"EMTH\x01"
+# Bus stop ID, length of the line label and number of records of a block.
+BLOCK_HEADER = struct.Struct("<IHI")
+# Type codes of the timestamp, ETA, distance and bus columns.
+COLUMN_TYPES = ("d", "i", "i", "i")
+MISSING = -1
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def _to_little_endian(column):
+    """Return a column in the byte order of the history file."""
+    if sys.byteorder == "big":
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column
+
+
+class LineHistory:
+    """A fixed-size ring buffer of the arrivals polled for a line at a bus stop.
+
+    Each record is a poll timestamp, the ETA in seconds, the distance in meters and
+    the bus ID, kept in one typed array per column, so a record takes 20 bytes. A
+    missing distance or bus ID is stored as -1. Once full, the oldest records are
+    overwritten.
+    """
+
+    __slots__ = ("_capacity", "_columns", "_next", "_size", "_pending", "_total")
+
+    def __init__(self, capacity=DEFAULT_HISTORY_CAPACITY) -> None:
+        """Initialize an instance of the LineHistory class."""
+        self._capacity = capacity
+        self._columns = tuple(array(code, [0]) * capacity for code in COLUMN_TYPES)
+        self._next = 0
+        self._size = 0
+        self._pending = 0
+        self._total = 0
+
+    def __len__(self) -> int:
+        """Return the number of records in the buffer."""
+        return self._size
+
+    @property
+    def total(self) -> int:
+        """Return the number of records ever added, including the overwritten ones."""
+        return self._total
+
+    @property
+    def pending(self) -> int:
+        """Return the number of records not spilled to disk yet."""
+        return self._pending
+
+    def append(self, timestamp, eta, distance, bus):
+        """Add a record, overwriting the oldest one if the buffer is full."""
+        index = self._next
+        timestamps, etas, distances, buses = self._columns
+        timestamps[index] = timestamp
+        etas[index] = eta
+        distances[index] = MISSING if distance is None else distance
+        buses[index] = MISSING if bus is None else bus
+        self._next = (index + 1) % self._capacity
+        self._size = min(self._size + 1, self._capacity)
+        self._pending = min(self._pending + 1, self._capacity)
+        self._total += 1
+
+    def columns(self, last=None):
+        """Return the timestamps, ETAs, distances and bus IDs, oldest first.
+
+        Only the last records are returned if given.
+        """
+        count = self._size if last is None else min(last, self._size)
+        start = (self._next - count) % self._capacity
+        if start + count <= self._capacity:
+            return tuple(column[start : start + count] for column in self._columns)
+        end = start + count - self._capacity
+        return tuple(column[start:] + column[:end] for column in self._columns)
+
+    def records(self):
+        """Return the records as (timestamp, ETA, distance, bus ID) tuples."""
+        return list(zip(*self.columns()))
+
+    def extend(self, columns):
+        """Add the records of some columns, as returned by columns, oldest first."""
+        for record in zip(*columns):
+            self.append(*record)
+
+    def pending_columns(self):
+        """Return the columns of the records not spilled yet, oldest first."""
+        return self.columns(self._pending)
+
+    def mark_spilled(self, count):
+        """Mark the oldest count records not spilled yet as spilled."""
+        self._pending = max(self._pending - count, 0)
+
+
+class ArrivalHistory:
+    """The arrival times of every poll, per bus stop and line, optionally spilled.
+
+    Only the last capacity records of each line are kept in memory. When a path is
+    given, spill appends the records added since the previous spill to a binary file
+    made of one block per line: a header followed by the little-endian columns of
+    its records. The file can be read back with read_history, and load refills the
+    buffers with the last records spilled.
+
+    Once the file reaches max_size bytes, it is moved to the same path ending in .1,
+    replacing the previous one, so at most twice max_size bytes are kept and read.
+    """
+
+    def __init__(
+        self,
+        path=None,
+        capacity=DEFAULT_HISTORY_CAPACITY,
+        max_size=DEFAULT_HISTORY_MAX_SIZE,
+    ) -> None:
+        """Initialize an instance of the ArrivalHistory class."""
+        self._path = path
+        self._capacity = capacity
+        self._max_size = max_size
+        self._lines = {}
+        self._lock = threading.Lock()
+
+    def record(self, stop_id, arrivals):
+        """Record the arrivals of a poll, given as lists of Arrival keyed by line."""
+        with self._lock:
+            for line, line_arrivals in arrivals.items():
+                history = self._lines.get((stop_id, line))
+                if history is None and line_arrivals:
+                    history = self._lines[(stop_id, line)] = LineHistory(self._capacity)
+                for arrival in line_arrivals:
+                    history.append(
+                        arrival.timestamp, arrival.eta, arrival.distance, arrival.bus
+                    )
+
+    def get(self, stop_id, line):
+        """Retrieve the columns of the records of a line at a bus stop, oldest first."""
+        with self._lock:
+            history = self._lines.get((stop_id, line))
+            if history is None:
+                return tuple(array(code) for code in COLUMN_TYPES)
+            return history.columns()
+
+    def count(self, stop_id, line) -> int:
+        """Return the number of records ever added for a line at a bus stop."""
+        with self._lock:
+            history = self._lines.get((stop_id, line))
+            return 0 if history is None else history.total
+
+    def keys(self):
+        """Return the (bus stop ID, line) pairs with records."""
+        with self._lock:
+            return list(self._lines)
+
+    def pending(self) -> int:
+        """Return the highest number of records of a line not spilled yet."""
+        with self._lock:
+            return max((history.pending for history in self._lines.values()), default=0)
+
+    def spill(self):
+        """Append the records not spilled yet to the history file.
+
+        The records are only marked spilled once written, so they are spilled again
+        after an error.
+        """
+        if self._path is None:
+            return
+        with self._lock:
+            blocks = [
+                (stop_id, line, history.pending_columns())
+                for (stop_id, line), history in self._lines.items()
+                if history.pending
+            ]
+        if not blocks:
+            return
+        try:
+            os.makedirs(os.path.dirname(self._path) or ".", exist_ok=True)
+            if (
+                os.path.exists(self._path)
+                and os.path.getsize(self._path) >= self._max_size
+            ):
+                os.replace(self._path, self._rotated_path())
+            with open(self._path, "ab") as file:
+                start = file.tell()
+                try:
+                    if start == 0:
+                        file.write(HISTORY_MAGIC)
+                    for stop_id, line, columns in blocks:
+                        _write_block(file, stop_id, line, columns)
+                except OSError:
+                    file.truncate(start)
+                    raise
+        except OSError as e:
+            _LOGGER.warning(f"Unable to spill the arrival history to {self._path}: {e}")
+            return
+        with self._lock:
+            for stop_id, line, columns in blocks:
+                self._lines[(stop_id, line)].mark_spilled(len(columns[0]))
+
+    def _rotated_path(self):
+        """Return the path of the previous history file."""
+        return f"{self._path}.1"
+
+    def load(self):
+        """Refill the buffers with the last records of the history files."""
+        if self._path is None:
+            return
+        history = read_history(self._rotated_path())
+        for key, columns in read_history(self._path).items():
+            previous = history.get(key)
+            if previous is None:
+                history[key] = columns
+            else:
+                for column, new_column in zip(previous, columns):
+                    column.extend(new_column)
+        with self._lock:
+            for (stop_id, line), columns in history.items():
+                line_history = LineHistory(self._capacity)
+                line_history.extend(
+                    tuple(column[-self._capacity :] for column in columns)
+                )
+                line_history.mark_spilled(len(line_history))
+                self._lines[(stop_id, line)] = line_history
+
+
+def _write_block(file, stop_id, line, columns):
+    """Write the records of a line at a bus stop as a block of a history file."""
+    label = line.encode()
+    file.write(BLOCK_HEADER.pack(stop_id, len(label), len(columns[0])))
+    file.write(label)
+    for column in columns:
+        _to_little_endian(column).tofile(file)
+
+
+def read_history(path):
+    """Read a history file, returning the columns of the records by bus stop and line.
+
+    The columns are typed arrays with the timestamps, ETAs, distances and bus IDs of
+    every spilled record, oldest first. A truncated last block is skipped.
+    """
+    history = {}
+    if not os.path.exists(path):
+        return history
+    try:
+        with open(path, "rb") as file:
+            if file.read(len(HISTORY_MAGIC)) != HISTORY_MAGIC:
+                _LOGGER.warning(f"Unknown format of the arrival history file {path}")
+                return history
+            while header := file.read(BLOCK_HEADER.size):
+                stop_id, label_size, count = BLOCK_HEADER.unpack(header)
+                line = file.read(label_size).decode()
+                block = tuple(array(code) for code in COLUMN_TYPES)
+                for column in block:
+                    column.fromfile(file, count)
+                    if sys.byteorder == "big":
+                        column.byteswap()
+                columns = history.get((stop_id, line))
+                if columns is None:
+                    history[(stop_id, line)] = block
+                else:
+                    for column, new_column in zip(columns, block):
+                        column.extend(new_column)
+    except (EOFError, struct.error, UnicodeDecodeError):
+        _LOGGER.warning(f"Skipping the truncated end of the arrival history {path}")
+    except OSError as e:
+        _LOGGER.warning(f"Unable to read the arrival history from {path}: {e}")
+    return history
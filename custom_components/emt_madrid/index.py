@@ -0,0 +1,161 @@
+"""Local index of the bus stops discovered through the EMT Madrid API."""
+
+import asyncio
+import copy
+import os
+import threading
+import time
+
+from .cache import DEFAULT_STOP_INFO_TTL, StopEntries
+from .spatial import SpatialIndex
+
+_stop_indexes = {}
+_stop_indexes_lock = threading.Lock()
+
+
+class StopIndex(StopEntries):
+    """An index of bus stops and the lines serving them, optionally persisted.
+
+    It is filled with the bus stops returned in bulk by the stops arround stop
+    endpoint, so many stops can be set up without a detail request each. Only the
+    basic information is indexed: names, addresses, coordinates and line headers.
+
+    The coordinates are also indexed in a SpatialIndex, built on the first lookup
+    after a change and persisted next to the bus stops, to find the stops near a
+    location without any request.
+    """
+
+    description = "the bus stop index"
+
+    def __init__(self, path=None, ttl=DEFAULT_STOP_INFO_TTL, on_change=None) -> None:
+        """Initialize an instance of the StopIndex class."""
+        super().__init__(path, ttl, on_change)
+        self._lines = {}
+        self._discovery_lock = None
+        self._spatial_index = None
+
+    def _index_lines(self, stop_id, stop_info):
+        """Add a bus stop to the sets of stops serving each of its lines."""
+        for line in stop_info["lines"]:
+            self._lines.setdefault(line, set()).add(stop_id)
+
+    def _unindex_lines(self, stop_id):
+        """Remove a bus stop from the sets of stops serving its lines."""
+        entry = self._entries.get(stop_id)
+        if entry is None:
+            return
+        for line in entry["stop_info"]["lines"]:
+            stop_ids = self._lines.get(line)
+            if stop_ids is not None:
+                stop_ids.discard(stop_id)
+                if not stop_ids:
+                    del self._lines[line]
+
+    def add(self, stops):
+        """Index the basic information of some bus stops."""
+        updated_at = time.time()
+        with self._lock:
+            for stop in stops:
+                stop_id = str(stop.stop_id)
+                stop_info = stop.as_dict()
+                self._unindex_lines(stop_id)
+                self._entries[stop_id] = {
+                    "stop_info": stop_info,
+                    "updated_at": updated_at,
+                }
+                self._index_lines(stop_id, stop_info)
+            self._spatial_index = None
+        self._changed()
+
+    def get(self, stop_id):
+        """Retrieve a copy of the indexed information of a bus stop if still valid."""
+        entry = self._get_entry(stop_id)
+        if entry is None:
+            return None
+        return copy.deepcopy(entry["stop_info"])
+
+    def get_lines(self, stop_id):
+        """Retrieve the lines serving an indexed bus stop, or None if not indexed."""
+        with self._lock:
+            entry = self._entries.get(str(stop_id))
+            if entry is None:
+                return None
+            return set(entry["stop_info"]["lines"])
+
+    def serves(self, stop_id, line) -> bool:
+        """Check whether an indexed bus stop is served by a line."""
+        with self._lock:
+            return str(stop_id) in self._lines.get(line, ())
+
+    def stops_serving(self, line):
+        """Retrieve the IDs of the indexed bus stops served by a line."""
+        with self._lock:
+            return sorted(int(stop_id) for stop_id in self._lines.get(line, ()))
+
+    def get_spatial_index(self) -> SpatialIndex:
+        """Retrieve the spatial index of the bus stops, building it if needed."""
+        with self._lock:
+            if self._spatial_index is None:
+                self._spatial_index = SpatialIndex.from_entries(self._entries)
+            return self._spatial_index
+
+    def nearest(self, lat, lon, k=1, line=None):
+        """Find the k nearest bus stops to a location, optionally served by a line."""
+        return self.get_spatial_index().nearest(lat, lon, k, line)
+
+    def within(self, lat, lon, radius, line=None):
+        """Find the bus stops within radius meters, optionally served by a line."""
+        return self.get_spatial_index().within(lat, lon, radius, line)
+
+    def __contains__(self, stop_id) -> bool:
+        """Check whether a bus stop is indexed and still valid."""
+        return self.get(stop_id) is not None
+
+    def __len__(self) -> int:
+        """Return the number of indexed bus stops."""
+        with self._lock:
+            return len(self._entries)
+
+    def async_discovery_lock(self) -> asyncio.Lock:
+        """Retrieve the asyncio lock serializing the discovery requests."""
+        with self._lock:
+            if self._discovery_lock is None:
+                self._discovery_lock = asyncio.Lock()
+            return self._discovery_lock
+
+    def _restore_entry(self, stop_id, entry):
+        """Add a persisted bus stop and index its lines, with the lock held."""
+        self._entries[stop_id] = entry
+        self._index_lines(stop_id, entry["stop_info"])
+        self._spatial_index = None
+
+    def load(self) -> bool:
+        """Load the persisted bus stop index and its spatial index from disk."""
+        if not super().load():
+            return False
+        spatial_index = SpatialIndex.load(self._spatial_path())
+        with self._lock:
+            if spatial_index is not None and len(spatial_index) == len(self._entries):
+                self._spatial_index = spatial_index
+        return True
+
+    def _spatial_path(self):
+        """Return the path of the persisted spatial index."""
+        return f"{os.path.splitext(self._path)[0]}.spatial.json"
+
+    def save(self) -> bool:
+        """Persist the bus stop index and its spatial index to disk."""
+        if not super().save():
+            return False
+        return self.get_spatial_index().save(self._spatial_path())
+
+
+def get_stop_index(path=None) -> StopIndex:
+    """Retrieve the bus stop index shared by every client using the same path."""
+    with _stop_indexes_lock:
+        stop_index = _stop_indexes.get(path)
+        if stop_index is None:
+            stop_index = StopIndex(path)
+            stop_index.load()
+            _stop_indexes[path] = stop_index
+        return stop_index
@@ -0,0 +1,130 @@
+"""Request metrics of the EMT Madrid API clients."""
+
+import bisect
+import threading
+
+# Upper bounds, in milliseconds, of the request latency histogram buckets.
+LATENCY_BUCKETS = (50, 100, 250, 500, 1000, 2500, 5000, 10000)
+SUCCESS_CODES = ("00", "01")
+
+
+class RequestMetrics:
+    """Counters of the requests sent by an API client, grouped by endpoint.
+
+    For each endpoint it keeps the number of requests, a histogram of their latency,
+    the API response codes that are not a success, the requests that failed before
+    getting a response and the bytes received.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS) -> None:
+        """Initialize an instance of the RequestMetrics class."""
+        self._buckets = tuple(buckets)
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def _endpoint(self, endpoint):
+        """Return the counters of an endpoint, creating them the first time."""
+        counters = self._endpoints.get(endpoint)
+        if counters is None:
+            counters = self._endpoints[endpoint] = {
+                "requests": 0,
+                "failures": 0,
+                "bytes": 0,
+                "latency_sum": 0.0,
+                "latency_buckets": [0] * (len(self._buckets) + 1),
+                "errors": {},
+            }
+        return counters
+
+    def _record_latency(self, counters, latency):
+        """Count a request and add its latency to the histogram."""
+        latency_ms = latency * 1000
+        counters["requests"] += 1
+        counters["latency_sum"] += latency_ms
+        counters["latency_buckets"][bisect.bisect_left(self._buckets, latency_ms)] += 1
+
+    def record_response(self, endpoint, latency, response):
+        """Count a request answered in latency seconds and its API response code."""
+        code = response.get("code") if isinstance(response, dict) else None
+        with self._lock:
+            counters = self._endpoint(endpoint)
+            self._record_latency(counters, latency)
+            if code is not None and code not in SUCCESS_CODES:
+                counters["errors"][code] = counters["errors"].get(code, 0) + 1
+
+    def record_failure(self, endpoint, latency):
+        """Count a request that failed without a response from the API."""
+        with self._lock:
+            counters = self._endpoint(endpoint)
+            self._record_latency(counters, latency)
+            counters["failures"] += 1
+
+    def record_bytes(self, endpoint, size):
+        """Count the bytes of a response body."""
+        with self._lock:
+            self._endpoint(endpoint)["bytes"] += size
+
+    def latency_quantile(self, quantile, endpoint=None):
+        """Estimate a latency quantile, in milliseconds, from the histogram.
+
+        The upper bound of the bucket holding the quantile is returned, or None if
+        there are no requests or the quantile falls above the last bucket.
+        """
+        with self._lock:
+            if endpoint is None:
+                endpoints = list(self._endpoints.values())
+            else:
+                counters = self._endpoints.get(endpoint)
+                endpoints = [counters] if counters is not None else []
+            histograms = [counters["latency_buckets"] for counters in endpoints]
+            buckets = [sum(counts) for counts in zip(*histograms)]
+        total = sum(buckets)
+        if not total:
+            return None
+        rank = quantile * total
+        seen = 0
+        for bound, count in zip(self._buckets, buckets):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def as_dict(self):
+        """Return a copy of the counters, with the totals of every endpoint."""
+        with self._lock:
+            endpoints = {
+                endpoint: {
+                    "requests": counters["requests"],
+                    "failures": counters["failures"],
+                    "bytes": counters["bytes"],
+                    "latency_mean_ms": counters["latency_sum"] / counters["requests"]
+                    if counters["requests"]
+                    else None,
+                    "latency_buckets": dict(
+                        zip(
+                            [*map(str, self._buckets), "inf"],
+                            counters["latency_buckets"],
+                        )
+                    ),
+                    "errors": dict(counters["errors"]),
+                }
+                for endpoint, counters in self._endpoints.items()
+            }
+        errors = {}
+        for counters in endpoints.values():
+            for code, count in counters["errors"].items():
+                errors[code] = errors.get(code, 0) + count
+        requests = sum(counters["requests"] for counters in endpoints.values())
+        latency_sum = sum(
+            counters["latency_mean_ms"] * counters["requests"]
+            for counters in endpoints.values()
+            if counters["requests"]
+        )
+        return {
+            "requests": requests,
+            "failures": sum(counters["failures"] for counters in endpoints.values()),
+            "bytes": sum(counters["bytes"] for counters in endpoints.values()),
+            "latency_mean_ms": latency_sum / requests if requests else None,
+            "errors": errors,
+            "endpoints": endpoints,
+        }
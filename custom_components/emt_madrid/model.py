@@ -0,0 +1,111 @@
+"""Data model of the EMT Madrid bus stops, lines and arrivals."""
+
+from collections.abc import Mapping
+from dataclasses import dataclass, field
+import math
+from typing import Any
+
+MAX_ARRIVAL_MINUTES = 45
+
+
+@dataclass(frozen=True, slots=True)
+class Arrival:
+    """An estimated arrival of a bus at a bus stop.
+
+    The pace is the rate at which the arrival time is counted down, estimated from
+    the recent speed of the bus.
+    """
+
+    eta: int
+    distance: int | None
+    bus: int | None
+    timestamp: float
+    pace: float = 1.0
+
+    @property
+    def minutes(self) -> int:
+        """Return the minutes until the arrival, capped to the maximum shown."""
+        return min(math.trunc(self.eta / 60), MAX_ARRIVAL_MINUTES)
+
+    def remaining(self, now: float) -> float:
+        """Return the seconds until the arrival, counted down from the fetch time."""
+        return self.eta - (now - self.timestamp) * self.pace
+
+    def minutes_at(self, now: float) -> int:
+        """Return the minutes until the arrival at the given time."""
+        return min(math.trunc(self.remaining(now) / 60), MAX_ARRIVAL_MINUTES)
+
+
+@dataclass(slots=True)
+class Line:
+    """A bus line serving a bus stop and its next arrivals."""
+
+    number: str
+    destination: str | None = None
+    origin: str | None = None
+    max_freq: int | None = None
+    min_freq: int | None = None
+    start_time: str | None = None
+    end_time: str | None = None
+    day_type: str | None = None
+    arrivals: list[Arrival] = field(default_factory=list)
+
+    def as_dict(self):
+        """Return the line information, without the arrivals."""
+        return {
+            "number": self.number,
+            "destination": self.destination,
+            "origin": self.origin,
+            "max_freq": self.max_freq,
+            "min_freq": self.min_freq,
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+            "day_type": self.day_type,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Create a line from the dictionary returned by as_dict."""
+        return cls(**data)
+
+
+@dataclass(slots=True)
+class Stop:
+    """A bus stop and the lines serving it."""
+
+    stop_id: int
+    name: str | None = None
+    coordinates: list[float] | None = None
+    address: str | None = None
+    lines: dict[str, Line] = field(default_factory=dict)
+
+    def as_dict(self):
+        """Return the bus stop information, without the arrivals."""
+        return {
+            "stop_id": self.stop_id,
+            "name": self.name,
+            "coordinates": self.coordinates,
+            "address": self.address,
+            "lines": {number: line.as_dict() for number, line in self.lines.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Create a bus stop from the dictionary returned by as_dict."""
+        return cls(
+            stop_id=data["stop_id"],
+            name=data["name"],
+            coordinates=data["coordinates"],
+            address=data["address"],
+            lines={
+                number: Line.from_dict(line) for number, line in data["lines"].items()
+            },
+        )
+
+
+@dataclass(frozen=True, slots=True)
+class LineSnapshot:
+    """The state and attributes of a sensor computed once per update."""
+
+    state: int | None
+    attributes: Mapping[str, Any]
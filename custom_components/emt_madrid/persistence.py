@@ -0,0 +1,39 @@
+"""JSON files persisted by the EMT Madrid integration."""
+
+import json
+import logging
+import os
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def load_json(path, description):
+    """Load a JSON file, or return None if it does not exist or cannot be read."""
+    if path is None or not os.path.exists(path):
+        return None
+    try:
+        with open(path, encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError) as e:
+        _LOGGER.warning(f"Unable to load {description} from {path}: {e}")
+        return None
+
+
+def save_json(path, data, description, private=False) -> bool:
+    """Write a JSON file atomically, return whether it was saved.
+
+    The data is written to a temporary file replacing the previous one, so a crash
+    never leaves a truncated file. Private files are only readable by their owner.
+    """
+    tmp_path = f"{path}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        mode = 0o600 if private else 0o666
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+        with os.fdopen(fd, "w", encoding="utf-8") as file:
+            json.dump(data, file)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        _LOGGER.warning(f"Unable to save {description} to {path}: {e}")
+        return False
+    return True
@@ -0,0 +1,258 @@
+"""Daily API quota tracking for the EMT Madrid integration."""
+
+from datetime import date, datetime, timedelta
+import threading
+from zoneinfo import ZoneInfo
+
+DEFAULT_DAILY_LIMIT = 20000
+DEFAULT_QUOTA_RESERVE = 0.02
+QUOTA_TIMEZONE = ZoneInfo("Europe/Madrid")
+
+_quota_manager = None
+_quota_manager_lock = threading.Lock()
+
+
+def _poll_interval(budget, stops, min_interval: timedelta) -> timedelta:
+    """Return the interval between polls spreading a budget over the rest of the day."""
+    now = datetime.now(QUOTA_TIMEZONE)
+    midnight = datetime.combine(
+        now.date() + timedelta(days=1), datetime.min.time(), QUOTA_TIMEZONE
+    )
+    seconds_left = (midnight - now).total_seconds()
+    if budget < stops:
+        return max(min_interval, timedelta(seconds=seconds_left))
+    interval = timedelta(seconds=seconds_left * stops / budget)
+    return max(min_interval, interval)
+
+
+class QuotaTracker:
+    """A tracker of the daily requests used by an EMT MobilityLabs account.
+
+    The usage is taken from the apiCounter of the login response and increased with
+    every request sent afterwards. It is used to spread the remaining daily budget
+    across the bus stops polled with the account, keeping a small reserve so the
+    API never answers that the limit was reached. The usage can be persisted with
+    as_dict and restore, so a restart reusing the access token, without a login,
+    does not start the day with the whole budget again.
+    """
+
+    def __init__(
+        self, daily_limit=DEFAULT_DAILY_LIMIT, reserve=DEFAULT_QUOTA_RESERVE
+    ) -> None:
+        """Initialize an instance of the QuotaTracker class."""
+        self._daily_limit = daily_limit
+        self._reserve = reserve
+        self._used = 0
+        self._exhausted = False
+        self._day = self._today()
+        self._stops = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _today():
+        """Return the current date in the timezone used by the API counters."""
+        return datetime.now(QUOTA_TIMEZONE).date()
+
+    def _roll_day(self):
+        """Reset the usage when the daily quota is renewed."""
+        today = self._today()
+        if today != self._day:
+            self._day = today
+            self._used = 0
+            self._exhausted = False
+
+    @property
+    def daily_limit(self) -> int:
+        """Return the number of requests allowed per day."""
+        return self._daily_limit
+
+    @property
+    def used(self) -> int:
+        """Return the number of requests used today."""
+        with self._lock:
+            self._roll_day()
+            return self._used
+
+    @property
+    def remaining(self) -> int:
+        """Return the number of requests left for today."""
+        with self._lock:
+            self._roll_day()
+            if self._exhausted:
+                return 0
+            return max(self._daily_limit - self._used, 0)
+
+    @property
+    def budget(self) -> float:
+        """Return the number of requests left for today above the reserve."""
+        return self.remaining - self._daily_limit * self._reserve
+
+    def as_dict(self):
+        """Return the usage of the day, to be persisted."""
+        with self._lock:
+            self._roll_day()
+            return {
+                "day": self._day.isoformat(),
+                "used": self._used,
+                "daily_limit": self._daily_limit,
+                "exhausted": self._exhausted,
+            }
+
+    def restore(self, usage):
+        """Restore a persisted usage if it is from today, keeping the highest count."""
+        try:
+            day = date.fromisoformat(usage["day"])
+            used = int(usage["used"])
+            daily_limit = int(usage["daily_limit"])
+        except (KeyError, TypeError, ValueError):
+            return
+        with self._lock:
+            self._roll_day()
+            if day != self._day:
+                return
+            self._daily_limit = daily_limit
+            self._used = max(self._used, used)
+            self._exhausted = self._exhausted or bool(usage.get("exhausted"))
+
+    def update_from_login(self, api_counter):
+        """Update the usage with the apiCounter of a login response."""
+        if not api_counter:
+            return
+        with self._lock:
+            self._roll_day()
+            self._daily_limit = int(api_counter.get("dailyUse", self._daily_limit))
+            self._used = int(api_counter.get("current", self._used))
+
+    def record_request(self):
+        """Count a request sent to the API."""
+        with self._lock:
+            self._roll_day()
+            self._used += 1
+
+    def mark_exhausted(self):
+        """Stop sending requests until the daily quota is renewed."""
+        with self._lock:
+            self._exhausted = True
+
+    def can_request(self) -> bool:
+        """Check whether there is budget left above the reserve."""
+        return self.remaining > self._daily_limit * self._reserve
+
+    def register_stop(self, stop_id):
+        """Register a bus stop polled with this account."""
+        with self._lock:
+            self._stops.add(stop_id)
+
+    def unregister_stop(self, stop_id):
+        """Unregister a bus stop that is no longer polled."""
+        with self._lock:
+            self._stops.discard(stop_id)
+
+    def poll_interval(self, min_interval: timedelta) -> timedelta:
+        """Return the interval between polls that makes the budget last all day.
+
+        The remaining budget above the reserve is shared between all the registered
+        bus stops until the quota is renewed at midnight.
+        """
+        with self._lock:
+            stops = max(len(self._stops), 1)
+        return _poll_interval(self.budget, stops, min_interval)
+
+
+class QuotaPool:
+    """The combined daily quota of a pool of accounts used by the same clients.
+
+    The bus stops are registered with the pool, so their polls are spread over the
+    budget of every account, whichever account each request is sent with.
+    """
+
+    def __init__(self, trackers) -> None:
+        """Initialize an instance of the QuotaPool class."""
+        self._trackers = tuple(trackers)
+        self._stops = set()
+        self._lock = threading.Lock()
+
+    @property
+    def daily_limit(self) -> int:
+        """Return the number of requests allowed per day by every account."""
+        return sum(tracker.daily_limit for tracker in self._trackers)
+
+    @property
+    def used(self) -> int:
+        """Return the number of requests used today by every account."""
+        return sum(tracker.used for tracker in self._trackers)
+
+    @property
+    def remaining(self) -> int:
+        """Return the number of requests left for today by every account."""
+        return sum(tracker.remaining for tracker in self._trackers)
+
+    def can_request(self) -> bool:
+        """Check whether an account has budget left above its reserve."""
+        return any(tracker.can_request() for tracker in self._trackers)
+
+    def register_stop(self, stop_id):
+        """Register a bus stop polled with this pool."""
+        with self._lock:
+            self._stops.add(stop_id)
+
+    def unregister_stop(self, stop_id):
+        """Unregister a bus stop that is no longer polled."""
+        with self._lock:
+            self._stops.discard(stop_id)
+
+    def poll_interval(self, min_interval: timedelta) -> timedelta:
+        """Return the interval between polls that makes the pool budget last all day."""
+        budget = sum(max(tracker.budget, 0) for tracker in self._trackers)
+        with self._lock:
+            stops = max(len(self._stops), 1)
+        return _poll_interval(budget, stops, min_interval)
+
+
+class QuotaManager:
+    """The quota trackers of every account, shared by the clients using them."""
+
+    def __init__(self) -> None:
+        """Initialize an instance of the QuotaManager class."""
+        self._trackers = {}
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def get(self, key) -> QuotaTracker:
+        """Retrieve the quota tracker of an account."""
+        with self._lock:
+            quota_tracker = self._trackers.get(key)
+            if quota_tracker is None:
+                quota_tracker = QuotaTracker()
+                self._trackers[key] = quota_tracker
+            return quota_tracker
+
+    def get_pool(self, keys) -> QuotaPool:
+        """Retrieve the quota pool shared by every client of the same accounts."""
+        trackers = [self.get(key) for key in keys]
+        with self._lock:
+            quota_pool = self._pools.get(tuple(keys))
+            if quota_pool is None:
+                quota_pool = QuotaPool(trackers)
+                self._pools[tuple(keys)] = quota_pool
+            return quota_pool
+
+    def as_dict(self):
+        """Return the usage of the day of every account."""
+        with self._lock:
+            trackers = dict(self._trackers)
+        return {key: tracker.as_dict() for key, tracker in trackers.items()}
+
+    def restore(self, quotas):
+        """Restore the persisted usage of the accounts."""
+        for key, usage in quotas.items():
+            self.get(key).restore(usage)
+
+
+def get_quota_manager() -> QuotaManager:
+    """Retrieve the quota manager shared by the clients without their own."""
+    global _quota_manager
+    with _quota_manager_lock:
+        if _quota_manager is None:
+            _quota_manager = QuotaManager()
+        return _quota_manager
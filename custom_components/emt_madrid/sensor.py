@@ -1,33 +1,64 @@
 """Support for EMT Madrid (Empresa Municipal de Transportes de Madrid) to get next departures."""
 
+import asyncio
 import logging
+import time
+from types import MappingProxyType
 from typing import Any
 
+import aiohttp
 import voluptuous as vol
 
 from homeassistant.components.sensor import PLATFORM_SCHEMA
 from homeassistant.const import (
     ATTR_ATTRIBUTION,
+    CONF_CLIENT_ID,
     CONF_EMAIL,
     CONF_ICON,
     CONF_PASSWORD,
+    CONF_SCAN_INTERVAL,
+    EVENT_HOMEASSISTANT_STOP,
+    EntityCategory,
     UnitOfTime,
 )
-from homeassistant.core import HomeAssistant
+from homeassistant.core import HomeAssistant, callback
+from homeassistant.helpers.aiohttp_client import async_get_clientsession
 import homeassistant.helpers.config_validation as cv
-from homeassistant.helpers.entity import Entity
 from homeassistant.helpers.entity_platform import AddEntitiesCallback
+from homeassistant.helpers.event import async_call_later
 from homeassistant.helpers.typing import ConfigType, DiscoveryInfoType
+from homeassistant.helpers.update_coordinator import CoordinatorEntity
 
-from .emt_madrid import APIEMT
+from .auth import Credentials
+from .coordinator import SCAN_INTERVAL, EMTStopCoordinator
+from .emt_madrid import AsyncAPIEMT
+from .model import Line, LineSnapshot
+from .storage import (
+    async_get_arrival_history,
+    async_get_quota_manager,
+    async_get_stop_index,
+    async_get_stop_info_cache,
+    async_get_token_manager,
+    get_circuit_breakers,
+)
 
 _LOGGER = logging.getLogger(__name__)
 
 
 CONF_STOP_ID = "stop"
+CONF_PASS_KEY = "pass_key"
+CONF_ACCOUNTS = "accounts"
 CONF_BUS_LINES = "lines"
+CONF_DIAGNOSTICS = "diagnostics"
+CONF_DISCOVERY_RADIUS = "discovery_radius"
+CONF_HISTORY = "history"
+CONF_STATISTICS = "statistics"
+CONF_RECORD_STATIC_ATTRIBUTES = "record_static_attributes"
 
 DEFAULT_ICON = "mdi:bus"
+MAX_DISCOVERY_RADIUS = 2000
+SETUP_RETRY_DELAY = 30
+MAX_SETUP_RETRY_DELAY = 3600
 
 ATTR_NEXT_UP = "next_bus"
 ATTR_STOP_ID = "stop_id"
@@ -41,30 +72,90 @@ ATTR_LINE_END_TIME = "end_time"
 ATTR_LINE_MAX_FREQ = "max_frequency"
 ATTR_LINE_MIN_FREQ = "min_frequency"
 ATTR_LINE_DISTANCE = "distance"
+ATTR_STALE = "stale"
+ATTR_VEHICLES = "vehicles"
 ATTRIBUTION = "Data provided by EMT Madrid MobilityLabs"
+# Attributes that do not change between updates.
+STATIC_ATTRIBUTES = frozenset(
+    {
+        ATTR_STOP_ID,
+        ATTR_STOP_NAME,
+        ATTR_STOP_ADDRESS,
+        ATTR_LINE,
+        ATTR_LINE_DESTINATION,
+        ATTR_LINE_ORIGIN,
+        ATTR_LINE_START_TIME,
+        ATTR_LINE_END_TIME,
+        ATTR_LINE_MAX_FREQ,
+        ATTR_LINE_MIN_FREQ,
+    }
+)
+
+DIAGNOSTIC_REQUESTS = "requests"
+DIAGNOSTIC_LATENCY = "latency"
+DIAGNOSTIC_ERRORS = "errors"
+DIAGNOSTIC_QUOTA = "quota"
+DIAGNOSTIC_SENSORS = {
+    DIAGNOSTIC_REQUESTS: ("API requests", None, "mdi:counter"),
+    DIAGNOSTIC_LATENCY: ("API latency", UnitOfTime.MILLISECONDS, "mdi:timer-outline"),
+    DIAGNOSTIC_ERRORS: ("API errors", None, "mdi:alert-circle-outline"),
+    DIAGNOSTIC_QUOTA: ("API quota remaining", None, "mdi:gauge"),
+}
+
+ACCOUNT_SCHEMA = vol.Any(
+    vol.Schema(
+        {vol.Required(CONF_EMAIL): cv.string, vol.Required(CONF_PASSWORD): cv.string}
+    ),
+    vol.Schema(
+        {
+            vol.Required(CONF_CLIENT_ID): cv.string,
+            vol.Required(CONF_PASS_KEY): cv.string,
+        }
+    ),
+)
 
 PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend(
     {
-        vol.Required(CONF_EMAIL): cv.string,
-        vol.Required(CONF_PASSWORD): cv.string,
+        vol.Inclusive(CONF_EMAIL, "user"): cv.string,
+        vol.Inclusive(CONF_PASSWORD, "user"): cv.string,
+        vol.Inclusive(CONF_CLIENT_ID, "app"): cv.string,
+        vol.Inclusive(CONF_PASS_KEY, "app"): cv.string,
+        vol.Optional(CONF_ACCOUNTS): vol.All(cv.ensure_list, [ACCOUNT_SCHEMA]),
         vol.Required(CONF_STOP_ID): cv.positive_int,
         vol.Optional(CONF_ICON, default=DEFAULT_ICON): cv.string,
         vol.Optional(CONF_BUS_LINES, default=[]): vol.All(cv.ensure_list, [cv.string]),
+        vol.Optional(CONF_DIAGNOSTICS, default=False): cv.boolean,
+        vol.Optional(CONF_HISTORY, default=False): cv.boolean,
+        vol.Optional(CONF_STATISTICS, default=False): cv.boolean,
+        vol.Optional(CONF_RECORD_STATIC_ATTRIBUTES, default=True): cv.boolean,
+        vol.Optional(CONF_DISCOVERY_RADIUS): vol.All(
+            vol.Coerce(int), vol.Range(min=0, max=MAX_DISCOVERY_RADIUS)
+        ),
     }
 )
+PLATFORM_SCHEMA = vol.All(
+    cv.has_at_least_one_key(CONF_EMAIL, CONF_CLIENT_ID, CONF_ACCOUNTS), PLATFORM_SCHEMA
+)
 
 
-class BusLineSensor(Entity):
-    """Implementation of an EMT-Madrid bus line sensor."""
+class EMTSnapshotSensor(CoordinatorEntity[EMTStopCoordinator]):
+    """Base of the EMT-Madrid sensors, computing their state once per update.
+
+    Subclasses set their unit and icon, and compute the state and attributes in
+    _build_snapshot. The state is only written when the snapshot or the
+    availability changed since the previous update.
+    """
 
-    def __init__(self, api_emt: APIEMT, stop_id, line, name, icon) -> None:
+    _unit: str | None = None
+    _icon: str | None = None
+
+    def __init__(self, coordinator: EMTStopCoordinator, name) -> None:
         """Initialize the sensor."""
-        self._state = None
-        self._api_emt = api_emt
-        self._stop_id = stop_id
-        self._bus_line = line
-        self._icon = icon
+        super().__init__(coordinator)
+        self._api_emt = coordinator.api_emt
         self._name = name
+        self._snapshot = self._build_snapshot()
+        self._available = self.available
 
     @property
     def name(self) -> str:
@@ -72,91 +163,374 @@ class BusLineSensor(Entity):
         return self._name
 
     @property
-    def state(self) -> int:
+    def state(self) -> int | float | None:
         """Return the state of the sensor."""
-        arrival_time = self._api_emt.get_arrival_time(self._bus_line)
-        return arrival_time[0]
+        return self._snapshot.state
 
     @property
-    def unit_of_measurement(self) -> str:
+    def unit_of_measurement(self) -> str | None:
         """Return the unit of measurement."""
-        return UnitOfTime.MINUTES
+        return self._unit
 
     @property
-    def icon(self) -> str:
+    def icon(self) -> str | None:
         """Return sensor specific icon."""
         return self._icon
 
     @property
     def extra_state_attributes(self) -> dict[str, Any]:
         """Return the device state attributes."""
-        arrival_time = self._api_emt.get_arrival_time(self._bus_line)
-        stop_info = self._api_emt.get_stop_info()
-        line_info = self._api_emt.get_line_info(self._bus_line)
+        return self._snapshot.attributes
+
+    @callback
+    def _handle_coordinator_update(self) -> None:
+        """Compute the snapshot of the new data and write the state if it changed."""
+        snapshot = self._build_snapshot()
+        if snapshot == self._snapshot and self.available == self._available:
+            return
+        self._snapshot = snapshot
+        self._available = self.available
+        super()._handle_coordinator_update()
+
+    def _build_snapshot(self) -> LineSnapshot:
+        """Compute the state and attributes of the sensor from the latest update."""
+        raise NotImplementedError
+
+
+class BusLineSensor(EMTSnapshotSensor):
+    """Implementation of an EMT-Madrid bus line sensor."""
+
+    # The tracked buses change on every update and only matter while live.
+    _unrecorded_attributes = frozenset({ATTR_VEHICLES})
+    _unit = UnitOfTime.MINUTES
 
-        return {
+    def __init__(
+        self, coordinator: EMTStopCoordinator, stop_id, line, name, icon
+    ) -> None:
+        """Initialize the sensor."""
+        self._stop_id = stop_id
+        self._bus_line = line
+        self._icon = icon
+        super().__init__(coordinator, name)
+
+    def _build_snapshot(self) -> LineSnapshot:
+        """Compute the state and attributes of the bus line from the latest update.
+
+        The arrival times are counted down from the last update, and the buses that
+        already arrived are skipped.
+        """
+        now = time.time()
+        stop_info = self.coordinator.data or self._api_emt.get_stop_info()
+        line_info = stop_info.lines.get(self._bus_line) or Line(self._bus_line)
+        arrivals = [
+            arrival for arrival in line_info.arrivals if arrival.remaining(now) >= 0
+        ]
+        arrival_time = [arrival.minutes_at(now) for arrival in arrivals[:2]]
+        arrival_time += [None] * (2 - len(arrival_time))
+
+        attributes = {
             ATTR_NEXT_UP: arrival_time[1],
             ATTR_LINE: self._bus_line,
-            ATTR_LINE_DISTANCE: line_info.get("distance")[0],
-            ATTR_LINE_DESTINATION: line_info.get("destination"),
-            ATTR_LINE_ORIGIN: line_info.get("origin"),
-            ATTR_LINE_START_TIME: line_info.get("start_time"),
-            ATTR_LINE_END_TIME: line_info.get("end_time"),
-            ATTR_LINE_MAX_FREQ: line_info.get("max_freq"),
-            ATTR_LINE_MIN_FREQ: line_info.get("min_freq"),
+            ATTR_LINE_DISTANCE: arrivals[0].distance if arrivals else None,
+            ATTR_LINE_DESTINATION: line_info.destination,
+            ATTR_LINE_ORIGIN: line_info.origin,
+            ATTR_LINE_START_TIME: line_info.start_time,
+            ATTR_LINE_END_TIME: line_info.end_time,
+            ATTR_LINE_MAX_FREQ: line_info.max_freq,
+            ATTR_LINE_MIN_FREQ: line_info.min_freq,
             ATTR_STOP_ID: self._stop_id,
-            ATTR_STOP_NAME: stop_info.get("bus_stop_name"),
-            ATTR_STOP_ADDRESS: stop_info.get("bus_stop_address"),
+            ATTR_STOP_NAME: stop_info.name,
+            ATTR_STOP_ADDRESS: stop_info.address,
+            ATTR_STALE: self._api_emt.is_stale(),
+            ATTR_VEHICLES: [
+                vehicle.as_dict()
+                for vehicle in self._api_emt.get_vehicles(self._bus_line)
+            ],
             ATTR_ATTRIBUTION: ATTRIBUTION,
         }
+        return LineSnapshot(arrival_time[0], MappingProxyType(attributes))
+
+
+class UnrecordedBusLineSensor(BusLineSensor):
+    """A bus line sensor whose static attributes are not recorded in the history."""
+
+    _unrecorded_attributes = BusLineSensor._unrecorded_attributes | STATIC_ATTRIBUTES
 
-    def update(self) -> None:
-        """Fetch new state data for the sensor."""
-        self._api_emt.update_arrival_times(self._stop_id)
 
+class LineStatisticsSensor(EMTSnapshotSensor):
+    """Implementation of a sensor with the observed headway of an EMT-Madrid line."""
 
-def get_api_emt_instance(config: ConfigType) -> APIEMT:
-    """Create an instance of the APIEMT class with the provided configuration."""
-    email = config.get(CONF_EMAIL)
-    password = config.get(CONF_PASSWORD)
+    _unit = UnitOfTime.MINUTES
+    _icon = "mdi:chart-bell-curve"
+
+    def __init__(self, coordinator: EMTStopCoordinator, stop_id, line, name) -> None:
+        """Initialize the sensor."""
+        self._stop_id = stop_id
+        self._bus_line = line
+        super().__init__(coordinator, name)
+
+    def _build_snapshot(self) -> LineSnapshot:
+        """Compute the state and attributes from the arrival history of the line."""
+        statistics = self._api_emt.get_line_statistics(self._bus_line)
+        attributes = statistics.as_dict() if statistics is not None else {}
+        attributes.update(
+            {
+                ATTR_LINE: self._bus_line,
+                ATTR_STOP_ID: self._stop_id,
+                ATTR_ATTRIBUTION: ATTRIBUTION,
+            }
+        )
+        state = attributes.pop("headway_mean", None)
+        return LineSnapshot(state, MappingProxyType(attributes))
+
+
+class DiagnosticSensor(EMTSnapshotSensor):
+    """Implementation of a sensor with the request metrics of an EMT-Madrid stop."""
+
+    _attr_entity_category = EntityCategory.DIAGNOSTIC
+
+    def __init__(self, coordinator: EMTStopCoordinator, stop_id, kind) -> None:
+        """Initialize the sensor."""
+        self._kind = kind
+        label, self._unit, self._icon = DIAGNOSTIC_SENSORS[kind]
+        super().__init__(coordinator, f"EMT Madrid {stop_id} - {label}")
+
+    def _build_snapshot(self) -> LineSnapshot:
+        """Compute the state and attributes from the metrics of the client."""
+        diagnostics = self._api_emt.get_diagnostics()
+        endpoints = diagnostics["endpoints"]
+        if self._kind == DIAGNOSTIC_REQUESTS:
+            state = diagnostics["requests"]
+            attributes = {
+                "bytes_received": diagnostics["bytes"],
+                **{
+                    endpoint: counters["requests"]
+                    for endpoint, counters in endpoints.items()
+                },
+            }
+        elif self._kind == DIAGNOSTIC_LATENCY:
+            mean = diagnostics["latency_mean_ms"]
+            state = round(mean) if mean is not None else None
+            attributes = {
+                "p95": diagnostics["latency_p95_ms"],
+                **{
+                    endpoint: round(counters["latency_mean_ms"])
+                    for endpoint, counters in endpoints.items()
+                    if counters["latency_mean_ms"] is not None
+                },
+            }
+        elif self._kind == DIAGNOSTIC_ERRORS:
+            state = diagnostics["failures"] + sum(diagnostics["errors"].values())
+            attributes = {
+                "failures": diagnostics["failures"],
+                **{
+                    f"code_{code}": count
+                    for code, count in diagnostics["errors"].items()
+                },
+            }
+        else:
+            state = diagnostics["quota_remaining"]
+            attributes = {
+                "used": diagnostics["quota_used"],
+                "daily_limit": diagnostics["quota_limit"],
+            }
+        return LineSnapshot(state, MappingProxyType(attributes))
+
+
+def get_credentials(config: ConfigType) -> list[Credentials]:
+    """Return the credentials of every account configured for a bus stop."""
+    credentials = []
+    for account in [config, *config.get(CONF_ACCOUNTS, [])]:
+        if CONF_EMAIL in account:
+            credentials.append(
+                Credentials(email=account[CONF_EMAIL], password=account[CONF_PASSWORD])
+            )
+        if CONF_CLIENT_ID in account:
+            credentials.append(
+                Credentials(
+                    client_id=account[CONF_CLIENT_ID], pass_key=account[CONF_PASS_KEY]
+                )
+            )
+    return credentials
+
+
+async def async_get_api_emt_instance(
+    hass: HomeAssistant, config: ConfigType
+) -> AsyncAPIEMT:
+    """Create an instance of the AsyncAPIEMT class without sending any request."""
+    stop_id = config.get(CONF_STOP_ID)
+    session = async_get_clientsession(hass)
+    token_manager = await async_get_token_manager(hass)
+    stop_info_cache = await async_get_stop_info_cache(hass)
+    stop_index = await async_get_stop_index(hass)
+    history = None
+    if config.get(CONF_HISTORY) or config.get(CONF_STATISTICS):
+        history = await async_get_arrival_history(hass)
+    return AsyncAPIEMT(
+        session,
+        config.get(CONF_EMAIL),
+        config.get(CONF_PASSWORD),
+        stop_id,
+        token_manager,
+        stop_info_cache,
+        stop_index=stop_index,
+        history=history,
+        credentials=get_credentials(config),
+        quota_manager=await async_get_quota_manager(hass),
+        circuit_breakers=get_circuit_breakers(hass),
+    )
+
+
+async def async_load_stop_info(api_emt: AsyncAPIEMT, config: ConfigType) -> None:
+    """Load the information of the bus stop, discovering the stops around if set."""
     stop_id = config.get(CONF_STOP_ID)
-    api_emt = APIEMT(email, password, stop_id)
-    api_emt.authenticate()
-    api_emt.update_stop_info(stop_id)
-    return api_emt
+    stop_index = api_emt.get_stop_index()
+    radius = config.get(CONF_DISCOVERY_RADIUS)
+    if radius is not None and not api_emt.load_cached_stop_info(stop_id):
+        async with stop_index.async_discovery_lock():
+            if stop_id not in stop_index:
+                await api_emt.discover_stops(stop_id, radius)
+    await api_emt.update_stop_info(stop_id)
 
 
 def create_bus_line_sensor(
-    api_emt: APIEMT, stop_id, line, name, icon, config: ConfigType
+    coordinator: EMTStopCoordinator, stop_id, line, name, icon, config: ConfigType
 ) -> BusLineSensor:
-    """Create a BusLineSensor instance with the provided APIEMT instance and configuration."""
-    api_emt.update_arrival_times(stop_id)
-    return BusLineSensor(api_emt, stop_id, line, name, icon)
+    """Create a BusLineSensor instance sharing the coordinator of its bus stop."""
+    if not config.get(CONF_RECORD_STATIC_ATTRIBUTES, True):
+        return UnrecordedBusLineSensor(coordinator, stop_id, line, name, icon)
+    return BusLineSensor(coordinator, stop_id, line, name, icon)
 
 
-def setup_platform(
-    hass: HomeAssistant,
-    config: ConfigType,
-    add_entities: AddEntitiesCallback,
-    discovery_info: DiscoveryInfoType | None = None,
-) -> None:
-    """Set up the sensor platform."""
-    api_emt = get_api_emt_instance(config)
+def create_sensors(coordinator: EMTStopCoordinator, config: ConfigType) -> list:
+    """Create the sensors of a bus stop from the information loaded by its client."""
+    api_emt = coordinator.api_emt
     stop_id = config.get(CONF_STOP_ID)
     stop_info = api_emt.get_stop_info()
+    serving_lines = api_emt.get_stop_index().get_lines(stop_id) or set(stop_info.lines)
     lines = config.get(CONF_BUS_LINES)
-    bus_line_sensors = []
+    sensors = []
     if not lines or len(lines) == 0:
-        lines = list(stop_info["lines"].keys())
+        lines = list(stop_info.lines.keys())
     for line in lines:
-        if line in stop_info["lines"]:
-            name = f"Bus {line} - {stop_info['bus_stop_name']}"
+        if line in serving_lines:
+            name = f"Bus {line} - {stop_info.name}"
             icon = config.get(CONF_ICON)
-            bus_line_sensors.append(
-                create_bus_line_sensor(api_emt, stop_id, line, name, icon, config)
+            sensors.append(
+                create_bus_line_sensor(coordinator, stop_id, line, name, icon, config)
             )
+            if config.get(CONF_STATISTICS):
+                sensors.append(
+                    LineStatisticsSensor(coordinator, stop_id, line, f"{name} headway")
+                )
         else:
             _LOGGER.error(
                 f"Sensor setup failed. Line {line} not serviced at this stop (Stop ID: {stop_id})"
             )
-    add_entities(bus_line_sensors)
+    if config.get(CONF_DIAGNOSTICS):
+        sensors.extend(
+            DiagnosticSensor(coordinator, stop_id, kind) for kind in DIAGNOSTIC_SENSORS
+        )
+    return sensors
+
+
+async def async_setup_stop(
+    coordinator: EMTStopCoordinator,
+    config: ConfigType,
+    async_add_entities: AddEntitiesCallback | None,
+    retry_delay=SETUP_RETRY_DELAY,
+) -> None:
+    """Load a bus stop and fetch its first arrival times in the background.
+
+    When async_add_entities is given, the sensors are added once the bus stop
+    information is loaded. Otherwise they were already added from the cache. A bus
+    stop that could not be loaded is retried later with a growing delay, unless the
+    credentials were rejected.
+    """
+    api_emt = coordinator.api_emt
+    stop_id = config.get(CONF_STOP_ID)
+    try:
+        await async_load_stop_info(api_emt, config)
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        error = e
+    else:
+        error = None if api_emt.get_stop_info().name else "no information received"
+    if error is not None:
+        if async_add_entities is None:
+            _LOGGER.error(
+                f"Unable to load the information of bus stop {stop_id}: {error}"
+            )
+        elif api_emt.credentials_rejected():
+            return
+        else:
+            _LOGGER.warning(
+                f"Unable to load the information of bus stop {stop_id}, retrying in "
+                f"{retry_delay} seconds: {error}"
+            )
+            async_retry_setup_stop(coordinator, config, async_add_entities, retry_delay)
+            return
+    await coordinator.async_refresh()
+    if async_add_entities is not None:
+        async_add_entities(create_sensors(coordinator, config))
+
+
+@callback
+def async_retry_setup_stop(
+    coordinator: EMTStopCoordinator,
+    config: ConfigType,
+    async_add_entities: AddEntitiesCallback,
+    retry_delay,
+) -> None:
+    """Set up a bus stop again after a delay, unless Home Assistant stops first."""
+    hass = coordinator.hass
+
+    @callback
+    def async_retry(_now) -> None:
+        unsub_stop()
+        hass.async_create_background_task(
+            async_setup_stop(
+                coordinator,
+                config,
+                async_add_entities,
+                min(2 * retry_delay, MAX_SETUP_RETRY_DELAY),
+            ),
+            f"EMT Madrid stop {coordinator.stop_id} setup",
+        )
+
+    @callback
+    def async_cancel_retry(_event) -> None:
+        unsub_retry()
+
+    unsub_retry = async_call_later(hass, retry_delay, async_retry)
+    unsub_stop = hass.bus.async_listen_once(
+        EVENT_HOMEASSISTANT_STOP, async_cancel_retry
+    )
+
+
+async def async_setup_platform(
+    hass: HomeAssistant,
+    config: ConfigType,
+    async_add_entities: AddEntitiesCallback,
+    discovery_info: DiscoveryInfoType | None = None,
+) -> None:
+    """Set up the sensor platform.
+
+    No request is sent during the setup: the sensors of a bus stop already cached
+    are added right away, and the login, the bus stop information and the first
+    arrival times are loaded in a background task, in parallel for every stop.
+    """
+    api_emt = await async_get_api_emt_instance(hass, config)
+    api_emt.subscribe_lines(config.get(CONF_BUS_LINES))
+    stop_id = config.get(CONF_STOP_ID)
+    coordinator = EMTStopCoordinator(
+        hass, api_emt, stop_id, config.get(CONF_SCAN_INTERVAL, SCAN_INTERVAL)
+    )
+    if api_emt.load_cached_stop_info(stop_id):
+        async_add_entities(create_sensors(coordinator, config))
+        pending_add_entities = None
+    else:
+        pending_add_entities = async_add_entities
+    hass.async_create_background_task(
+        async_setup_stop(coordinator, config, pending_add_entities),
+        f"EMT Madrid stop {stop_id} setup",
+    )
@@ -0,0 +1,76 @@
+"""Request coalescing for the EMT Madrid API clients."""
+
+import asyncio
+import threading
+
+
+class _Call:
+    """A call in flight and its outcome."""
+
+    def __init__(self) -> None:
+        """Initialize an instance of the _Call class."""
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesce concurrent calls with the same key into a single execution.
+
+    The first caller runs the function while the others wait for it to finish, and
+    all of them get the same result or exception.
+    """
+
+    def __init__(self) -> None:
+        """Initialize an instance of the SingleFlight class."""
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, function, *args):
+        """Run the function, or wait for the call in flight with the same key."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = function(*args)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+class AsyncSingleFlight:
+    """Coalesce concurrent coroutine calls with the same key into a single task.
+
+    Cancelling one of the callers does not cancel the shared task, so the others
+    still get its result.
+    """
+
+    def __init__(self) -> None:
+        """Initialize an instance of the AsyncSingleFlight class."""
+        self._calls = {}
+
+    async def do(self, key, function, *args):
+        """Run the coroutine function, or wait for the task with the same key."""
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(function(*args))
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        """Remove a finished task so the next call runs the function again."""
+        if self._calls.get(key) is task:
+            del self._calls[key]
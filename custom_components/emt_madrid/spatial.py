@@ -0,0 +1,190 @@
+"""Spatial index of bus stops for nearest stop lookups without API requests."""
+
+import heapq
+import logging
+import math
+
+from .persistence import load_json, save_json
+
+DEFAULT_CELL_SIZE = 250
+REFERENCE_LATITUDE = 40.4168
+EARTH_RADIUS = 6371008.8
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def distance(lat1, lon1, lat2, lon2) -> float:
+    """Return the great-circle distance in meters between two points."""
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = (
+        math.sin(dphi / 2) ** 2
+        + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+class SpatialIndex:
+    """A uniform grid of bus stop positions.
+
+    Positions are projected to meters around Madrid and bucketed in square cells of
+    cell_size meters, so a lookup only measures the stops of the cells around the
+    point. The projection is only used to pick the cells, distances are great-circle
+    distances.
+    """
+
+    def __init__(self, cell_size=DEFAULT_CELL_SIZE) -> None:
+        """Initialize an instance of the SpatialIndex class."""
+        self._cell_size = cell_size
+        self._lon_scale = math.cos(math.radians(REFERENCE_LATITUDE))
+        self._cells = {}
+        self._stops = {}
+        self._bounds = None
+
+    @classmethod
+    def from_entries(cls, entries, cell_size=DEFAULT_CELL_SIZE):
+        """Build the index from bus stop entries of the stop index or cache."""
+        index = cls(cell_size)
+        for entry in entries.values():
+            stop_info = entry["stop_info"]
+            coordinates = stop_info.get("coordinates")
+            if coordinates:
+                lon, lat = coordinates[:2]
+                index.add(stop_info["stop_id"], lat, lon, stop_info["lines"])
+        return index
+
+    def __len__(self) -> int:
+        """Return the number of bus stops in the index."""
+        return len(self._stops)
+
+    def _cell(self, lat, lon):
+        """Return the grid cell of a position."""
+        x = lon * self._lon_scale * METERS_PER_DEGREE
+        y = lat * METERS_PER_DEGREE
+        return math.floor(x / self._cell_size), math.floor(y / self._cell_size)
+
+    def add(self, stop_id, lat, lon, lines=()):
+        """Add a bus stop, or move it if it was already indexed."""
+        self.remove(stop_id)
+        cell = self._cell(lat, lon)
+        self._stops[stop_id] = (lat, lon, frozenset(lines), cell)
+        self._cells.setdefault(cell, []).append(stop_id)
+        if self._bounds is None:
+            self._bounds = (cell[0], cell[1], cell[0], cell[1])
+        else:
+            min_x, min_y, max_x, max_y = self._bounds
+            self._bounds = (
+                min(min_x, cell[0]),
+                min(min_y, cell[1]),
+                max(max_x, cell[0]),
+                max(max_y, cell[1]),
+            )
+
+    def remove(self, stop_id):
+        """Remove a bus stop from the index."""
+        stop = self._stops.pop(stop_id, None)
+        if stop is None:
+            return
+        cell_stops = self._cells[stop[3]]
+        cell_stops.remove(stop_id)
+        if not cell_stops:
+            del self._cells[stop[3]]
+
+    def _ring(self, cell, radius):
+        """Yield the cells at the given Chebyshev distance of a cell."""
+        cx, cy = cell
+        if radius == 0:
+            yield cell
+            return
+        for dx in range(-radius, radius + 1):
+            yield cx + dx, cy - radius
+            yield cx + dx, cy + radius
+        for dy in range(-radius + 1, radius):
+            yield cx - radius, cy + dy
+            yield cx + radius, cy + dy
+
+    def nearest(self, lat, lon, k=1, line=None):
+        """Return the k nearest bus stops, optionally served by a line.
+
+        The result is a list of (stop ID, distance in meters) tuples, nearest first.
+        """
+        if k <= 0 or not self._stops:
+            return []
+        center = self._cell(lat, lon)
+        min_x, min_y, max_x, max_y = self._bounds
+        max_ring = max(
+            center[0] - min_x, max_x - center[0], center[1] - min_y, max_y - center[1]
+        )
+        found = []
+        for ring in range(max_ring + 1):
+            for cell in self._ring(center, ring):
+                for stop_id in self._cells.get(cell, ()):
+                    stop_lat, stop_lon, lines, _ = self._stops[stop_id]
+                    if line is None or line in lines:
+                        found.append((distance(lat, lon, stop_lat, stop_lon), stop_id))
+            # The stops outside the searched rings are at least ring cells away,
+            # one cell is left as a margin for the projection error.
+            if len(found) >= k and heapq.nsmallest(k, found)[-1][0] <= (
+                (ring - 1) * self._cell_size
+            ):
+                break
+        return [(stop_id, meters) for meters, stop_id in heapq.nsmallest(k, found)]
+
+    def within(self, lat, lon, radius, line=None):
+        """Return the bus stops within radius meters, optionally served by a line.
+
+        The result is a list of (stop ID, distance in meters) tuples, nearest first.
+        """
+        center = self._cell(lat, lon)
+        # Cells are slightly smaller than cell_size meters away from the reference
+        # latitude, so one more ring is searched.
+        rings = math.ceil(radius / self._cell_size) + 1
+        found = []
+        for dx in range(-rings, rings + 1):
+            for dy in range(-rings, rings + 1):
+                for stop_id in self._cells.get((center[0] + dx, center[1] + dy), ()):
+                    stop_lat, stop_lon, lines, _ = self._stops[stop_id]
+                    if line is not None and line not in lines:
+                        continue
+                    meters = distance(lat, lon, stop_lat, stop_lon)
+                    if meters <= radius:
+                        found.append((meters, stop_id))
+        found.sort()
+        return [(stop_id, meters) for meters, stop_id in found]
+
+    def as_dict(self):
+        """Return the indexed bus stops, to persist the index."""
+        return {
+            "cell_size": self._cell_size,
+            "stops": [
+                [stop_id, lat, lon, sorted(lines)]
+                for stop_id, (lat, lon, lines, _) in self._stops.items()
+            ],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Create an index from the dictionary returned by as_dict."""
+        index = cls(data["cell_size"])
+        for stop_id, lat, lon, lines in data["stops"]:
+            index.add(stop_id, lat, lon, lines)
+        return index
+
+    def save(self, path) -> bool:
+        """Persist the index to disk, return whether it was written."""
+        return save_json(path, self.as_dict(), "the spatial index")
+
+    @classmethod
+    def load(cls, path):
+        """Load an index persisted to disk, or None if it cannot be read."""
+        data = load_json(path, "the spatial index")
+        if data is None:
+            return None
+        try:
+            return cls.from_dict(data)
+        except (KeyError, TypeError, ValueError) as e:
+            _LOGGER.warning(f"Unable to load the spatial index from {path}: {e}")
+            return None
@@ -0,0 +1,140 @@
+"""Headway and arrival time reliability statistics of the recorded arrivals."""
+
+from dataclasses import asdict, dataclass
+
+import numpy as np
+
+# Records with a longer ETA have no estimate: the API answers 999999 seconds.
+MAX_ETA = 2 * 60 * 60
+# The observations of a bus further apart than this belong to different trips.
+TRIP_GAP = 15 * 60
+# A trip whose last ETA was at most this many seconds is counted as arrived.
+ARRIVAL_ETA = 90
+# Longer intervals between arrivals are service breaks, not headways.
+MAX_HEADWAY = 2 * 60 * 60
+# Buses arriving within this fraction of the scheduled headway are bunched.
+BUNCHING_FACTOR = 0.25
+
+
+@dataclass(frozen=True, slots=True)
+class LineStatistics:
+    """The observed service of a line at a bus stop.
+
+    Headways are in minutes and ETA errors in seconds, positive when the bus arrived
+    later than estimated. The window is the time in hours between the first and last
+    records the statistics were computed from.
+    """
+
+    arrivals: int
+    window_hours: float | None = None
+    headway_mean: float | None = None
+    headway_median: float | None = None
+    headway_p90: float | None = None
+    bunching_rate: float | None = None
+    eta_error_mean: float | None = None
+    eta_error_mae: float | None = None
+    eta_error_p90: float | None = None
+
+    def as_dict(self):
+        """Return the statistics, rounded for display."""
+        return {
+            name: round(value, 2) if isinstance(value, float) else value
+            for name, value in asdict(self).items()
+        }
+
+
+def _as_array(column, dtype):
+    """Return a typed array column as a NumPy array, without copying it if possible."""
+    if isinstance(column, np.ndarray):
+        return column.astype(dtype, copy=False)
+    return np.frombuffer(column, dtype=dtype) if len(column) else np.empty(0, dtype)
+
+
+def estimate_arrivals(columns):
+    """Estimate the actual arrivals of the buses of a line from the recorded polls.
+
+    The records of each bus are split into trips, and a trip ending with an ETA
+    under ARRIVAL_ETA seconds arrived at the last estimated time. Returns the sorted
+    arrival timestamps and, for every record of an arrived trip other than its last
+    one, the ETA error in seconds.
+    """
+    timestamps = _as_array(columns[0], np.float64)
+    etas = _as_array(columns[1], np.int32)
+    buses = _as_array(columns[3], np.int32)
+
+    valid = (buses >= 0) & (etas >= 0) & (etas < MAX_ETA)
+    timestamps = timestamps[valid]
+    etas = etas[valid]
+    buses = buses[valid]
+    if not len(timestamps):
+        return np.empty(0), np.empty(0)
+
+    order = np.lexsort((timestamps, buses))
+    timestamps = timestamps[order]
+    etas = etas[order]
+    buses = buses[order]
+    estimated = timestamps + etas
+
+    new_trip = np.ones(len(timestamps), dtype=bool)
+    new_trip[1:] = (
+        (buses[1:] != buses[:-1])
+        | (timestamps[1:] - timestamps[:-1] > TRIP_GAP)
+        | (estimated[1:] - estimated[:-1] > TRIP_GAP)
+    )
+    trips = np.cumsum(new_trip) - 1
+    last = np.ones(len(timestamps), dtype=bool)
+    last[:-1] = new_trip[1:]
+
+    arrived = etas[last] <= ARRIVAL_ETA
+    arrivals = np.sort(estimated[last][arrived])
+
+    errors_mask = arrived[trips] & ~last
+    errors = (estimated[last][trips] - estimated)[errors_mask]
+    return arrivals, errors
+
+
+def compute_line_statistics(columns, scheduled_headway=None) -> LineStatistics:
+    """Compute the statistics of a line from the columns of its recorded arrivals.
+
+    The columns are the timestamps, ETAs, distances and bus IDs returned by the
+    arrival history. Buses are bunched when they arrive within a fraction of the
+    scheduled headway in minutes, or of the observed median headway if not given.
+    """
+    arrivals, errors = estimate_arrivals(columns)
+    headways = np.diff(arrivals)
+    headways = headways[headways <= MAX_HEADWAY] / 60
+    statistics = {"arrivals": len(arrivals)}
+    timestamps = _as_array(columns[0], np.float64)
+    if len(timestamps):
+        statistics["window_hours"] = float(timestamps.max() - timestamps.min()) / 3600
+    if len(headways):
+        median = float(np.median(headways))
+        reference = scheduled_headway or median
+        statistics.update(
+            headway_mean=float(headways.mean()),
+            headway_median=median,
+            headway_p90=float(np.percentile(headways, 90)),
+            bunching_rate=float(
+                np.count_nonzero(headways < BUNCHING_FACTOR * reference) / len(headways)
+            ),
+        )
+    if len(errors):
+        statistics.update(
+            eta_error_mean=float(errors.mean()),
+            eta_error_mae=float(np.abs(errors).mean()),
+            eta_error_p90=float(np.percentile(np.abs(errors), 90)),
+        )
+    return LineStatistics(**statistics)
+
+
+def compute_statistics(history, scheduled_headways=None):
+    """Compute the statistics of every line of a history read with read_history.
+
+    The scheduled headways, if given, are keyed like the history by bus stop ID and
+    line.
+    """
+    scheduled_headways = scheduled_headways or {}
+    return {
+        key: compute_line_statistics(columns, scheduled_headways.get(key))
+        for key, columns in history.items()
+    }
@@ -0,0 +1,137 @@
+"""Persistent storage of the EMT Madrid integration."""
+
+from datetime import timedelta
+
+from homeassistant.const import EVENT_HOMEASSISTANT_STOP
+from homeassistant.core import HomeAssistant, callback
+from homeassistant.helpers.event import async_track_time_interval
+from homeassistant.helpers.storage import STORAGE_DIR, Store
+
+from .auth import TokenManager
+from .breaker import CircuitBreakerRegistry
+from .cache import StopInfoCache
+from .history import ArrivalHistory
+from .index import StopIndex
+from .quota import QuotaManager
+
+DOMAIN = "emt_madrid"
+STORAGE_VERSION = 1
+STORAGE_SAVE_DELAY = 10
+TOKEN_STORAGE_KEY = f"{DOMAIN}.tokens"
+CIRCUIT_BREAKERS_KEY = f"{DOMAIN}.circuit_breakers"
+STOP_INFO_STORAGE_KEY = f"{DOMAIN}.stops"
+STOP_INDEX_STORAGE_KEY = f"{DOMAIN}.stop_index"
+HISTORY_STORAGE_KEY = f"{DOMAIN}.history"
+HISTORY_SPILL_INTERVAL = timedelta(hours=1)
+QUOTA_SAVE_INTERVAL = timedelta(minutes=5)
+
+
+async def async_get_token_manager(hass: HomeAssistant) -> TokenManager:
+    """Retrieve the token manager shared by the platform, with its persisted tokens."""
+    token_manager, _ = await _async_get_shared(
+        hass, TOKEN_STORAGE_KEY, _async_load_accounts
+    )
+    return token_manager
+
+
+async def async_get_quota_manager(hass: HomeAssistant) -> QuotaManager:
+    """Retrieve the quota manager shared by the platform, with the persisted usage."""
+    _, quota_manager = await _async_get_shared(
+        hass, TOKEN_STORAGE_KEY, _async_load_accounts
+    )
+    return quota_manager
+
+
+def get_circuit_breakers(hass: HomeAssistant) -> CircuitBreakerRegistry:
+    """Retrieve the circuit breakers of the accounts shared by the platform."""
+    domain_data = hass.data.setdefault(DOMAIN, {})
+    return domain_data.setdefault(CIRCUIT_BREAKERS_KEY, CircuitBreakerRegistry())
+
+
+async def async_get_stop_info_cache(hass: HomeAssistant) -> StopInfoCache:
+    """Retrieve the bus stop cache shared by the platform, with its persisted stops."""
+    return await _async_get_shared(
+        hass, STOP_INFO_STORAGE_KEY, _async_load_persisted, StopInfoCache
+    )
+
+
+async def async_get_stop_index(hass: HomeAssistant) -> StopIndex:
+    """Retrieve the bus stop index shared by the platform, with its persisted stops."""
+    return await _async_get_shared(
+        hass, STOP_INDEX_STORAGE_KEY, _async_load_persisted, StopIndex
+    )
+
+
+async def async_get_arrival_history(hass: HomeAssistant) -> ArrivalHistory:
+    """Retrieve the arrival history shared by the platform, with its last records."""
+    return await _async_get_shared(
+        hass, HISTORY_STORAGE_KEY, _async_load_arrival_history
+    )
+
+
+async def _async_get_shared(hass: HomeAssistant, key, async_load, *args):
+    """Retrieve an object shared by the platform, loaded once under its storage key.
+
+    The first caller starts the loading task and the others wait for the same one.
+    """
+    domain_data = hass.data.setdefault(DOMAIN, {})
+    if key not in domain_data:
+        domain_data[key] = hass.async_create_task(async_load(hass, key, *args))
+    return await domain_data[key]
+
+
+async def _async_load_persisted(hass: HomeAssistant, key, factory):
+    """Create an object saving itself in the Home Assistant storage when it changes.
+
+    The factory is called with the on_change callback, and the object restores and
+    returns its persisted content with restore and as_dict.
+    """
+    store = Store(hass, STORAGE_VERSION, key)
+    persisted = factory(
+        on_change=lambda: store.async_delay_save(persisted.as_dict, STORAGE_SAVE_DELAY)
+    )
+    persisted.restore(await store.async_load() or {})
+    return persisted
+
+
+async def _async_load_accounts(hass: HomeAssistant, key):
+    """Create token and quota managers persisted in the Home Assistant storage.
+
+    Both are stored together, as the tokens and quotas mappings of one private
+    storage file keyed by account. The tokens are saved when they change, and the
+    quota usage every few minutes and when Home Assistant stops, so a restart
+    without a login knows how many requests are left today.
+    """
+    store = Store(hass, STORAGE_VERSION, key, private=True)
+
+    @callback
+    def async_save(*_) -> None:
+        store.async_delay_save(
+            lambda: {
+                "tokens": token_manager.as_dict(),
+                "quotas": quota_manager.as_dict(),
+            },
+            STORAGE_SAVE_DELAY,
+        )
+
+    token_manager = TokenManager(on_change=async_save)
+    quota_manager = QuotaManager()
+    data = await store.async_load() or {}
+    token_manager.restore(data.get("tokens", {}))
+    quota_manager.restore(data.get("quotas", {}))
+    async_track_time_interval(hass, async_save, QUOTA_SAVE_INTERVAL)
+    hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, async_save)
+    return token_manager, quota_manager
+
+
+async def _async_load_arrival_history(hass: HomeAssistant, key) -> ArrivalHistory:
+    """Create an arrival history spilled every hour and when Home Assistant stops."""
+    history = ArrivalHistory(hass.config.path(STORAGE_DIR, key))
+    await hass.async_add_executor_job(history.load)
+
+    async def async_spill(*_) -> None:
+        await hass.async_add_executor_job(history.spill)
+
+    async_track_time_interval(hass, async_spill, HISTORY_SPILL_INTERVAL)
+    hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, async_spill)
+    return history
@@ -0,0 +1,123 @@
+"""Tracking of the buses approaching a bus stop across polls."""
+
+from dataclasses import dataclass
+import threading
+
+from .spatial import distance
+
+# Weight of the latest speed measurement in the smoothed speed of a bus.
+SPEED_SMOOTHING = 0.5
+# Faster speeds, in meters per second, are measurement errors.
+MAX_SPEED = 25
+# Bounds of the pace used to count down the arrival time of a bus.
+MIN_PACE = 0.5
+MAX_PACE = 2.0
+
+
+@dataclass(slots=True)
+class Vehicle:
+    """A bus approaching a bus stop, as seen in the last poll."""
+
+    bus: int
+    line: str
+    eta: int
+    distance: int | None
+    coordinates: list[float] | None
+    deviation: int | None
+    timestamp: float
+    speed: float | None = None
+
+    @property
+    def pace(self) -> float:
+        """Return how fast the bus moves compared to the speed implied by its ETA.
+
+        The arrival time is counted down at this rate between polls, so a bus stuck
+        in traffic counts down slower than the clock, down to MIN_PACE for a stopped
+        bus. Without a speed measurement yet, it follows the clock.
+        """
+        if self.speed is None or not self.distance or self.eta <= 0:
+            return 1.0
+        return min(max(self.speed / (self.distance / self.eta), MIN_PACE), MAX_PACE)
+
+    def as_dict(self):
+        """Return the vehicle information, with the speed in km/h."""
+        return {
+            "bus": self.bus,
+            "eta": self.eta,
+            "distance": self.distance,
+            "speed": round(self.speed * 3.6, 1) if self.speed is not None else None,
+            "deviation": self.deviation,
+            "coordinates": self.coordinates,
+        }
+
+
+class VehicleTracker:
+    """A tracker of the buses approaching a bus stop, matched by bus ID.
+
+    The speed of a bus is estimated from how much closer it got between two polls,
+    along the route if the API gave the distances, or in a straight line between its
+    positions otherwise. A bus missing from a poll of its line is considered to have
+    arrived and is no longer tracked.
+    """
+
+    def __init__(self) -> None:
+        """Initialize an instance of the VehicleTracker class."""
+        self._vehicles = {}
+        self._lock = threading.Lock()
+
+    def _estimate_speed(self, previous: Vehicle, vehicle: Vehicle):
+        """Estimate the speed of a bus from its previous and current observations."""
+        elapsed = vehicle.timestamp - previous.timestamp
+        if elapsed <= 0:
+            return previous.speed
+        if previous.distance is not None and vehicle.distance is not None:
+            covered = previous.distance - vehicle.distance
+        elif previous.coordinates and vehicle.coordinates:
+            lon1, lat1 = previous.coordinates[:2]
+            lon2, lat2 = vehicle.coordinates[:2]
+            covered = distance(lat1, lon1, lat2, lon2)
+        else:
+            return previous.speed
+        speed = covered / elapsed
+        if speed < 0 or speed > MAX_SPEED:
+            # The bus started a new trip or was wrongly located.
+            return None
+        if previous.speed is None:
+            return speed
+        return SPEED_SMOOTHING * speed + (1 - SPEED_SMOOTHING) * previous.speed
+
+    def update(self, vehicles):
+        """Track the buses of a poll, given as lists of Vehicle keyed by line.
+
+        The speeds of the buses already tracked are set on the given vehicles.
+        """
+        with self._lock:
+            tracked = {
+                bus: vehicle
+                for bus, vehicle in self._vehicles.items()
+                if vehicle.line not in vehicles
+            }
+            for line_vehicles in vehicles.values():
+                for vehicle in line_vehicles:
+                    previous = self._vehicles.get(vehicle.bus)
+                    if previous is not None and previous.line == vehicle.line:
+                        vehicle.speed = self._estimate_speed(previous, vehicle)
+                    tracked[vehicle.bus] = vehicle
+            self._vehicles = tracked
+
+    def get(self, bus) -> Vehicle | None:
+        """Retrieve a tracked bus."""
+        with self._lock:
+            return self._vehicles.get(bus)
+
+    def vehicles(self, line):
+        """Retrieve the tracked buses of a line, the closest first."""
+        with self._lock:
+            return sorted(
+                (
+                    vehicle
+                    for vehicle in self._vehicles.values()
+                    if vehicle.line == line
+                ),
+                key=lambda vehicle: vehicle.eta,
+            )
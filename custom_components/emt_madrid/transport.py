@@ -0,0 +1,204 @@
+"""Record and replay transports for the EMT Madrid API clients."""
+
+import asyncio
+import copy
+import json
+import random
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+
+from .persistence import load_json, save_json
+
+CASSETTE_VERSION = 1
+STOP_ID_SEGMENT = re.compile(r"/\d+/")
+
+FAULT_TIMEOUT = "timeout"
+FAULT_RESPONSES = {
+    "80": {"code": "80", "description": "Invalid token", "data": []},
+    "81": {"code": "81", "description": "Stop not found", "data": []},
+    "90": {"code": "90", "description": "Error managing internal services", "data": []},
+    "98": {"code": "98", "description": "Limit of use exceeded", "data": []},
+}
+
+# Fields of the login responses identifying the account, blanked when recording.
+SCRUBBED_FIELDS = ("email", "userName", "username", "idUser")
+SCRUBBED_TOKEN = "00000000-0000-0000-0000-000000000000"
+
+
+def request_key(method, url) -> str:
+    """Return the key of a request, without the host so any base URL matches."""
+    return f"{method} {urlsplit(url).path}"
+
+
+def request_pattern(key) -> str:
+    """Return the key of a request with the bus stop IDs replaced by a wildcard."""
+    return STOP_ID_SEGMENT.sub("/*/", key)
+
+
+def scrub_response(response):
+    """Return a copy of a response without the access token and account details.
+
+    The token is replaced wherever it appears, as the login description repeats it.
+    """
+    data = response.get("data") if isinstance(response, dict) else None
+    items = [item for item in data if isinstance(item, dict)] if data else []
+    text = json.dumps(response)
+    for item in items:
+        token = item.get("accessToken")
+        if isinstance(token, str) and token:
+            text = text.replace(token, SCRUBBED_TOKEN)
+    response = json.loads(text)
+    for item in response["data"] if items else []:
+        if isinstance(item, dict):
+            for name in SCRUBBED_FIELDS:
+                if name in item:
+                    item[name] = ""
+    return response
+
+
+class Transport:
+    """A transport sending every request through the given send function.
+
+    The clients call request, or async_request, with the function that sends the
+    request over HTTP. Subclasses can record the responses or answer without it.
+    """
+
+    def request(self, send, method, url, headers=None, data=None):
+        """Send a request and return the decoded response."""
+        return send(method, url, headers, data)
+
+    async def async_request(self, send, method, url, headers=None, data=None):
+        """Send a request from the event loop and return the decoded response."""
+        return await send(method, url, headers, data)
+
+
+class RecordTransport(Transport):
+    """A transport saving every API response to a cassette file.
+
+    Responses are kept in order per request, including the ones with error codes,
+    so a replay goes through the same sequence. The access token and account
+    details of the login responses are scrubbed, so cassettes can be shared.
+    """
+
+    def __init__(self, path) -> None:
+        """Initialize an instance of the RecordTransport class."""
+        self._path = path
+        self._interactions = {}
+        self._lock = threading.Lock()
+
+    def request(self, send, method, url, headers=None, data=None):
+        """Send a request and record its response."""
+        response = send(method, url, headers, data)
+        self.record(method, url, response)
+        return response
+
+    async def async_request(self, send, method, url, headers=None, data=None):
+        """Send a request from the event loop and record its response."""
+        response = await send(method, url, headers, data)
+        self.record(method, url, response)
+        return response
+
+    def record(self, method, url, response):
+        """Add a response to the cassette, scrubbed of the account credentials."""
+        response = scrub_response(response)
+        with self._lock:
+            self._interactions.setdefault(request_key(method, url), []).append(response)
+
+    def save(self):
+        """Write the recorded responses to the cassette file."""
+        with self._lock:
+            cassette = {
+                "version": CASSETTE_VERSION,
+                "interactions": dict(self._interactions),
+            }
+        save_json(self._path, cassette, "the recorded responses")
+
+
+class ReplayTransport(Transport):
+    """A transport answering from a cassette file, without the network or quota.
+
+    The responses of each request are replayed in the recorded order, starting again
+    after the last one. Requests for bus stops that were not recorded get the
+    responses of another bus stop of the same endpoint, so a few recorded stops can
+    simulate many. Every response is delayed by the latency plus a random jitter,
+    and the faults map an API error code, or "timeout", to the probability of
+    answering with it instead.
+    """
+
+    def __init__(self, path, latency=0.0, jitter=0.0, faults=None, seed=None) -> None:
+        """Initialize an instance of the ReplayTransport class."""
+        self._latency = latency
+        self._jitter = jitter
+        self._faults = dict(faults or {})
+        unknown = set(self._faults) - set(FAULT_RESPONSES) - {FAULT_TIMEOUT}
+        if unknown:
+            raise ValueError(f"Invalid faults: {', '.join(sorted(unknown))}")
+        self._random = random.Random(seed)
+        self._interactions = {}
+        self._patterns = {}
+        self._positions = {}
+        self._lock = threading.Lock()
+        self.load(path)
+
+    def load(self, path):
+        """Load the responses of a cassette file."""
+        cassette = load_json(path, "the recorded responses")
+        if cassette is None:
+            raise ValueError(f"Unable to load the recorded responses from {path}")
+        if cassette.get("version") != CASSETTE_VERSION:
+            raise ValueError(f"Unsupported cassette version in {path}")
+        with self._lock:
+            self._interactions = cassette["interactions"]
+            self._patterns = {}
+            for key in self._interactions:
+                self._patterns.setdefault(request_pattern(key), key)
+            self._positions = {}
+
+    def request(self, send, method, url, headers=None, data=None):
+        """Answer a request from the cassette after the simulated latency."""
+        delay, response = self._next_response(method, url)
+        time.sleep(delay)
+        if response is None:
+            raise requests.Timeout(f"Simulated timeout for {url}")
+        return response
+
+    async def async_request(self, send, method, url, headers=None, data=None):
+        """Answer a request from the cassette without blocking the event loop."""
+        delay, response = self._next_response(method, url)
+        await asyncio.sleep(delay)
+        if response is None:
+            raise asyncio.TimeoutError(f"Simulated timeout for {url}")
+        return response
+
+    def _next_response(self, method, url):
+        """Return the delay and response of a request, or None for a timeout."""
+        key = request_key(method, url)
+        with self._lock:
+            delay = max(self._latency + self._random.uniform(-1, 1) * self._jitter, 0)
+            fault = self._pick_fault()
+            if fault == FAULT_TIMEOUT:
+                return delay, None
+            if fault is not None:
+                return delay, copy.deepcopy(FAULT_RESPONSES[fault])
+            recorded_key = key
+            if recorded_key not in self._interactions:
+                recorded_key = self._patterns.get(request_pattern(key))
+            if recorded_key is None:
+                raise ValueError(f"No recorded response for {key}")
+            responses = self._interactions[recorded_key]
+            position = self._positions.get(key, 0)
+            self._positions[key] = (position + 1) % len(responses)
+            return delay, copy.deepcopy(responses[position])
+
+    def _pick_fault(self):
+        """Return the fault to inject in the next response, if any."""
+        draw = self._random.random()
+        for fault, probability in self._faults.items():
+            if draw < probability:
+                return fault
+            draw -= probability
+        return None
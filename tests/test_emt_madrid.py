@@ -0,0 +1,746 @@
+"""The tests for the EMT Madrid API client."""
+
+
+import asyncio
+from datetime import timedelta
+import json
+import os
+import stat
+import time
+from unittest.mock import patch
+
+import pytest
+import requests
+
+from homeassistant.components.emt_madrid import auth, breaker, cache, index, quota
+from homeassistant.components.emt_madrid.auth import Credentials, TokenManager
+from homeassistant.components.emt_madrid.breaker import CircuitBreaker
+from homeassistant.components.emt_madrid.cache import StopInfoCache
+from homeassistant.components.emt_madrid.emt_madrid import (
+    APIEMT,
+    DEFAULT_BACKOFF_FACTOR,
+    DEFAULT_RETRIES,
+    RETRY_STATUS_CODES,
+    APIEMTBatch,
+    AsyncAPIEMT,
+    create_session,
+    get_shared_session,
+)
+from homeassistant.components.emt_madrid.history import (
+    ArrivalHistory,
+    LineHistory,
+    read_history,
+)
+from homeassistant.components.emt_madrid.index import StopIndex
+from homeassistant.components.emt_madrid.model import Arrival
+from homeassistant.components.emt_madrid.quota import QuotaManager, QuotaTracker
+from homeassistant.components.emt_madrid.stats import compute_line_statistics
+from homeassistant.components.emt_madrid.tracker import (
+    MIN_PACE,
+    Vehicle,
+    VehicleTracker,
+)
+from homeassistant.components.emt_madrid.transport import (
+    RecordTransport,
+    ReplayTransport,
+)
+
+from .test_sensor import make_request_mock
+
+
+@pytest.fixture(autouse=True)
+def reset_shared_clients_state():
+    """Give every test its own shared tokens, quotas, breakers and bus stops."""
+    with (
+        patch.dict(auth._token_managers, clear=True),
+        patch.dict(cache._stop_info_caches, clear=True),
+        patch.dict(index._stop_indexes, clear=True),
+        patch.object(quota, "_quota_manager", None),
+        patch.object(breaker, "_circuit_breakers", None),
+    ):
+        yield
+
+
+def failing_stop_request_mock(url, headers=None, data=None, method="POST"):
+    """Mock the API request, failing the arrival times of bus stop 4490."""
+    if data and data.get("stopId") == 4490:
+        raise requests.HTTPError("Error while connecting to EMT API")
+    return make_request_mock(url, headers=headers, data=data, method=method)
+
+
+def session_request_mock(session, method, url, headers=None, data=None, **kwargs):
+    """Mock the requests sent through a session with the API responses."""
+    response = requests.Response()
+    response.status_code = 200
+    body = make_request_mock(url, headers, data and json.loads(data), method)
+    response._content = json.dumps(body).encode()
+    return response
+
+
+def test_shared_session() -> None:
+    """Test that the clients share a keep-alive session retrying transient errors."""
+
+    retry = create_session().get_adapter("https://openapi.emtmadrid.es/").max_retries
+    assert retry.total == DEFAULT_RETRIES
+    assert retry.backoff_factor == DEFAULT_BACKOFF_FACTOR
+    assert set(retry.status_forcelist) == set(RETRY_STATUS_CODES)
+    assert "POST" in retry.allowed_methods
+
+    with patch.object(
+        requests.Session, "request", autospec=True, side_effect=session_request_mock
+    ) as mock_request:
+        APIEMT("session1@mail.com", "password123", 72).authenticate()
+        APIEMT("session2@mail.com", "password123", 4490).authenticate()
+
+    assert mock_request.call_count == 2
+    sessions = {call.args[0] for call in mock_request.call_args_list}
+    assert sessions == {get_shared_session()}
+
+
+def test_empty_response_body() -> None:
+    """Test that an empty response body raises a ValueError, like an invalid one."""
+
+    response = requests.Response()
+    response.status_code = 200
+    response._content = b""
+    with patch.object(requests.Session, "request", return_value=response):
+        with pytest.raises(ValueError):
+            APIEMT("empty@mail.com", "password123", 72).authenticate()
+
+
+@patch(
+    "homeassistant.components.emt_madrid.emt_madrid.APIEMT._make_request",
+    side_effect=failing_stop_request_mock,
+)
+def test_batch_arrival_times(mock_request) -> None:
+    """Test that a failing bus stop does not prevent updating the others."""
+
+    batch = APIEMTBatch("batch@mail.com", "password123", [72, 4490, 123456])
+    result = batch.update_arrival_times()
+
+    assert set(result.results) == {72, 123456}
+    assert set(result.errors) == {4490}
+    assert result.results[72].name == "Cibeles-Casa de América"
+    assert batch.get_client(72).get_arrival_time("27") == [3, 25]
+
+
+def test_batch_retries_stop_info() -> None:
+    """Test that a batch loads its stops after a failed login and reports any error."""
+
+    login_responses = iter([{"code": "90", "description": "Error", "data": []}])
+
+    def flaky_request_mock(url, headers=None, data=None, method="POST"):
+        if url.endswith("/user/login/"):
+            return next(login_responses, None) or make_request_mock(url, headers)
+        if "/4490/" in url:
+            raise RuntimeError("Unexpected error")
+        return make_request_mock(url, headers, data, method)
+
+    with patch(
+        "homeassistant.components.emt_madrid.emt_madrid.APIEMT._make_request",
+        side_effect=flaky_request_mock,
+    ):
+        batch = APIEMTBatch("flaky-batch@mail.com", "password123", [72, 4490])
+        batch.update_arrival_times([72])
+        assert batch.get_client(72).get_stop_info().name is None
+        result = batch.update_arrival_times()
+
+    assert result.results[72].name == "Cibeles-Casa de América"
+    assert batch.get_client(72).get_arrival_time("27") == [3, 25]
+    assert isinstance(result.errors[4490], RuntimeError)
+
+
+def test_quota_poll_interval() -> None:
+    """Test that the polling interval spreads the remaining daily quota."""
+
+    quota = QuotaTracker()
+    quota.update_from_login({"current": 96, "dailyUse": 20000})
+    for stop_id in range(60):
+        quota.register_stop(stop_id)
+
+    assert quota.remaining == 19904
+    assert quota.can_request()
+    assert quota.poll_interval(timedelta(minutes=1)) >= timedelta(minutes=1)
+
+    quota.update_from_login({"current": 19700, "dailyUse": 20000})
+    assert not quota.can_request()
+    assert quota.poll_interval(timedelta(minutes=1)) >= timedelta(minutes=1)
+
+    restored = QuotaTracker()
+    restored.restore(quota.as_dict())
+    assert restored.used == 19700
+    restored.restore({**quota.as_dict(), "day": "2000-01-01", "used": 0})
+    assert restored.used == 19700
+
+
+@patch(
+    "homeassistant.components.emt_madrid.emt_madrid.APIEMT._make_request",
+    side_effect=make_request_mock,
+)
+def test_credential_pool(mock_request) -> None:
+    """Test that requests are routed to the account of the pool with quota left."""
+
+    user = Credentials(email="pool@mail.com", password="password123")
+    app = Credentials(client_id="pool-client", pass_key="pool-pass-key")
+    quota_manager = QuotaManager()
+    quota_manager.get(user.key).mark_exhausted()
+    api_emt = APIEMT(
+        None, None, 72, credentials=[user, app], quota_manager=quota_manager
+    )
+    api_emt.update_stop_info(72)
+    api_emt.update_arrival_times(72)
+
+    login_headers = mock_request.call_args_list[0].kwargs["headers"]
+    assert login_headers == {"X-ClientId": "pool-client", "passKey": "pool-pass-key"}
+    assert api_emt.get_arrival_time("27") == [3, 25]
+    quota = api_emt.get_quota()
+    assert quota.daily_limit == (
+        quota_manager.get(user.key).daily_limit + quota_manager.get(app.key).daily_limit
+    )
+
+
+def test_failed_login_retried() -> None:
+    """Test that a failed login is retried, unless the credentials were rejected."""
+
+    login_responses = iter([{"code": "90", "description": "Error", "data": []}])
+
+    def flaky_login_request_mock(url, headers=None, data=None, method="POST"):
+        if url.endswith("/user/login/"):
+            return next(login_responses, None) or make_request_mock(url, headers)
+        return make_request_mock(url, headers, data, method)
+
+    with patch(
+        "homeassistant.components.emt_madrid.emt_madrid.APIEMT._make_request",
+        side_effect=flaky_login_request_mock,
+    ) as mock_request:
+        api_emt = APIEMT("flaky@mail.com", "password123", 72)
+        api_emt.update_stop_info(72)
+        assert api_emt.get_stop_info().name is None
+
+        api_emt.update_stop_info(72)
+        api_emt.update_arrival_times(72)
+        assert api_emt.get_arrival_time("27") == [3, 25]
+        assert not api_emt.is_stale()
+
+        mock_request.reset_mock()
+        api_emt = APIEMT("invalid@email.com", "password123", 4490)
+        api_emt.update_stop_info(4490)
+        api_emt.update_stop_info(4490)
+        assert mock_request.call_count == 1
+
+
+@patch(
+    "homeassistant.components.emt_madrid.cache.current_day_type",
+    return_value="FE",
+)
+@patch(
+    "homeassistant.components.emt_madrid.emt_madrid.APIEMT._make_request",
+    side_effect=make_request_mock,
+)
+def test_cached_stop_info(mock_request, mock_day_type, tmp_path) -> None:
+    """Test that a persisted bus stop is not requested again."""
+
+    path = tmp_path / "stops.json"
+    api_emt = APIEMT(
+        "cache@mail.com", "password123", 72, stop_info_cache=StopInfoCache(path)
+    )
+    api_emt.update_stop_info(72)
+    assert mock_request.call_count == 2
+
+    stop_info_cache = StopInfoCache(path)
+    stop_info_cache.load()
+    api_emt = APIEMT(
+        "cache@mail.com", "password123", 72, stop_info_cache=stop_info_cache
+    )
+    api_emt.update_stop_info(72)
+    assert mock_request.call_count == 2
+    assert api_emt.get_stop_info().name == "Cibeles-Casa de América"
+    assert api_emt.get_line_info("27").max_freq == 25
+
+    mock_day_type.return_value = "LA"
+    api_emt.update_stop_info(72)
+    assert mock_request.call_count == 3
+
+
+def test_persisted_tokens(tmp_path) -> None:
+    """Test that the access tokens are saved to a file only readable by its owner."""
+
+    path = str(tmp_path / "tokens.json")
+    token_manager = TokenManager(path)
+    token_manager.store("account", "token")
+    token_manager.save()
+
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    restored = TokenManager(path)
+    restored.load()
+    assert restored.get("account") == "token"
+
+
+@patch(
+    "homeassistant.components.emt_madrid.emt_madrid.AsyncAPIEMT._make_request",
+    side_effect=make_request_mock,
+)
+async def test_coalesced_arrival_times(mock_request) -> None:
+    """Test that concurrent updates of the same bus stop share a single request."""
+
+    api_emt = AsyncAPIEMT(None, "flight@mail.com", "password123", 72)
+    await api_emt.update_stop_info(72)
+    mock_request.reset_mock()
+
+    results = await asyncio.gather(
+        *(api_emt.update_arrival_times(72) for _ in range(5))
+    )
+
+    assert mock_request.call_count == 1
+    assert all(result is results[0] for result in results)
+    assert api_emt.get_arrival_time("27") == [3, 25]
+
+
+@patch(
+    "homeassistant.components.emt_madrid.emt_madrid.APIEMT._make_request",
+    side_effect=make_request_mock,
+)
+def test_fresh_arrival_times_from_cache(mock_request) -> None:
+    """Test that recently updated arrival times are not requested again."""
+
+    api_emt = APIEMT("fresh@mail.com", "password123", 72, min_freshness=60)
+    api_emt.update_stop_info(72)
+    api_emt.update_arrival_times(72)
+    mock_request.reset_mock()
+
+    api_emt.update_arrival_times(72)
+
+    assert mock_request.call_count == 0
+    assert api_emt.get_arrival_time("27") == [3, 25]
+
+
+@patch(
+    "homeassistant.components.emt_madrid.emt_madrid.APIEMT._make_request",
+    side_effect=make_request_mock,
+)
+def test_arrival_times_countdown(mock_request) -> None:
+    """Test that the arrival times are counted down locally between updates."""
+
+    api_emt = APIEMT("countdown@mail.com", "password123", 72)
+    api_emt.update_stop_info(72)
+    api_emt.update_arrival_times(72)
+    now = time.time()
+
+    assert api_emt.get_arrival_time("27", now) == [3, 25]
+    assert api_emt.get_arrival_time("27", now + 120) == [1, 23]
+    assert api_emt.get_arrival_time("27", now + 240) == [21, None]
+
+
+@patch(
+    "homeassistant.components.emt_madrid.emt_madrid.APIEMT._make_request",
+    side_effect=make_request_mock,
+)
+def test_subscribed_lines_arrival_times(mock_request) -> None:
+    """Test that only the arrival times of the subscribed lines are parsed."""
+
+    api_emt = APIEMT("subscribed@mail.com", "password123", 72)
+    api_emt.subscribe_lines(["27"])
+    api_emt.update_stop_info(72)
+    api_emt.update_arrival_times(72)
+
+    assert api_emt.get_arrival_time("27") == [3, 25]
+    assert api_emt.get_arrival_time("5") == [None, None]
+
+
+@patch(
+    "homeassistant.components.emt_madrid.emt_madrid.APIEMT._make_request",
+    side_effect=make_request_mock,
+)
+def test_arrival_history(mock_request, tmp_path) -> None:
+    """Test that the arrival times of every poll are recorded and spilled."""
+
+    path = str(tmp_path / "history")
+    history = ArrivalHistory(path)
+    api_emt = APIEMT(
+        "history@mail.com", "password123", 72, min_freshness=0, history=history
+    )
+    api_emt.update_stop_info(72)
+    api_emt.update_arrival_times(72)
+    history.spill()
+    api_emt.update_arrival_times(72)
+    history.spill()
+
+    timestamps, etas, distances, buses = history.get(72, "27")
+    assert len(timestamps) == 4
+    assert [eta // 60 for eta in etas] == [3, 25, 3, 25]
+    assert history.pending() == 0
+
+    spilled = read_history(path)
+    assert spilled[(72, "27")] == history.get(72, "27")
+    restored = ArrivalHistory(path)
+    restored.load()
+    assert restored.get(72, "27") == history.get(72, "27")
+    assert sorted(restored.keys()) == sorted(history.keys())
+
+
+def test_history_spill_failure_and_rotation(tmp_path) -> None:
+    """Test that unwritten records are spilled again and full files are rotated."""
+
+    path = str(tmp_path / "history")
+    history = ArrivalHistory(path, max_size=1)
+    history.record(72, {"27": [Arrival(180, 674, 528, 1.0)]})
+    with patch("homeassistant.components.emt_madrid.history.open", side_effect=OSError):
+        history.spill()
+    assert history.pending() == 1
+
+    history.spill()
+    history.record(72, {"27": [Arrival(60, 200, 528, 2.0)]})
+    history.spill()
+
+    assert history.pending() == 0
+    assert read_history(f"{path}.1")[(72, "27")][1].tolist() == [180]
+    assert read_history(path)[(72, "27")][1].tolist() == [60]
+    restored = ArrivalHistory(path)
+    restored.load()
+    assert restored.get(72, "27") == history.get(72, "27")
+
+
+def test_line_history_ring_buffer() -> None:
+    """Test that a full line history overwrites its oldest records."""
+
+    line_history = LineHistory(capacity=3)
+    for index in range(5):
+        line_history.append(float(index), index * 60, None, index)
+
+    assert len(line_history) == 3
+    assert line_history.records() == [
+        (2.0, 120, -1, 2),
+        (3.0, 180, -1, 3),
+        (4.0, 240, -1, 4),
+    ]
+    assert line_history.columns(last=1)[1].tolist() == [240]
+
+
+def test_line_statistics() -> None:
+    """Test the headways and ETA errors computed from the recorded arrivals."""
+
+    line_history = LineHistory()
+    for timestamp, eta, bus in (
+        (0, 540, 1),
+        (300, 290, 1),
+        (540, 60, 1),
+        (600, 600, 2),
+        (600, 700, 3),
+        (1140, 60, 2),
+        (1200, 60, 3),
+        (1200, 1500, 4),
+    ):
+        line_history.append(float(timestamp), eta, None, bus)
+
+    statistics = compute_line_statistics(line_history.columns(), scheduled_headway=10)
+
+    assert statistics.arrivals == 3
+    assert statistics.window_hours == 1 / 3
+    assert statistics.headway_mean == 5.5
+    assert statistics.headway_median == 5.5
+    assert statistics.bunching_rate == 0.5
+    assert statistics.eta_error_mean == 7.5
+    assert statistics.eta_error_mae == 27.5
+    assert compute_line_statistics(LineHistory().columns()).arrivals == 0
+
+
+def test_vehicle_tracker() -> None:
+    """Test that buses are matched across polls to count down at their pace."""
+
+    def vehicle(bus, line, eta, distance, timestamp):
+        return Vehicle(bus, line, eta, distance, None, 0, timestamp)
+
+    tracker = VehicleTracker()
+    tracker.update({"27": [vehicle(528, "27", 240, 1200, 0.0)]})
+    slowed_down = vehicle(528, "27", 180, 1020, 60.0)
+    tracker.update({"27": [slowed_down, vehicle(515, "27", 900, 4000, 60.0)]})
+
+    assert slowed_down.speed == 3.0
+    assert slowed_down.pace == pytest.approx(0.53, abs=0.01)
+    assert [bus.bus for bus in tracker.vehicles("27")] == [528, 515]
+    arrival = Arrival(180, 1020, 528, 60.0, pace=slowed_down.pace)
+    assert arrival.remaining(120.0) == pytest.approx(148.2, abs=0.1)
+
+    tracker.update({"5": [vehicle(51, "5", 345, 1777, 120.0)]})
+    assert tracker.get(528) is not None
+    tracker.update({"27": [vehicle(515, "27", 840, 3700, 120.0)]})
+    assert tracker.get(528) is None
+    assert tracker.get(515).speed == 5.0
+
+    stopped = Vehicle(528, "27", 180, 1020, None, 0, 60.0, speed=0.0)
+    assert stopped.pace == MIN_PACE
+    assert vehicle(528, "27", 180, 1020, 60.0).pace == 1.0
+
+
+def test_record_and_replay_transport(tmp_path) -> None:
+    """Test that recorded responses are replayed without sending any request."""
+
+    cassette = str(tmp_path / "cassette.json")
+    recorder = RecordTransport(cassette)
+    with patch(
+        "homeassistant.components.emt_madrid.emt_madrid.APIEMT._send",
+        side_effect=lambda method, url, headers, data: make_request_mock(
+            url, headers, data, method
+        ),
+    ):
+        api_emt = APIEMT(
+            "record@mail.com",
+            "password123",
+            72,
+            stop_info_cache=StopInfoCache(),
+            transport=recorder,
+        )
+        api_emt.update_stop_info(72)
+        api_emt.update_arrival_times(72)
+    recorder.save()
+    with open(cassette, encoding="utf-8") as file:
+        assert "3bd5855a-ed3d-41d5-8b4b-182726f86031" not in file.read()
+
+    with patch(
+        "homeassistant.components.emt_madrid.emt_madrid.APIEMT._send"
+    ) as mock_send:
+        api_emt = APIEMT(
+            "replay@mail.com",
+            "password123",
+            4490,
+            stop_info_cache=StopInfoCache(),
+            transport=ReplayTransport(cassette),
+        )
+        api_emt.update_stop_info(4490)
+        api_emt.update_arrival_times(4490)
+
+    assert mock_send.call_count == 0
+    assert api_emt.get_stop_info().name == "Cibeles-Casa de América"
+    assert api_emt.get_arrival_time("27") == [3, 25]
+
+
+def test_replay_transport_faults(tmp_path) -> None:
+    """Test that the replay transport injects the configured faults."""
+
+    cassette = tmp_path / "cassette.json"
+    cassette.write_text('{"version": 1, "interactions": {}}')
+    transport = ReplayTransport(str(cassette), faults={"98": 1.0})
+
+    response = transport.request(None, "GET", "https://openapi.emtmadrid.es/")
+
+    assert response["code"] == "98"
+    with pytest.raises(ValueError):
+        ReplayTransport(str(cassette), faults={"99": 0.5})
+
+    transport = ReplayTransport(str(cassette), faults={"timeout": 1.0})
+    batch = APIEMTBatch(
+        "timeout@mail.com", "password123", [72, 4490], transport=transport
+    )
+    result = batch.update_arrival_times()
+
+    assert set(result.errors) == {72, 4490}
+    assert isinstance(result.errors[72], requests.Timeout)
+
+
+@patch(
+    "homeassistant.components.emt_madrid.emt_madrid.APIEMT._send",
+    side_effect=lambda method, url, headers, data: make_request_mock(
+        url, headers, data, method
+    ),
+)
+def test_request_metrics(mock_send) -> None:
+    """Test that the requests are counted per endpoint and API response code."""
+
+    api_emt = APIEMT(
+        "metrics@mail.com", "password123", 123456, stop_info_cache=StopInfoCache()
+    )
+    api_emt.update_stop_info(123456)
+    diagnostics = api_emt.get_diagnostics()
+
+    assert diagnostics["requests"] == 2
+    assert diagnostics["endpoints"]["login"]["requests"] == 1
+    assert diagnostics["endpoints"]["detail"]["errors"] == {"90": 1}
+    assert diagnostics["errors"] == {"90": 1}
+    assert diagnostics["latency_p95_ms"] is not None
+    assert diagnostics["quota_remaining"] == 19904
+
+
+def test_circuit_breaker_backoff() -> None:
+    """Test that the circuit opens after failures and lets a single probe through."""
+
+    breaker = CircuitBreaker(failure_threshold=2, base_delay=0, jitter=0)
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+    assert breaker.allow_request()
+    assert breaker.state == "half_open"
+    assert not breaker.allow_request()
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+    breaker = CircuitBreaker(failure_threshold=1, base_delay=60, jitter=0)
+    breaker.record_failure()
+    assert not breaker.allow_request()
+    assert 0 < breaker.retry_after() <= 60
+
+
+def failing_arrivals_request_mock(url, headers=None, data=None, method="POST"):
+    """Mock the API request, failing every arrival times request."""
+    if url.endswith("/arrives/"):
+        raise requests.HTTPError("Error while connecting to EMT API")
+    return make_request_mock(url, headers=headers, data=data, method=method)
+
+
+@patch(
+    "homeassistant.components.emt_madrid.emt_madrid.APIEMT._make_request",
+    side_effect=failing_arrivals_request_mock,
+)
+def test_open_circuit_keeps_arrival_times(mock_request) -> None:
+    """Test that no request is sent while the circuit is open."""
+
+    api_emt = APIEMT(
+        "breaker@mail.com", "password123", 72, min_freshness=0, stale_ttl=0
+    )
+    api_emt.update_stop_info(72)
+    for _ in range(3):
+        with pytest.raises(requests.HTTPError):
+            api_emt.update_arrival_times(72)
+    mock_request.reset_mock()
+
+    api_emt.update_arrival_times(72)
+
+    assert mock_request.call_count == 0
+    assert api_emt.is_stale()
+    assert api_emt.retry_after() > 0
+
+
+def exhausted_arrivals_request_mock(url, headers=None, data=None, method="POST"):
+    """Mock the API request, answering every arrival times request with code 98."""
+    if url.endswith("/arrives/"):
+        return {"code": "98", "description": "Limit of use exceeded", "data": []}
+    return make_request_mock(url, headers=headers, data=data, method=method)
+
+
+def test_exhausted_quota_keeps_arrival_times() -> None:
+    """Test that an exhausted quota keeps the last arrival times, without errors."""
+
+    api_emt = APIEMT(
+        "exhausted@mail.com", "password123", 72, min_freshness=0, stale_ttl=0
+    )
+    with patch(
+        "homeassistant.components.emt_madrid.emt_madrid.APIEMT._make_request",
+        side_effect=make_request_mock,
+    ):
+        api_emt.update_stop_info(72)
+        api_emt.update_arrival_times(72)
+    with patch(
+        "homeassistant.components.emt_madrid.emt_madrid.APIEMT._make_request",
+        side_effect=exhausted_arrivals_request_mock,
+    ) as mock_request:
+        api_emt.update_arrival_times(72)
+        api_emt.update_arrival_times(72)
+
+    assert mock_request.call_count == 1
+    assert api_emt.get_arrival_time("27") == [3, 25]
+    assert api_emt.is_stale()
+    assert not api_emt.get_quota().can_request()
+
+
+VALID_ARROUND_STOP = {
+    "code": "00",
+    "description": "Data recovered OK",
+    "data": [
+        {
+            "stopId": stop_id,
+            "stopName": name,
+            "address": address,
+            "geometry": {"type": "Point", "coordinates": coordinates},
+            "lines": [
+                {
+                    "line": "027",
+                    "label": "27",
+                    "to": "B",
+                    "nameA": "EMBAJADORES",
+                    "nameB": "PLAZA CASTILLA",
+                },
+                {
+                    "line": "005",
+                    "label": "5",
+                    "to": "B",
+                    "nameA": "SOL/SEVILLA",
+                    "nameB": "CHAMARTIN",
+                },
+            ],
+            "metersToPoint": meters,
+        }
+        for stop_id, name, address, coordinates, meters in (
+            (72, "Cibeles-Casa de América", "Pº Recoletos, 2", [-3.6921, 40.4203], 0),
+            (73, "Pº Recoletos-Colón", "Pº Recoletos, 22", [-3.6918, 40.4238], 390),
+        )
+    ],
+}
+
+
+def arround_stop_request_mock(url, headers=None, data=None, method="POST"):
+    """Mock the API request, answering the stops arround stop requests."""
+    if "/arroundstop/72/500/" in url:
+        return VALID_ARROUND_STOP
+    return make_request_mock(url, headers=headers, data=data, method=method)
+
+
+@patch(
+    "homeassistant.components.emt_madrid.emt_madrid.APIEMT._make_request",
+    side_effect=arround_stop_request_mock,
+)
+def test_discover_stops(mock_request) -> None:
+    """Test that discovered bus stops are set up without a detail request."""
+
+    stop_index = StopIndex()
+    api_emt = APIEMT(
+        "discovery@mail.com",
+        "password123",
+        73,
+        stop_info_cache=StopInfoCache(),
+        stop_index=stop_index,
+    )
+    stops = api_emt.discover_stops(72, 500)
+    mock_request.reset_mock()
+
+    api_emt.update_stop_info(73)
+
+    assert [stop.stop_id for stop in stops] == [72, 73]
+    assert mock_request.call_count == 0
+    assert api_emt.get_stop_info().name == "Pº Recoletos-Colón"
+    assert api_emt.get_line_info("27").destination == "PLAZA CASTILLA"
+    assert stop_index.serves(73, "5")
+    assert stop_index.stops_serving("27") == [72, 73]
+
+
+@patch(
+    "homeassistant.components.emt_madrid.emt_madrid.APIEMT._make_request",
+    side_effect=arround_stop_request_mock,
+)
+def test_nearest_stops(mock_request, tmp_path) -> None:
+    """Test that the nearest bus stops are found without any request."""
+
+    stop_index = StopIndex(tmp_path / "stop_index.json")
+    api_emt = APIEMT(
+        "nearest@mail.com",
+        "password123",
+        73,
+        stop_info_cache=StopInfoCache(),
+        stop_index=stop_index,
+    )
+    api_emt.discover_stops(72, 500)
+    stop_index.save()
+    mock_request.reset_mock()
+
+    nearest = stop_index.nearest(40.4236, -3.6917, 2)
+    assert [stop_id for stop_id, _ in nearest] == [73, 72]
+    assert nearest[0][1] < 30
+    assert [stop_id for stop_id, _ in stop_index.within(40.4236, -3.6917, 100)] == [73]
+    assert stop_index.within(40.4236, -3.6917, 500, line="1") == []
+    assert mock_request.call_count == 0
+
+    restored_index = StopIndex(tmp_path / "stop_index.json")
+    restored_index.load()
+    assert restored_index.nearest(40.4205, -3.6920) == stop_index.nearest(
+        40.4205, -3.6920
+    )
@@ -1,12 +1,25 @@
 """The tests for the EMT Madrid sensor platform."""
 
 
+from datetime import datetime, timedelta
+import time
 from unittest.mock import patch
 
+import aiohttp
+from freezegun.api import FrozenDateTimeFactory
 import pytest
 
+from homeassistant.components.emt_madrid.auth import account_key
+from homeassistant.components.emt_madrid.quota import QUOTA_TIMEZONE
+from homeassistant.components.emt_madrid.sensor import (
+    BusLineSensor,
+    UnrecordedBusLineSensor,
+)
 from homeassistant.core import HomeAssistant
 from homeassistant.setup import async_setup_component
+from homeassistant.util import dt as dt_util
+
+from tests.common import async_fire_time_changed
 
 VALID_LOGIN = {
     "code": "01",
@@ -193,9 +206,9 @@ INVALID_STOP_INFO = {
 def make_request_mock(url, headers=None, data=None, method="POST"):
     """Mock the API request."""
     if url == "https://openapi.emtmadrid.es/v1/mobilitylabs/user/login/":
-        if headers["email"] == "invalid@email.com":
+        if headers.get("email") == "invalid@email.com":
             return INVALID_USER_LOGIN
-        if headers["password"] == "invalid_password":
+        if headers.get("password") == "invalid_password":
             return INVALID_PASSWORD_LOGIN
         return VALID_LOGIN
     if (
@@ -218,7 +231,7 @@ def make_request_mock(url, headers=None, data=None, method="POST"):
 
 
 @patch(
-    "homeassistant.components.emt_madrid.sensor.APIEMT._make_request",
+    "homeassistant.components.emt_madrid.sensor.AsyncAPIEMT._make_request",
     side_effect=make_request_mock,
 )
 async def test_valid_config(setup_component, hass: HomeAssistant) -> None:
@@ -235,7 +248,7 @@ async def test_valid_config(setup_component, hass: HomeAssistant) -> None:
         }
     }
     assert await async_setup_component(hass, "sensor", config)
-    await hass.async_block_till_done()
+    await hass.async_block_till_done(wait_background_tasks=True)
     state = hass.states.get("sensor.bus_27_cibeles_casa_de_america")
 
     assert state.state == "3"
@@ -257,7 +270,7 @@ async def test_valid_config(setup_component, hass: HomeAssistant) -> None:
 
 
 @patch(
-    "homeassistant.components.emt_madrid.sensor.APIEMT._make_request",
+    "homeassistant.components.emt_madrid.sensor.AsyncAPIEMT._make_request",
     side_effect=make_request_mock,
 )
 async def test_valid_config_no_lines_specified(
@@ -274,7 +287,7 @@ async def test_valid_config_no_lines_specified(
         }
     }
     assert await async_setup_component(hass, "sensor", config)
-    await hass.async_block_till_done()
+    await hass.async_block_till_done(wait_background_tasks=True)
     state = hass.states.get("sensor.bus_27_cibeles_casa_de_america")
 
     assert state.state == "3"
@@ -334,7 +347,7 @@ async def test_valid_config_no_lines_specified(
 
 
 @patch(
-    "homeassistant.components.emt_madrid.sensor.APIEMT._make_request",
+    "homeassistant.components.emt_madrid.sensor.AsyncAPIEMT._make_request",
     side_effect=make_request_mock,
 )
 async def test_invalid_user(
@@ -353,12 +366,12 @@ async def test_invalid_user(
         }
     }
     assert await async_setup_component(hass, "sensor", config)
-    await hass.async_block_till_done()
+    await hass.async_block_till_done(wait_background_tasks=True)
     assert "Invalid email or password" in caplog.text
 
 
 @patch(
-    "homeassistant.components.emt_madrid.sensor.APIEMT._make_request",
+    "homeassistant.components.emt_madrid.sensor.AsyncAPIEMT._make_request",
     side_effect=make_request_mock,
 )
 async def test_invalid_password(
@@ -377,12 +390,12 @@ async def test_invalid_password(
         }
     }
     assert await async_setup_component(hass, "sensor", config)
-    await hass.async_block_till_done()
+    await hass.async_block_till_done(wait_background_tasks=True)
     assert "Invalid email or password" in caplog.text
 
 
 @patch(
-    "homeassistant.components.emt_madrid.sensor.APIEMT._make_request",
+    "homeassistant.components.emt_madrid.sensor.AsyncAPIEMT._make_request",
     side_effect=make_request_mock,
 )
 async def test_invalid_stop(
@@ -401,5 +414,268 @@ async def test_invalid_stop(
         }
     }
     assert await async_setup_component(hass, "sensor", config)
-    await hass.async_block_till_done()
+    await hass.async_block_till_done(wait_background_tasks=True)
     assert "Bus stop disabled or does not exist" in caplog.text
+
+
+def failing_detail_request_mock():
+    """Mock the API request, failing the first bus stop detail request."""
+    failed = []
+
+    def request_mock(url, headers=None, data=None, method="POST"):
+        if url.endswith("/detail/") and not failed:
+            failed.append(url)
+            raise aiohttp.ClientError("Error while connecting to EMT API")
+        return make_request_mock(url, headers=headers, data=data, method=method)
+
+    return request_mock
+
+
+async def test_setup_retried(setup_component, hass: HomeAssistant) -> None:
+    """Test that a bus stop that failed to load is set up again later."""
+
+    config = {
+        "sensor": {
+            "platform": "emt_madrid",
+            "email": "retry@mail.com",
+            "password": "password123",
+            "stop": 72,
+            "lines": ["27"],
+        }
+    }
+    with patch(
+        "homeassistant.components.emt_madrid.sensor.AsyncAPIEMT._make_request",
+        side_effect=failing_detail_request_mock(),
+    ):
+        assert await async_setup_component(hass, "sensor", config)
+        await hass.async_block_till_done(wait_background_tasks=True)
+        assert hass.states.get("sensor.bus_27_cibeles_casa_de_america") is None
+
+        async_fire_time_changed(hass, dt_util.utcnow() + timedelta(seconds=30))
+        await hass.async_block_till_done(wait_background_tasks=True)
+
+    state = hass.states.get("sensor.bus_27_cibeles_casa_de_america")
+    assert state.state == "3"
+
+
+async def test_single_arrivals_request_per_stop(
+    setup_component, hass: HomeAssistant
+) -> None:
+    """Test that all the lines of a bus stop share a single arrivals request."""
+
+    config = {
+        "sensor": {
+            "platform": "emt_madrid",
+            "email": "test@mail.com",
+            "password": "password123",
+            "stop": 72,
+        }
+    }
+    with patch(
+        "homeassistant.components.emt_madrid.sensor.AsyncAPIEMT._make_request",
+        side_effect=make_request_mock,
+    ) as mock_request:
+        assert await async_setup_component(hass, "sensor", config)
+        await hass.async_block_till_done(wait_background_tasks=True)
+
+    assert len(hass.states.async_entity_ids("sensor")) == 3
+    arrival_requests = [
+        call
+        for call in mock_request.call_args_list
+        if call.args[0].endswith("/arrives/")
+    ]
+    assert len(arrival_requests) == 1
+
+
+async def test_shared_login_per_account(setup_component, hass: HomeAssistant) -> None:
+    """Test that bus stops configured with the same account share the access token."""
+
+    config = {
+        "sensor": [
+            {
+                "platform": "emt_madrid",
+                "email": "shared@mail.com",
+                "password": "password123",
+                "stop": 72,
+            },
+            {
+                "platform": "emt_madrid",
+                "email": "shared@mail.com",
+                "password": "password123",
+                "stop": 4490,
+            },
+        ]
+    }
+    with patch(
+        "homeassistant.components.emt_madrid.sensor.AsyncAPIEMT._make_request",
+        side_effect=make_request_mock,
+    ) as mock_request:
+        assert await async_setup_component(hass, "sensor", config)
+        await hass.async_block_till_done(wait_background_tasks=True)
+
+    login_requests = [
+        call
+        for call in mock_request.call_args_list
+        if call.args[0].endswith("/user/login/")
+    ]
+    assert len(login_requests) == 1
+
+
+async def test_setup_from_cached_stop(
+    setup_component, hass: HomeAssistant, hass_storage
+) -> None:
+    """Test that the sensors of a cached bus stop are set up without its detail."""
+
+    hass_storage["emt_madrid.stops"] = {
+        "version": 1,
+        "minor_version": 1,
+        "key": "emt_madrid.stops",
+        "data": {
+            "72": {
+                "stop_info": {
+                    "stop_id": 72,
+                    "name": "Cibeles-Casa de América",
+                    "coordinates": [-3.6921, 40.4203],
+                    "address": "Pº de Recoletos, 2 (Pza. de Cibeles)",
+                    "lines": {
+                        "27": {
+                            "number": "27",
+                            "destination": "PLAZA CASTILLA",
+                            "origin": "EMBAJADORES",
+                            "max_freq": 25,
+                            "min_freq": 11,
+                            "start_time": "07:00",
+                            "end_time": "00:01",
+                            "day_type": None,
+                        }
+                    },
+                },
+                "endpoint": "v1/transport/busemtmad/stops/",
+                "day_type": None,
+                "updated_at": time.time(),
+            }
+        },
+    }
+    config = {
+        "sensor": {
+            "platform": "emt_madrid",
+            "email": "cached@mail.com",
+            "password": "password123",
+            "stop": 72,
+            "lines": ["27"],
+        }
+    }
+    with patch(
+        "homeassistant.components.emt_madrid.sensor.AsyncAPIEMT._make_request",
+        side_effect=make_request_mock,
+    ) as mock_request:
+        assert await async_setup_component(hass, "sensor", config)
+        await hass.async_block_till_done(wait_background_tasks=True)
+
+    state = hass.states.get("sensor.bus_27_cibeles_casa_de_america")
+    assert state.state == "3"
+    assert state.attributes["destination"] == "PLAZA CASTILLA"
+    assert not any(
+        call.args[0].endswith("/detail/") for call in mock_request.call_args_list
+    )
+
+
+async def test_quota_restored_with_token(
+    setup_component, hass: HomeAssistant, hass_storage
+) -> None:
+    """Test that the quota usage is restored along with the persisted token."""
+
+    key = account_key("restored@mail.com", "password123")
+    hass_storage["emt_madrid.tokens"] = {
+        "version": 1,
+        "minor_version": 1,
+        "key": "emt_madrid.tokens",
+        "data": {
+            "tokens": {
+                key: {
+                    "token": "3bd5855a-ed3d-41d5-8b4b-182726f86031",
+                    "expires_at": time.time() + 3600,
+                }
+            },
+            "quotas": {
+                key: {
+                    "day": datetime.now(QUOTA_TIMEZONE).date().isoformat(),
+                    "used": 15000,
+                    "daily_limit": 20000,
+                }
+            },
+        },
+    }
+    config = {
+        "sensor": {
+            "platform": "emt_madrid",
+            "email": "restored@mail.com",
+            "password": "password123",
+            "stop": 72,
+            "lines": ["27"],
+            "diagnostics": True,
+        }
+    }
+    with patch(
+        "homeassistant.components.emt_madrid.sensor.AsyncAPIEMT._make_request",
+        side_effect=make_request_mock,
+    ) as mock_request:
+        assert await async_setup_component(hass, "sensor", config)
+        await hass.async_block_till_done(wait_background_tasks=True)
+
+    assert not any(
+        call.args[0].endswith("/user/login/") for call in mock_request.call_args_list
+    )
+    state = hass.states.get("sensor.emt_madrid_72_api_quota_remaining")
+    assert state.state == "5000"
+
+
+async def test_unchanged_state_not_written(
+    setup_component, hass: HomeAssistant, freezer: FrozenDateTimeFactory
+) -> None:
+    """Test that the countdown only writes the state of the sensors that changed."""
+
+    config = {
+        "sensor": {
+            "platform": "emt_madrid",
+            "email": "unchanged@mail.com",
+            "password": "password123",
+            "stop": 72,
+            "lines": ["27"],
+            "record_static_attributes": False,
+        }
+    }
+    with patch(
+        "homeassistant.components.emt_madrid.sensor.AsyncAPIEMT._make_request",
+        side_effect=make_request_mock,
+    ):
+        assert await async_setup_component(hass, "sensor", config)
+        await hass.async_block_till_done(wait_background_tasks=True)
+
+    with patch(
+        "homeassistant.components.emt_madrid.sensor.BusLineSensor.async_write_ha_state"
+    ) as mock_write:
+        # The next bus goes from 233 to 218 seconds away, still 3 minutes.
+        freezer.tick(timedelta(seconds=15))
+        async_fire_time_changed(hass)
+        await hass.async_block_till_done()
+        assert mock_write.call_count == 0
+
+        # 178 seconds away, before the next poll, the state goes down to 2 minutes.
+        freezer.tick(timedelta(seconds=40))
+        async_fire_time_changed(hass)
+        await hass.async_block_till_done()
+        assert mock_write.call_count == 1
+
+    state = hass.states.get("sensor.bus_27_cibeles_casa_de_america")
+    assert state.state == "3"
+    assert state.attributes["stop_name"] == "Cibeles-Casa de América"
+
+
+def test_vehicles_never_recorded() -> None:
+    """Test that the tracked buses are left out of the history, whatever the option."""
+
+    assert "vehicles" in BusLineSensor._unrecorded_attributes
+    assert "vehicles" in UnrecordedBusLineSensor._unrecorded_attributes
+    assert "stop_name" in UnrecordedBusLineSensor._unrecorded_attributes
+    assert "stop_name" not in BusLineSensor._unrecorded_attributes